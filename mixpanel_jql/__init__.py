@@ -1,4 +1,23 @@
-from .query import JQL, Events, People, Reducer, Converter, raw  # noqa
-from ._version import get_versions    # noqa
-__version__ = get_versions()['version']  # noqa
-del get_versions  # noqa
+import sys
+
+from .query import JQL, Events, People, Reducer, Converter, GroupRow, Param, raw, param  # noqa
+from .coalesce import SingleFlight, coalesce  # noqa
+from .sketches import HyperLogLog, TDigest  # noqa
+
+
+def _get_version():
+    # Built distributions carry a static version written by versioneer at
+    # build time, but source checkouts have to ask git for it.
+    from ._version import get_versions
+    return get_versions()['version']
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # Resolved on first use so importing the library never shells out to git.
+        if name == '__version__':
+            version = globals()['__version__'] = _get_version()
+            return version
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    __version__ = _get_version()  # noqa
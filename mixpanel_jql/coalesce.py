@@ -0,0 +1,313 @@
+"""
+Tools for answering several queries with fewer requests to Mixpanel.
+"""
+
+from __future__ import absolute_import
+
+import collections
+from datetime import datetime, timedelta
+import json
+import threading
+
+import six
+
+from .exceptions import JQLSyntaxError
+from .query import Converter, Events, _Operation, _fetch, raw
+
+_END = object()
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class _Flight(object):
+    """
+    A single request whose rows are buffered for every subscriber. Rows
+    are pulled from the request by whichever subscriber first needs them.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+    def get(self, i):
+        """
+        Returns the i-th row of the request (or `_END` past the last one),
+        raising whatever error the request raised.
+        """
+        while True:
+            with self.condition:
+                while True:
+                    if i < len(self.buffer):
+                        return self.buffer[i]
+                    if self.error is not None:
+                        raise self.error
+                    if self.done:
+                        return _END
+                    if not self.pulling:
+                        break
+                    self.condition.wait()
+                self.pulling = True
+            row = error = None
+            try:
+                row = next(self.rows, _END)
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.pulling = False
+                if error is not None:
+                    self.error = error
+                elif row is _END:
+                    self.done = True
+                else:
+                    self.buffer.append(row)
+                self.condition.notify_all()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent sends of the same query (the same script, params
+    and API secret) into a single request. Every subscriber receives the
+    full sequence of rows, which are buffered until the request completes.
+    Rows are buffered as parsed, and decoded for each subscriber as its
+    query would decode them (e.g. naming accumulators, or not).
+
+    Sends made after a request completes start a new request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    @staticmethod
+    def _key(query):
+        return (query.ENDPOINT % query.VERSION, query.api_secret, query._compile(),
+                json.dumps(query.bindings, sort_keys=True))
+
+    def send(self, query):
+        """
+        Sends a query unless an identical one is already in flight, in which
+        case its rows are shared.
+
+        :param query: The `JQL` query to send.
+        :return: An iterator over the rows of the query.
+        """
+        key = self._key(query)
+        url, api_secret, data, decoders = query._request()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(_fetch(url, api_secret, data, ()))
+            flight.subscribers += 1
+        return self._subscribe(key, flight, decoders)
+
+    def _land(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _subscribe(self, key, flight, decoders):
+        try:
+            i = 0
+            while True:
+                try:
+                    row = flight.get(i)
+                except Exception:
+                    self._land(key, flight)
+                    raise
+                if row is _END:
+                    self._land(key, flight)
+                    return
+                for decode in decoders:
+                    row = decode(row)
+                yield row
+                i += 1
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned and self._flights.get(key) is flight:
+                    del self._flights[key]
+            if abandoned:
+                # Everyone stopped listening early, so give up on the request.
+                flight.rows.close()
+
+
+def _day_start(day, utc_offset):
+    """
+    The time (in milliseconds since the epoch) a `YYYY-MM-DD` day starts,
+    in a timezone `utc_offset` ahead of UTC.
+    """
+    start = datetime.strptime(day, '%Y-%m-%d') - _EPOCH - utc_offset
+    return (start.days * 86400 + start.seconds) * 1000
+
+
+def _event_filter(params, utc_offset):
+    """
+    A JavaScript condition matching the events selected by the given
+    `Events` params. Dates are only compared given the project's
+    `utc_offset`.
+    """
+    conditions = []
+    for k, v in params.items():
+        if k == 'event_selectors':
+            for selector in v:
+                if set(selector) - {'event', 'label'} or 'event' not in selector:
+                    raise JQLSyntaxError(
+                        "Only queries selecting events by name can be coalesced")
+            names = sorted(set(selector['event'] for selector in v))
+            if names:
+                conditions.append("%s.indexOf(e.name) >= 0" % json.dumps(names))
+        elif not isinstance(v, six.string_types):
+            raise JQLSyntaxError("Queries with parameterized dates cannot be coalesced")
+        elif utc_offset is None:
+            continue
+        elif k == 'from_date':
+            conditions.append("e.time >= %d" % _day_start(v, utc_offset))
+        else:
+            conditions.append("e.time < %d" % (_day_start(v, utc_offset) + 86400000))
+    return " && ".join(conditions) or "true"
+
+
+class CoalescedQuery(object):
+    """
+    A family of queries, identical but for the events and dates they
+    select, answered by a single query over the union of their events.
+    The results are tagged with the queries they belong to and split back
+    out as they arrive.
+    """
+
+    def __init__(self, queries, utc_offset=None):
+        """
+        :param queries: The `JQL` queries to coalesce. Each must select
+                        events (by name only) and end with the first
+                        `group_by` or `group_by_user` of its pipeline.
+        :param utc_offset: How far the project's timezone is ahead of UTC,
+                           as a `timedelta` (e.g. `timedelta(hours=-8)`),
+                           which Mixpanel's dates are in. Required to
+                           coalesce queries over different dates, and must
+                           hold across all of them (so not across a change
+                           to or from daylight saving time).
+        """
+        self.queries = tuple(queries)
+        if not self.queries:
+            raise JQLSyntaxError("No queries to coalesce")
+        if utc_offset is not None and not isinstance(utc_offset, timedelta):
+            raise JQLSyntaxError("utc_offset in coalesce must be a timedelta")
+        first = self.queries[0]
+        for q in self.queries:
+            if q.events is None or q.people is not None:
+                raise JQLSyntaxError("Only queries over events alone can be coalesced")
+            if (q.api_secret, q.preamble, q.bindings, [str(op) for op in q.operations]) != (
+                    first.api_secret, first.preamble, first.bindings,
+                    [str(op) for op in first.operations]):
+                raise JQLSyntaxError(
+                    "Coalesced queries may only differ in the events and dates they select")
+        reshaping = [op for op in first.operations if op.name in _Operation.RESHAPING]
+        if not reshaping or reshaping[0] is not first.operations[-1] \
+                or reshaping[0].name not in ('groupBy', 'groupByUser'):
+            raise JQLSyntaxError(
+                "Coalesced queries must end with their first group_by or group_by_user")
+
+        dates = set((q.events.params.get('from_date'), q.events.params.get('to_date'))
+                    for q in self.queries)
+        if len(dates) > 1 and utc_offset is None:
+            raise JQLSyntaxError(
+                "Queries over different dates can only be coalesced given the project's "
+                "utc_offset")
+
+        group = first.operations[-1]
+        # Grouping by user puts the distinct_id ahead of the tag.
+        self._tag_position = int(group.name == 'groupByUser')
+        tag = str(Converter.multiple_keys(raw(
+            "function(e){var t = []; %s return t;}"
+            % " ".join("if (%s) t.push(%d);" % (_event_filter(q.events.params, utc_offset), i)
+                       for i, q in enumerate(self.queries)))))
+        meta = dict(group.meta, key_size=group.meta['key_size'] + 1)
+
+        self.query = first._clone()
+        self.query.events = Events(self._envelope())
+        self.query.source = str(self.query.events)
+        self.query.operations = first.operations[:-1] + (_Operation(
+            group.name, [tag] + list(group.args[0]), *group.args[1:], **meta),)
+
+    def _envelope(self):
+        """
+        The params of an `Events` covering the events of every query.
+        """
+        params = {}
+        selectors = collections.OrderedDict()
+        for q in self.queries:
+            p = q.events.params
+            if 'event_selectors' not in p:
+                selectors = None
+            elif selectors is not None:
+                for selector in p['event_selectors']:
+                    selectors.setdefault(selector['event'], {'event': selector['event']})
+        if selectors:
+            params['event_selectors'] = list(selectors.values())
+        for k, pick in (('from_date', min), ('to_date', max)):
+            dates = [q.events.params.get(k) for q in self.queries]
+            if None not in dates:
+                params[k] = pick(dates)
+        return params
+
+    def send(self):
+        """
+        Sends the coalesced query.
+
+        :return: An iterator over the rows of each of the original queries,
+                 in order. Rows are buffered for any iterator falling behind
+                 the others.
+        """
+        splitter = _Splitter(self.query.send(), len(self.queries), self._tag_position)
+        return [splitter.rows(i) for i in range(len(self.queries))]
+
+
+class _Splitter(object):
+
+    def __init__(self, rows, count, position):
+        self.source = rows
+        self.position = position
+        self.buffers = [collections.deque() for _ in range(count)]
+        self.done = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    def rows(self, i):
+        buffer = self.buffers[i]
+        while True:
+            with self.lock:
+                while not buffer and not self.done:
+                    try:
+                        row = next(self.source, _END)
+                    except Exception as e:
+                        # Raised to every query, once it has had its rows.
+                        self.error = e
+                        self.done = True
+                        break
+                    if row is _END:
+                        self.done = True
+                        break
+                    key = row['key']
+                    tag = key[self.position]
+                    row = dict(row, key=key[:self.position] + key[self.position + 1:])
+                    self.buffers[tag].append(row)
+                if not buffer:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                row = buffer.popleft()
+            yield row
+
+
+def coalesce(queries, utc_offset=None):
+    """
+    Coalesces queries differing only in the events and dates they select
+    into a single query (see `CoalescedQuery`).
+    """
+    return CoalescedQuery(queries, utc_offset)
@@ -0,0 +1,321 @@
+"""
+Results read into typed columns, following a schema given up front.
+"""
+
+from __future__ import absolute_import
+
+import array
+import collections
+from decimal import Decimal
+from functools import partial
+
+import six
+
+from .exceptions import JQLSyntaxError, SchemaMismatchError
+from .parsing import _INT_TYPECODE, _ChunkReader
+from .query import _name_group_values, _name_values
+
+# The array typecode each type is stored with. Strings are kept in lists.
+_TYPECODES = {int: _INT_TYPECODE, float: 'd', bool: 'b'}
+# The range of values the int typecode holds.
+_INT_LIMIT = 2 ** (8 * array.array(_INT_TYPECODE).itemsize - 1)
+_NUMBERS = six.integer_types + (float, Decimal)
+
+
+def _check_int(value):
+    # Also keeps values within the range of the array.
+    if type(value) not in six.integer_types or not -_INT_LIMIT <= value < _INT_LIMIT:
+        raise TypeError
+    return value
+
+
+def _check_float(value):
+    if not isinstance(value, _NUMBERS) or isinstance(value, bool):
+        raise TypeError
+    return float(value)
+
+
+def _check_bool(value):
+    if not isinstance(value, bool):
+        raise TypeError
+    return value
+
+
+def _check_str(value):
+    if not isinstance(value, six.string_types):
+        raise TypeError
+    return value
+
+
+_CHECKS = {int: _check_int, float: _check_float, bool: _check_bool, str: _check_str}
+
+
+def _fields(schema, path=()):
+    """
+    Flattens a schema into `(path, type)` pairs, one for each column, and
+    `(path, length)` pairs, one for each list in the rows.
+    """
+    if isinstance(schema, dict):
+        fields, lengths = [], []
+        for name in schema:
+            f, l = _fields(schema[name], path + (name,))
+            fields += f
+            lengths += l
+        return fields, lengths
+    if isinstance(schema, (list, tuple)):
+        fields, lengths = [], [(path, len(schema))]
+        for i, item in enumerate(schema):
+            f, l = _fields(item, path + (i,))
+            fields += f
+            lengths += l
+        return fields, lengths
+    if schema in (six.text_type, str):
+        schema = str
+    if schema not in _CHECKS:
+        raise JQLSyntaxError(
+            "%r is not a valid schema type (valid types: int, float, bool, str)" % (schema,))
+    return [(path, schema)], []
+
+
+def _lookup(row, path):
+    for step in path:
+        row = row[step]
+    return row
+
+
+def _name(path):
+    return ".".join(str(step) for step in path) or "value"
+
+
+class _Fields(tuple):
+    """
+    The shape of an array whose items are the values of the given
+    `(name, shape)` fields, in order (e.g. of the accumulators a query
+    names).
+    """
+
+
+def _named(names, schema):
+    if not isinstance(schema, dict) or set(schema) != set(names):
+        return None
+    return _Fields((n, schema[n]) for n in names)
+
+
+def _raw_schema(schema, decoders):
+    """
+    The shape of the rows of a query as Mixpanel returns them, given the
+    shape of the rows decoded, or None if the rows must be decoded (e.g.
+    scaled up, or rebuilt from compact rows) before they can be read.
+    """
+    if not decoders:
+        return schema
+    if len(decoders) > 1 or not isinstance(decoders[0], partial):
+        return None
+    decode, names = decoders[0].func, decoders[0].args[0]
+    if decode is _name_values:
+        return _named(names, schema)
+    if decode is _name_group_values and isinstance(schema, dict) and 'value' in schema:
+        value = _named(names, schema['value'])
+        return None if value is None else dict(schema, value=value)
+    return None
+
+
+class _Mismatch(Exception):
+    """
+    Raised by a reader when the events don't match the shape at a path.
+    """
+
+
+def _skip(events, event):
+    if event not in ('start_map', 'start_array'):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if not depth:
+                return
+
+
+def _reader(schema, path, columns, string):
+    """
+    Builds a function reading a value of the given shape from ijson's
+    `basic_parse` events, from its first event on, and appending each of
+    its scalars to its column.
+    """
+    if isinstance(schema, dict):
+        fields = dict((name, _reader(schema[name], path + (name,), columns, string))
+                      for name in schema)
+
+        def read(events, event, value):
+            if event != 'start_map':
+                raise _Mismatch(path)
+            seen = set()
+            for event, value in events:
+                if event == 'end_map':
+                    break
+                read_field = fields.get(value)
+                if value in seen:
+                    raise _Mismatch(path)
+                event, field = next(events)
+                if read_field is None:
+                    # Values the schema leaves out are parsed, but not kept.
+                    _skip(events, event)
+                    continue
+                seen.add(value)
+                read_field(events, event, field)
+            if len(seen) != len(fields):
+                raise _Mismatch(path)
+        return read
+
+    if isinstance(schema, (list, tuple)):
+        items = schema if isinstance(schema, _Fields) else list(enumerate(schema))
+        readers = [_reader(item, path + (step,), columns, string) for step, item in items]
+
+        def read(events, event, value):
+            if event != 'start_array':
+                raise _Mismatch(path)
+            for read_item in readers:
+                event, value = next(events)
+                read_item(events, event, value)
+            if next(events)[0] != 'end_array':
+                raise _Mismatch(path)
+        return read
+
+    append = columns[_name(path)].append
+    if schema is int:
+        def read(events, event, value):
+            if event != 'number' or type(value) not in six.integer_types \
+                    or not -_INT_LIMIT <= value < _INT_LIMIT:
+                raise _Mismatch(path)
+            append(value)
+    elif schema is float:
+        def read(events, event, value):
+            if event != 'number':
+                raise _Mismatch(path)
+            append(float(value))
+    elif schema is bool:
+        def read(events, event, value):
+            if event != 'boolean':
+                raise _Mismatch(path)
+            append(value)
+    else:
+        def read(events, event, value):
+            if event != 'string':
+                raise _Mismatch(path)
+            append(value if string is None else string(value))
+    return read
+
+
+class Columns(collections.OrderedDict):
+    """
+    The results of a query as columns, keyed by the path to each value in
+    the rows (e.g. `"key.0"` or `"value.total"`). Integers, floats and
+    booleans are stored in `array.array`s, and strings in lists.
+    """
+
+    @property
+    def rows(self):
+        """
+        The number of rows (`len()` is the number of columns, as for any
+        dict).
+        """
+        return len(next(iter(self.values()))) if self else 0
+
+    def to_numpy(self):
+        """
+        Converts the columns to NumPy arrays (which must be installed).
+        Numeric columns aren't copied, so can't be appended to while the
+        arrays are in use.
+
+        :return: An `OrderedDict` of the arrays.
+        """
+        import numpy
+
+        arrays = collections.OrderedDict()
+        for name, column in self.items():
+            if isinstance(column, array.array):
+                converted = numpy.frombuffer(column, dtype=column.typecode)
+                arrays[name] = converted.view(numpy.bool_) if column.typecode == 'b' else converted
+            else:
+                arrays[name] = numpy.array(column, dtype=object)
+        return arrays
+
+
+def _columns(schema):
+    """
+    The empty columns of a schema, and the `(path, type)` of each.
+    """
+    fields, lengths = _fields(schema)
+    if not fields:
+        raise JQLSyntaxError("A schema requires at least one column")
+    columns = Columns()
+    for path, kind in fields:
+        columns[_name(path)] = array.array(_TYPECODES[kind]) if kind in _TYPECODES else []
+    return columns, fields, lengths
+
+
+def to_columns(rows, schema):
+    """
+    Reads rows into typed columns.
+
+    :param rows: An iterator over the rows.
+    :param schema: The shape of each row, with the type (`int`, `float`,
+                   `bool` or `str`) of each value in place of the value, e.g.
+                   `{'key': [str, str], 'value': int}`.
+    :return: The `Columns`.
+    :raises SchemaMismatchError: if a row doesn't match the schema.
+    """
+    columns, fields, lengths = _columns(schema)
+    checks = [(path, _CHECKS[kind], columns[_name(path)].append) for path, kind in fields]
+    for row in rows:
+        try:
+            for path, length in lengths:
+                value = _lookup(row, path)
+                if not isinstance(value, (list, tuple)) or len(value) != length:
+                    raise TypeError
+            # Checked in full first, so a bad row adds nothing to the columns.
+            values = [(append, check(_lookup(row, path))) for path, check, append in checks]
+        except (KeyError, IndexError, TypeError):
+            raise SchemaMismatchError("Row does not match the schema: %r" % (row,))
+        for append, value in values:
+            append(value)
+    return columns
+
+
+def read_columns(chunks, schema, raw_schema=None, interner=None):
+    """
+    Reads the elements of a top-level JSON array straight into typed
+    columns as it's parsed, from the parser's events, without building any
+    rows.
+
+    :param chunks: An iterator over the bytes of the array.
+    :param schema: The shape of each row (see `to_columns`).
+    :param raw_schema: The shape of each element as it's read, if it differs
+                       from the rows' (see `_raw_schema`).
+    :param interner: The `parsing._Interner` to share string values through.
+    :return: The `Columns`.
+    :raises SchemaMismatchError: if an element doesn't match the schema.
+    """
+    # Imported here to keep the cost of importing this library low.
+    import ijson
+
+    columns, _, _ = _columns(schema)
+    read = _reader(schema if raw_schema is None else raw_schema, (), columns,
+                   interner.value if interner is not None and interner.limit else None)
+    events = ijson.basic_parse(_ChunkReader(chunks))
+    if next(events, (None, None))[0] != 'start_array':
+        raise ValueError("Expected a JSON array")
+    row = 0
+    for event, value in events:
+        if event == 'end_array':
+            break
+        try:
+            read(events, event, value)
+        except _Mismatch as e:
+            raise SchemaMismatchError(
+                "Row %d does not match the schema at %s" % (row, _name(e.args[0])))
+        row += 1
+    return columns
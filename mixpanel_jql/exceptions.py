@@ -4,3 +4,7 @@ class JQLSyntaxError(Exception):
 
 class InvalidJavaScriptText(Exception):
     pass
+
+
+class SchemaMismatchError(Exception):
+    pass
@@ -0,0 +1,210 @@
+"""
+Running many queries, and whatever is done with their results, across a
+pool of processes.
+"""
+
+from __future__ import absolute_import
+
+import array
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from .query import _fetch
+
+# Arrays smaller than this (in bytes) are pickled rather than shared.
+SHARED_MEMORY_THRESHOLD = 2 ** 16
+
+
+def _ensure_tracker():
+    # Workers must share our resource tracker, or theirs would unlink the
+    # arrays they share when they exit.
+    if shared_memory is not None:
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+
+# Started on import, so that pools created afterwards share it too.
+_ensure_tracker()
+
+
+class _SharedArray(object):
+    """
+    An `array.array` handed back from a worker through shared memory.
+    """
+
+    __slots__ = ('name', 'typecode', 'size')
+
+    def __init__(self, name, typecode, size):
+        self.name = name
+        self.typecode = typecode
+        self.size = size
+
+    @classmethod
+    def share(cls, values):
+        data = memoryview(values).cast('B')
+        block = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            block.buf[:len(data)] = data
+            return cls(block.name, values.typecode, len(data))
+        finally:
+            # Left for the receiving process to unlink.
+            block.close()
+
+    def load(self):
+        block = shared_memory.SharedMemory(self.name)
+        try:
+            values = array.array(self.typecode)
+            view = block.buf[:self.size]
+            values.frombytes(view)
+            view.release()
+            return values
+        finally:
+            block.close()
+            block.unlink()
+
+    def discard(self):
+        block = shared_memory.SharedMemory(self.name)
+        block.close()
+        block.unlink()
+
+
+def _share(result):
+    """
+    Replaces the large arrays in a result (or in the values of a dict, or
+    items of a list or tuple, it returns) with arrays in shared memory.
+    """
+    if isinstance(result, array.array):
+        if shared_memory is None or result.itemsize * len(result) < SHARED_MEMORY_THRESHOLD:
+            return result
+        return _SharedArray.share(result)
+    if isinstance(result, dict):
+        return type(result)((k, _share(v)) for k, v in result.items())
+    if type(result) in (list, tuple):
+        return type(result)(_share(v) for v in result)
+    return result
+
+
+def _load(result):
+    if isinstance(result, _SharedArray):
+        return result.load()
+    if isinstance(result, dict):
+        return type(result)((k, _load(v)) for k, v in result.items())
+    if type(result) in (list, tuple):
+        return type(result)(_load(v) for v in result)
+    return result
+
+
+def _discard(result):
+    """
+    Frees the shared memory of a result which won't be loaded.
+    """
+    if isinstance(result, _SharedArray):
+        result.discard()
+    elif isinstance(result, dict):
+        for v in result.values():
+            _discard(v)
+    elif type(result) in (list, tuple):
+        for v in result:
+            _discard(v)
+
+
+def _run(job):
+    url, api_secret, data, decoders, transform = job
+    rows = _fetch(url, api_secret, data, decoders)
+    try:
+        return _share(transform(rows))
+    finally:
+        rows.close()
+
+
+def send_many(queries, transform=list, processes=None):
+    """
+    Sends queries from a pool of processes, each of which reads, parses and
+    transforms the results of its queries. Only the compiled queries are
+    sent to the processes, and only the transformed results sent back, so
+    CPU-heavy processing of the results runs in parallel.
+
+    Large `array.array`s returned by the transform (directly, or as the
+    values of a dict or items of a list or tuple) are handed back through
+    shared memory rather than pickled, where supported (Python 3.8+).
+
+    :param queries: The `JQL` queries to send.
+    :param transform: A picklable function (e.g. one defined at the top
+                      level of a module) taking an iterator over the rows of
+                      a query and returning a picklable result. By default,
+                      the rows are returned as a list.
+    :param processes: The number of processes to send the queries from (by
+                      default, one for each CPU up to one for each query),
+                      or a `multiprocessing.pool.Pool` to send them from. A
+                      pool given must be created after importing this module,
+                      so its processes share the tracker of shared memory
+                      started on import (which would otherwise free shared
+                      arrays as soon as the process sharing them exits).
+    :return: An iterator over the results of each query, in order. Results
+             not yet read when the iterator is closed are discarded.
+    """
+    # Compiled up front, so errors in the queries are raised here.
+    jobs = [query._request() + (transform,) for query in queries]
+    return _send_many(jobs, processes)
+
+
+class _Results(object):
+    """
+    The results of jobs sent to a pool, which are discarded if they're
+    produced after the caller has stopped reading them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.produced = {}
+        self.abandoned = False
+
+    def callback(self, i):
+        def produced(result):
+            # Called from the pool's thread handling results.
+            with self.lock:
+                if self.abandoned:
+                    _discard(result)
+                else:
+                    self.produced[i] = result
+        return produced
+
+    def take(self, i):
+        with self.lock:
+            self.produced.pop(i, None)
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            for result in self.produced.values():
+                _discard(result)
+            self.produced.clear()
+
+
+def _send_many(jobs, processes):
+    if not jobs:
+        return
+    _ensure_tracker()
+    owned = not isinstance(processes, multiprocessing.pool.Pool)
+    if owned:
+        pool = multiprocessing.Pool(processes or min(len(jobs), multiprocessing.cpu_count()))
+    else:
+        pool = processes
+    results = _Results()
+    pending = [pool.apply_async(_run, (job,), callback=results.callback(i))
+               for i, job in enumerate(jobs)]
+    try:
+        for i, result in enumerate(pending):
+            value = result.get()
+            results.take(i)
+            yield _load(value)
+    finally:
+        results.abandon()
+        if owned:
+            pool.terminate()
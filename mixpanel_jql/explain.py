@@ -0,0 +1,162 @@
+"""
+Estimates of what a query will cost before it's run in full.
+"""
+
+from __future__ import absolute_import
+
+import collections
+
+from .exceptions import JQLSyntaxError
+from .query import _Operation
+
+# Sums the number of records reaching the end of a pipeline and the size
+# of their JSON encoding.
+_PROBE = ("function(accs, items){var c = 0, b = 0, i; "
+          "for (i = 0; i < accs.length; i++) {c += accs[i][0]; b += accs[i][1];} "
+          "for (i = 0; i < items.length; i++) {c += 1; b += JSON.stringify(items[i]).length + 1;} "
+          "return [c, b];}")
+
+# Results larger than this are flagged as likely to time out or fail.
+LARGE_RESULT = 100 * 2 ** 20
+
+_AGGREGATING = ('reduce', 'groupBy', 'groupByUser')
+_SORTING = ('sortAsc', 'sortDesc')
+
+Stage = collections.namedtuple('Stage', ['operation', 'rows', 'bytes'])
+
+
+class Explanation(object):
+    """
+    The stages of a query, each with the estimated number of records (and
+    their size in bytes) it produces, along with any red flags.
+    """
+
+    def __init__(self, script, stages, warnings):
+        self.script = script
+        self.stages = stages
+        self.warnings = warnings
+
+    @property
+    def rows(self):
+        """
+        The estimated number of rows in the results (None if not probed).
+        """
+        return self.stages[-1].rows
+
+    @property
+    def bytes(self):
+        """
+        The estimated size of the results in bytes (None if not probed).
+        """
+        return self.stages[-1].bytes
+
+    def __str__(self):
+        lines = ["%-60s %14s %14s" % ('Stage', 'Rows', 'Bytes')]
+        for stage in self.stages:
+            operation = stage.operation
+            if len(operation) > 60:
+                operation = operation[:57] + '...'
+            lines.append("%-60s %14s %14s" % (
+                operation,
+                '?' if stage.rows is None else stage.rows,
+                '?' if stage.bytes is None else _size(stage.bytes)))
+        for warning in self.warnings:
+            lines.append("Warning: %s" % warning)
+        return "\n".join(lines)
+
+
+def _size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return ("%d %s" if unit == 'B' else "%.1f %s") % (n, unit)
+        n /= 1024.0
+
+
+def _red_flags(query):
+    """
+    Flags parts of a query's pipeline known to be slow or wasteful.
+    """
+    flags = []
+    operations = query.operations
+    for i, op in enumerate(operations, 1):
+        later = operations[i:]
+        if op.name == 'groupByUser':
+            for j, after in enumerate(later, i + 1):
+                if after.name in _AGGREGATING and after.name != 'groupByUser':
+                    break
+                if after.name in _SORTING:
+                    flags.append(
+                        "Stage %d sorts the output of group_by_user (stage %d), which has a "
+                        "row for every user; aggregate it further or sort client side" % (j, i))
+                    break
+        if op.name in _SORTING:
+            for after in later:
+                if after.name in _Operation.RESHAPING:
+                    if after.name in _AGGREGATING:
+                        flags.append(
+                            "Stage %d sorts records which are then aggregated, "
+                            "so the order is lost" % i)
+                    break
+        if op.name in ('groupBy', 'groupByUser') and 'new Date(' in str(op):
+            flags.append(
+                "Stage %d builds keys with new Date(...) for every record; "
+                "Converter.time_bucket(...) is much faster" % i)
+    if not any(op.name in _AGGREGATING for op in operations):
+        flags.append("The query is never aggregated, so every matching record is returned")
+    return flags
+
+
+def _probe(query, operations, fraction, seed):
+    """
+    Counts the records coming out of the given operations of a query, and
+    the size of their JSON encoding, over a sample of users.
+    """
+    probe = query._clone()
+    probe.operations = operations
+    scale = 1.0
+    if query.sampling is None and fraction < 1:
+        probe = probe.sample(fraction, seed)
+        scale /= fraction
+    # The probe is scaled up here, rather than by send().
+    rows = list(probe._append(_Operation('reduce', _PROBE, unscaled=True)).send())
+    count, size = rows[0] if rows else (0, 0)
+    return int(round(int(count) * scale)), int(round(int(size) * scale))
+
+
+def explain(query, probe=True, fraction=0.01, seed=0):
+    """
+    Estimates, stage by stage, the number of records a query produces and
+    their size in bytes. Estimates come from probe queries (one for each
+    stage) counting what a stage produces for a sample of users, scaled up.
+    Estimates for stages grouping by anything other than users scale the
+    number of groups too, and so are upper bounds.
+
+    Queries which are already sampled are probed over their own sample, and
+    their estimates aren't scaled.
+
+    :param query: The `JQL` query to explain.
+    :param probe: Whether to run probe queries. Without them, only red
+                  flags are reported.
+    :param fraction: The fraction of users each probe query considers.
+    :param seed: Picks a different sample of users for each value.
+    :return: An `Explanation`.
+    """
+    if not 0 < fraction <= 1:
+        raise JQLSyntaxError("fraction in explain must be above 0 and at most 1")
+    operations = query.operations
+    # A query's own sampling can't be probed apart from its data source.
+    first = 0 if query.sampling is None else 1
+    labels = [query.source] + [".%s" % op for op in operations]
+    stages = []
+    for i in range(first, len(operations) + 1):
+        rows = size = None
+        if probe:
+            rows, size = _probe(query, operations[:i], fraction, seed)
+        stages.append(Stage(labels[i], rows, size))
+
+    warnings = _red_flags(query)
+    if probe and stages[-1].bytes > LARGE_RESULT:
+        warnings.append(
+            "The results are estimated at %s, and may time out or fail"
+            % _size(stages[-1].bytes))
+    return Explanation(query._compile(), stages, warnings)
@@ -0,0 +1,342 @@
+"""
+Lightweight tools for shrinking and formatting the JavaScript generated
+for JQL queries. Both work off a small tokenizer, which is far cheaper
+than a full parser and sufficient for the scripts this library builds.
+"""
+
+from __future__ import absolute_import
+
+import re
+
+_WORD = 'word'
+_STRING = 'string'
+_REGEX = 'regex'
+_PUNCTUATOR = 'punctuator'
+_COMMENT = 'comment'
+
+_PUNCTUATORS = sorted([
+    '>>>=', '...', '===', '!==', '**=', '<<=', '>>=', '>>>', '=>', '==', '!=',
+    '<=', '>=', '&&', '||', '??', '?.', '++', '--', '+=', '-=', '*=', '/=',
+    '%=', '&=', '|=', '^=', '<<', '>>', '**', '{', '}', '(', ')', '[', ']',
+    ';', ',', '<', '>', '+', '-', '*', '/', '%', '&', '|', '^', '!', '~',
+    '?', ':', '=', '.', '@', '#'
+], key=len, reverse=True)
+
+_NUMBER = re.compile(
+    r'(?:0[xXbBoO][\da-fA-F_]+|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][+-]?\d+)?)n?')
+_IDENTIFIER = re.compile(r'[\w$\\]+', re.UNICODE)
+_WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+# Keywords after which a `/` starts a regular expression rather than a division.
+_KEYWORDS_BEFORE_EXPRESSION = (
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+    'throw', 'case', 'do', 'else', 'yield', 'await')
+
+# Keywords which may not be followed by a line break without ending the statement.
+_RESTRICTED_KEYWORDS = ('return', 'break', 'continue', 'throw', 'yield')
+
+
+class _Token(object):
+
+    __slots__ = ('kind', 'text', 'newline_before', 'space_before')
+
+    def __init__(self, kind, text, newline_before, space_before):
+        self.kind = kind
+        self.text = text
+        self.newline_before = newline_before
+        self.space_before = space_before
+
+
+def _scan_quoted(script, start):
+    quote = script[start]
+    i = start + 1
+    while i < len(script):
+        c = script[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == quote:
+            return i
+    raise ValueError("Unterminated string starting at offset %d" % start)
+
+
+def _scan_regex(script, start):
+    i = start + 1
+    in_class = False
+    while i < len(script):
+        c = script[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            match = _IDENTIFIER.match(script, i)
+            return match.end() if match else i
+        elif c == '\n':
+            break
+    raise ValueError("Unterminated regular expression starting at offset %d" % start)
+
+
+def _regex_allowed(previous):
+    if previous is None:
+        return True
+    if previous.kind == _PUNCTUATOR:
+        return previous.text not in (')', ']', '}')
+    return previous.kind == _WORD and previous.text in _KEYWORDS_BEFORE_EXPRESSION
+
+
+def _tokenize(script):
+    """
+    Splits JavaScript into tokens, noting the whitespace preceding each.
+    Comments are yielded as tokens of their own.
+    """
+    i = 0
+    newline = space = False
+    previous = None
+    while i < len(script):
+        c = script[i]
+        match = _WHITESPACE.match(script, i)
+        if match:
+            newline = newline or '\n' in match.group() or '\r' in match.group()
+            space = True
+            i = match.end()
+            continue
+        if script.startswith('//', i):
+            end = script.find('\n', i)
+            end = len(script) if end == -1 else end
+            kind = _COMMENT
+        elif script.startswith('/*', i):
+            end = script.find('*/', i + 2)
+            if end == -1:
+                raise ValueError("Unterminated comment starting at offset %d" % i)
+            end += 2
+            kind = _COMMENT
+        elif c in '"\'`':
+            end = _scan_quoted(script, i)
+            kind = _STRING
+        elif c == '/' and _regex_allowed(previous):
+            end = _scan_regex(script, i)
+            kind = _REGEX
+        else:
+            match = _NUMBER.match(script, i) or _IDENTIFIER.match(script, i)
+            if match:
+                end = match.end()
+                kind = _WORD
+            else:
+                for p in _PUNCTUATORS:
+                    if script.startswith(p, i):
+                        end = i + len(p)
+                        break
+                else:
+                    end = i + 1
+                kind = _PUNCTUATOR
+        token = _Token(kind, script[i:end], newline, space)
+        yield token
+        if kind == _COMMENT:
+            # A comment separates its neighbours just like whitespace does.
+            newline = newline or token.text.startswith('//') or '\n' in token.text
+            space = True
+        else:
+            previous = token
+            newline = space = False
+        i = end
+
+
+def _is_word_char(c):
+    return c.isalnum() or c in '_$\\' or ord(c) > 127
+
+
+def _needs_space(left, right):
+    a, b = left.text[-1], right.text[0]
+    if _is_word_char(a) and _is_word_char(b):
+        return True
+    if a in '+-' and b == a:
+        return True
+    if a == '/' and b in '/*':
+        return True
+    # A number followed by a property access (e.g. `1 .toFixed()`).
+    return left.kind == _WORD and left.text[0].isdigit() and b == '.'
+
+
+def _asi_sensitive(left, right):
+    """
+    Whether removing a line break between two tokens could change the
+    meaning of the script through automatic semicolon insertion.
+    """
+    if left.kind == _WORD and left.text in _RESTRICTED_KEYWORDS:
+        return True
+    if right.text in ('++', '--'):
+        return True
+    ends_statement = left.kind != _PUNCTUATOR or left.text in (')', ']', '}', '++', '--')
+    starts_statement = right.kind in (_WORD, _STRING, _REGEX) or right.text in ('{', '!', '~')
+    return ends_statement and starts_statement
+
+
+def minify(script):
+    """
+    Strips comments and any whitespace that isn't needed to keep a
+    script's meaning, including line breaks that automatic semicolon
+    insertion would otherwise depend on.
+
+    :param script: The JavaScript to minify.
+    :return: The minified JavaScript.
+    """
+    out = []
+    previous = None
+    for token in _tokenize(script):
+        if token.kind == _COMMENT:
+            continue
+        if previous is not None and token.space_before:
+            if token.newline_before and (
+                    _asi_sensitive(previous, token) or _needs_space(previous, token)):
+                out.append('\n')
+            elif _needs_space(previous, token):
+                out.append(' ')
+        out.append(token.text)
+        previous = token
+    return ''.join(out)
+
+
+_SPACED_OPERATORS = (
+    '=', '==', '===', '!=', '!==', '<', '>', '<=', '>=', '+', '-', '*', '/', '%',
+    '**', '&&', '||', '??', '&', '|', '^', '<<', '>>', '>>>', '+=', '-=', '*=',
+    '/=', '%=', '**=', '&=', '|=', '^=', '<<=', '>>=', '>>>=', '=>', '?')
+_SPACED_KEYWORDS = ('if', 'for', 'while', 'switch', 'catch', 'return', 'typeof')
+_CONTINUATION_KEYWORDS = ('else', 'catch', 'finally', 'while')
+
+
+class _Printer(object):
+
+    def __init__(self, indent):
+        self.indent = indent
+        self.level = 0
+        self.lines = []
+        self.line = ''
+
+    def newline(self):
+        if self.line.strip():
+            self.lines.append(self.line.rstrip())
+        self.line = self.indent * self.level
+
+    def write(self, text, space=False):
+        if space and self.line.strip() and not self.line.endswith(' '):
+            self.line += ' '
+        self.line += text
+
+    def last(self):
+        stripped = self.line.rstrip()
+        return stripped[-1] if stripped.strip() else ''
+
+    def result(self):
+        self.newline()
+        return '\n'.join(self.lines)
+
+
+def beautify(script, indent='    '):
+    """
+    Formats a script for reading, placing each statement and object
+    property on its own line. Comments are kept.
+
+    :param script: The JavaScript to format.
+    :param indent: The text used for each level of indentation.
+    :return: The formatted JavaScript.
+    """
+    tokens = list(_tokenize(script))
+    printer = _Printer(indent)
+    brackets = []
+    # Open ternaries at each level of brackets.
+    ternaries = [0]
+    previous = None
+
+    for i, token in enumerate(tokens):
+        text = token.text
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        top = brackets[-1] if brackets else None
+        last = printer.last()
+
+        if token.kind == _COMMENT:
+            printer.write(text, space=True)
+            if text.startswith('//') or following is not None and following.newline_before:
+                printer.newline()
+            continue
+
+        if (token.newline_before and previous is not None and top in ('{', None)
+                and _asi_sensitive(previous, token)):
+            # Keep line breaks that automatic semicolon insertion relies on.
+            printer.newline()
+            last = printer.last()
+
+        if token.kind != _PUNCTUATOR:
+            printer.write(text, space=_is_word_char(last) or last in ')]}"\'`')
+        elif text == '{':
+            if following is not None and following.text == '}':
+                printer.write('{', space=last not in '([!')
+            else:
+                printer.write('{', space=last not in '([!')
+                brackets.append('{')
+                ternaries.append(0)
+                printer.level += 1
+                printer.newline()
+        elif text == '}':
+            if previous is not None and previous.text == '{':
+                printer.write('}')
+            else:
+                brackets.pop()
+                ternaries.pop()
+                printer.level -= 1
+                printer.newline()
+                printer.write('}')
+            if following is not None:
+                if following.text in _CONTINUATION_KEYWORDS:
+                    printer.write('')
+                elif following.text not in (')', ']', ',', ';', '.', '('):
+                    printer.newline()
+        elif text in ('(', '['):
+            printer.write(text, space=(
+                previous is not None and previous.text in _SPACED_KEYWORDS))
+            brackets.append(text)
+            ternaries.append(0)
+        elif text in (')', ']'):
+            if brackets:
+                brackets.pop()
+                ternaries.pop()
+            printer.write(text)
+        elif text == ';':
+            printer.write(';')
+            if top == '(':
+                printer.write(' ')
+            else:
+                printer.newline()
+        elif text == ',':
+            printer.write(',')
+            if top == '{':
+                printer.newline()
+            else:
+                printer.write(' ')
+        elif text == ':':
+            if ternaries[-1]:
+                ternaries[-1] -= 1
+                printer.write(': ', space=True)
+            else:
+                printer.write(': ')
+        elif text == '?':
+            ternaries[-1] += 1
+            printer.write('? ', space=True)
+        elif text in ('+', '-') and (
+                previous is None or previous.kind == _PUNCTUATOR
+                and previous.text not in (')', ']', '}')
+                or previous.kind == _WORD and previous.text in _KEYWORDS_BEFORE_EXPRESSION):
+            # Unary plus and minus.
+            printer.write(text, space=last not in '([!~')
+        elif text in _SPACED_OPERATORS:
+            printer.write(text + ' ', space=True)
+        else:
+            printer.write(text)
+        previous = token
+
+    return printer.result()
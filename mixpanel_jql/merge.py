@@ -0,0 +1,359 @@
+"""
+Merging of sorted rows, sorting of rows too many to sort in memory, and
+combining of grouped results with more keys than fit in memory.
+"""
+
+from __future__ import absolute_import
+
+from decimal import Decimal
+import heapq
+from itertools import islice
+import json
+from operator import itemgetter
+import pickle
+import tempfile
+
+import six
+
+from .query import GroupRow, Reducer
+from .sketches import HyperLogLog, TDigest
+
+_END = object()
+
+_NUMBERS = six.integer_types + (float, Decimal)
+
+# How many rows of a run are pickled (and read back) at a time.
+_BLOCK_SIZE = 1000
+
+
+class _Reversed(object):
+    """
+    A sort key ordering values in reverse.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def merge_sorted(iterables, key=None, reverse=False):
+    """
+    Merges iterables, each already sorted, into a single sorted iterator,
+    reading from each only as far as needed. Rows that compare equal are
+    yielded in the order of the iterables they come from.
+
+    Closing the returned iterator closes any of the iterables not yet
+    exhausted.
+
+    :param iterables: The sorted iterables.
+    :param key: A function computing the value each row is sorted by. By
+                default, the rows themselves are compared.
+    :param reverse: Whether the iterables are sorted in descending order.
+    :return: An iterator over the rows.
+    """
+    return _merge_sorted([iter(i) for i in iterables], key, reverse)
+
+
+def _merge_sorted(iterators, key, reverse):
+    def sort_key(row):
+        value = row if key is None else key(row)
+        return _Reversed(value) if reverse else value
+
+    try:
+        # Ties are broken by the index of the iterator, so rows themselves
+        # are never compared (unless they are their own keys).
+        heap = []
+        for i, iterator in enumerate(iterators):
+            row = next(iterator, _END)
+            if row is not _END:
+                heap.append([sort_key(row), i, row])
+        heapq.heapify(heap)
+        while heap:
+            entry = heap[0]
+            yield entry[2]
+            row = next(iterators[entry[1]], _END)
+            if row is _END:
+                heapq.heappop(heap)
+            else:
+                entry[0], entry[2] = sort_key(row), row
+                heapq.heapreplace(heap, entry)
+    finally:
+        for iterator in iterators:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+
+def external_sort(rows, key=None, reverse=False, run_size=100000, tmpdir=None):
+    """
+    Sorts rows without holding them all in memory at once. Runs of
+    `run_size` rows are sorted in memory and written to a temporary file,
+    then the runs are merged back in order. Rows which fit in a single run
+    never touch the disk. The sort is stable.
+
+    :param rows: An iterable of (picklable) rows.
+    :param key: A function computing the value each row is sorted by.
+    :param reverse: Whether to sort in descending order.
+    :param run_size: How many rows to sort in memory at a time.
+    :param tmpdir: The directory to write the temporary file in.
+    :return: An iterator over the sorted rows.
+    """
+    if not isinstance(run_size, int) or isinstance(run_size, bool) or run_size < 1:
+        raise ValueError("run_size must be a positive integer")
+    return _external_sort(iter(rows), key, reverse, run_size, tmpdir)
+
+
+def _write_run(spill, run):
+    """
+    Appends a sorted run to the spill file.
+
+    :return: The offsets of the blocks of the run.
+    """
+    offsets = []
+    spill.seek(0, 2)
+    for start in range(0, len(run), _BLOCK_SIZE):
+        offsets.append(spill.tell())
+        pickle.dump(run[start:start + _BLOCK_SIZE], spill, pickle.HIGHEST_PROTOCOL)
+    return offsets
+
+
+def _read_run(spill, offsets):
+    for offset in offsets:
+        # Runs are read in turn, so each block is read from where it is.
+        spill.seek(offset)
+        for row in pickle.load(spill):
+            yield row
+
+
+def _external_sort(rows, key, reverse, run_size, tmpdir):
+    run = sorted(islice(rows, run_size), key=key, reverse=reverse)
+    if len(run) < run_size:
+        for row in run:
+            yield row
+        return
+    with tempfile.TemporaryFile(prefix='mixpanel-jql-', dir=tmpdir) as spill:
+        runs = []
+        while run:
+            runs.append(_write_run(spill, run))
+            run = sorted(islice(rows, run_size), key=key, reverse=reverse)
+        for row in merge_sorted([_read_run(spill, offsets) for offsets in runs], key, reverse):
+            yield row
+
+
+def _add(a, b):
+    # Results from send() hold Decimals, whereas results loaded back with
+    # `json` hold floats, which can't be added to them.
+    if isinstance(a, Decimal) and isinstance(b, float):
+        b = Decimal(repr(b))
+    elif isinstance(a, float) and isinstance(b, Decimal):
+        a = Decimal(repr(a))
+    return a + b
+
+
+def _merge_objects(a, b):
+    # Like Mixpanel's object_merge, numbers found in both are summed.
+    merged = dict(a)
+    for k, v in b.items():
+        if k not in merged:
+            merged[k] = v
+        elif isinstance(v, dict) and isinstance(merged[k], dict):
+            merged[k] = _merge_objects(merged[k], v)
+        elif _is_number(v) and _is_number(merged[k]):
+            merged[k] = _add(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+def _is_number(value):
+    return isinstance(value, _NUMBERS) and not isinstance(value, bool)
+
+
+def _merge_hll(a, b):
+    return HyperLogLog.from_sketch(a).merge(HyperLogLog.from_sketch(b)).to_sketch()
+
+
+def _merge_tdigest(a, b):
+    return TDigest.from_sketch(a).merge(TDigest.from_sketch(b)).to_sketch()
+
+
+# How to combine two values of each reducer computed over disjoint records.
+_MERGES = {
+    'count': _add,
+    'sum': _add,
+    'min': min,
+    'max': max,
+    'hll': _merge_hll,
+    'tdigest': _merge_tdigest,
+    'object_merge': _merge_objects,
+}
+
+
+def merge_function(accumulator):
+    """
+    The function combining two values computed by an accumulator (as
+    passed to `group_by`) over disjoint records, e.g. adding two counts.
+
+    :param accumulator: A `Reducer`, or a list of them, or a dict of them
+                        keyed by name.
+    :return: A function taking two values and returning their combination.
+    :raises ValueError: if values of the accumulator can't be combined (e.g.
+                        averages, without their counts).
+    """
+    if isinstance(accumulator, dict):
+        merges = dict((name, merge_function(a)) for name, a in accumulator.items())
+        return lambda a, b: dict((name, merges[name](a[name], b[name])) for name in merges)
+    if isinstance(accumulator, (list, tuple)):
+        merges = [merge_function(a) for a in accumulator]
+        return lambda a, b: [merge(x, y) for merge, x, y in zip(merges, a, b)]
+    if not isinstance(accumulator, Reducer) or accumulator.name not in _MERGES:
+        raise ValueError("Values of %r can't be merged (mergeable reducers: %s)"
+                         % (accumulator, ", ".join(sorted(_MERGES))))
+    merge = _MERGES[accumulator.name]
+
+    def merge_values(a, b):
+        # Reducers over no values return null.
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return merge(a, b)
+    return merge_values
+
+
+def _normalized(value):
+    # Numbers are compared by value, whether parsed as ints, floats or
+    # Decimals (but unlike in Python, not equal to booleans).
+    if isinstance(value, (float, Decimal)):
+        try:
+            if value == int(value):
+                return int(value)
+        except (ValueError, OverflowError):
+            pass
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalized(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _normalized(v)) for k, v in value.items())
+    return value
+
+
+def _sort_key(key):
+    # Identifies and orders keys of any (JSON) types, the same way in
+    # memory as in every partition written to disk.
+    return json.dumps(_normalized(key), sort_keys=True, default=str)
+
+
+class KeyedAggregator(object):
+    """
+    Combines grouped results computed over disjoint records (e.g. shards,
+    days or projects) into the results over all of them, keeping at most
+    `max_keys` keys in memory. Whenever more keys are seen, the keys held
+    are written, sorted, to a temporary file, and the sorted partitions are
+    merged when the results are read.
+
+    Keys are the same when their JSON is, with numbers compared by value
+    (so `1`, `1.0` and `Decimal('1')` are the same key, but `True` and `'1'`
+    are others).
+    """
+
+    def __init__(self, merge, max_keys=1000000, tmpdir=None):
+        """
+        :param merge: The function combining two values for the same key, or
+                      the accumulator of the results, to combine values as
+                      that accumulator would (see `merge_function`).
+        :param max_keys: The number of keys to keep in memory.
+        :param tmpdir: The directory to write the temporary file in.
+        """
+        if not isinstance(max_keys, int) or isinstance(max_keys, bool) or max_keys < 1:
+            raise ValueError("max_keys must be a positive integer")
+        self._merge = merge if callable(merge) else merge_function(merge)
+        self.max_keys = max_keys
+        self.tmpdir = tmpdir
+        self._table = {}
+        self._spill = None
+        self._runs = []
+
+    def add(self, key, value):
+        """
+        Combines a value into the results for a key.
+
+        :param key: The key, as a tuple or a list.
+        """
+        if isinstance(key, list):
+            key = tuple(key)
+        sort_key = _sort_key(key)
+        table = self._table
+        entry = table.get(sort_key)
+        if entry is not None:
+            entry[1] = self._merge(entry[1], value)
+            return
+        if len(table) >= self.max_keys:
+            self._flush()
+        table[sort_key] = [key, value]
+
+    def update(self, rows):
+        """
+        Combines rows of grouped results (e.g. from `send()`, as dicts or
+        `GroupRow`s) into the results.
+        """
+        for row in rows:
+            if isinstance(row, dict):
+                self.add(row['key'], row['value'])
+            else:
+                self.add(*row)
+
+    def _flush(self):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix='mixpanel-jql-', dir=self.tmpdir)
+        run = sorted(((sort_key, k, v) for sort_key, (k, v) in self._table.items()),
+                     key=itemgetter(0))
+        self._runs.append(_write_run(self._spill, run))
+        self._table.clear()
+
+    def __iter__(self):
+        """
+        Iterates over the combined results, as `GroupRow`s. Results kept
+        entirely in memory are in no particular order; otherwise, they're
+        ordered by their keys' JSON.
+        """
+        if not self._runs:
+            for key, value in list(self._table.values()):
+                yield GroupRow(key, value)
+            return
+        if self._table:
+            self._flush()
+        runs = [_read_run(self._spill, offsets) for offsets in self._runs]
+        current = None
+        for sort_key, key, value in merge_sorted(runs, key=itemgetter(0)):
+            if current is not None and current[0] == sort_key:
+                current[2] = self._merge(current[2], value)
+                continue
+            if current is not None:
+                yield GroupRow(current[1], current[2])
+            current = [sort_key, key, value]
+        if current is not None:
+            yield GroupRow(current[1], current[2])
+
+    def close(self):
+        """
+        Deletes the temporary file.
+        """
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._runs = []
+        self._table.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
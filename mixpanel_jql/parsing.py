@@ -0,0 +1,297 @@
+"""
+Parsing of large results across several processes.
+
+The top-level array of a response is split into batches of elements, and
+each batch is then parsed by a pool of processes.
+"""
+
+from __future__ import absolute_import
+
+import array
+import collections
+from decimal import Decimal
+import json
+import multiprocessing
+import multiprocessing.pool
+import re
+
+import six
+
+# Where one element may end and the next begin. Only elements which are
+# objects or arrays are split apart; arrays of other values are parsed as
+# a single batch.
+_BOUNDARY = re.compile(br'[}\]]\s*,\s*[{\[]')
+
+# The start of an object up to the end of its first key.
+_FIRST_KEY = re.compile(br'\{\s*"(?:[^"\\]|\\.)*"\s*:')
+
+# Strings (skipped over whole), brackets, and separators with the
+# whitespace following them.
+_TOKEN = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]|,\s*')
+_ARRAY_START = re.compile(br'\s*\[\s*')
+
+# The typecode of 64-bit integers (or of longs, where there's no 'q').
+try:
+    _INT_TYPECODE = array.array('q').typecode
+except ValueError:  # Python 2
+    _INT_TYPECODE = 'l'
+
+
+def _batches(chunks, batch_size):
+    """
+    Splits the elements of a top-level JSON array read in chunks into
+    batches of roughly `batch_size` bytes each.
+
+    The splitting is optimistic: rather than tokenizing the array, batches
+    end at the first place past `batch_size` that looks like the boundary
+    between two elements. A batch split anywhere else (within an element)
+    is never valid JSON, and must be joined back to the batch after it.
+
+    :return: An iterator over `(separator, batch)` pairs, where the
+             separator is the text between the batch and the one before.
+    """
+    chunks = iter(chunks)
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        if buffer.strip():
+            break
+    buffer = buffer.lstrip()
+    if not buffer.startswith(b'['):
+        raise ValueError("Expected a JSON array")
+    buffer = buffer[1:]
+
+    boundary = None
+    separator = b''
+    parts, size = [], len(buffer)
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size < batch_size:
+            continue
+        buffer += b''.join(parts)
+        parts = []
+        if boundary is None:
+            # Boundaries followed by the same first key as the first element
+            # are less likely to be within an element.
+            match = _FIRST_KEY.match(buffer.lstrip())
+            if match:
+                boundary = re.compile(br'[}\]]\s*,\s*' + re.escape(match.group()))
+            elif not buffer.lstrip().startswith(b'{') or b':' in buffer:
+                boundary = _BOUNDARY
+        start = 0
+        while len(buffer) - start >= batch_size:
+            match = (boundary or _BOUNDARY).search(buffer, start + batch_size - 1)
+            if match is None:
+                break
+            end = match.start() + 1
+            following = end + len(match.group()) - len(match.group()[1:].lstrip(b', \t\r\n')) - 1
+            yield separator, buffer[start:end]
+            separator, start = buffer[end:following], following
+        buffer = buffer[start:]
+        size = len(buffer)
+
+    buffer = (buffer + b''.join(parts)).rstrip()
+    if not buffer.endswith(b']'):
+        raise ValueError("Incomplete JSON array")
+    if buffer[:-1].strip():
+        yield separator, buffer[:-1]
+
+
+def element_offsets(data):
+    """
+    Finds the offsets of the elements of a complete top-level JSON array,
+    whatever their types.
+
+    Unlike `_batches`, the array is tokenized (though only as far as
+    strings, brackets and commas), so every element is found.
+
+    :param data: The bytes of the array (or e.g. an `mmap` of them).
+    :return: An `array.array` of offsets.
+    """
+    offsets = array.array(_INT_TYPECODE)
+    start = _ARRAY_START.match(data)
+    if start is None:
+        raise ValueError("Expected a JSON array")
+    if data[start.end():start.end() + 1] == b']':
+        return offsets
+    offsets.append(start.end())
+    depth = 0
+    for match in _TOKEN.finditer(data, start.end()):
+        token = match.group()[:1]
+        if token == b',':
+            if depth == 0:
+                offsets.append(match.end())
+        elif token in (b'[', b'{'):
+            depth += 1
+        elif token in (b']', b'}'):
+            depth -= 1
+            if depth < 0:
+                break
+    return offsets
+
+
+class _ChunkReader(object):
+    """
+    A file-like object reading from an iterator over chunks of bytes.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, n):
+        if not self.buffer:
+            self.buffer = next(self.chunks, b'')
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+
+class _Interner(object):
+    """
+    Shares a single copy of each repeated string between parsed rows.
+    Object keys are always interned, and string values only while fewer
+    than `limit` distinct values have been seen.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.keys = {}
+        self.values = {}
+
+    def key(self, key):
+        interned = self.keys.get(key)
+        if interned is None:
+            # Native strings also go in the interpreter's own table, so
+            # lookups with literal keys compare by identity.
+            interned = self.keys[key] = six.moves.intern(key) if isinstance(key, str) else key
+        return interned
+
+    def value(self, value):
+        if not self.limit:
+            return value
+        interned = self.values.get(value)
+        if interned is not None:
+            return interned
+        if len(self.values) < self.limit:
+            self.values[value] = value
+        return value
+
+
+def build_items(events, interner):
+    """
+    Builds the elements of a top-level JSON array from ijson's
+    `basic_parse` events, interning object keys and string values as their
+    events arrive, so each row is only built once.
+
+    :param events: An iterator over `(event, value)` pairs.
+    :param interner: The `_Interner` to share strings through.
+    :return: An iterator over the elements.
+    """
+    key, value = interner.key, interner.value
+    # The objects and arrays being built, and the key of the value
+    # expected next in each object.
+    containers, keys = [], []
+    events = iter(events)
+    for event, v in events:
+        if event != 'start_array':
+            raise ValueError("Expected a JSON array")
+        break
+    for event, v in events:
+        if event == 'map_key':
+            keys[-1] = key(v)
+            continue
+        if event == 'start_map' or event == 'start_array':
+            containers.append({} if event == 'start_map' else [])
+            keys.append(None)
+            continue
+        if event == 'end_map' or event == 'end_array':
+            if not containers:
+                return
+            v = containers.pop()
+            keys.pop()
+        elif event == 'string':
+            v = value(v)
+        if not containers:
+            yield v
+        elif keys[-1] is None:
+            containers[-1].append(v)
+        else:
+            containers[-1][keys[-1]] = v
+
+
+def _parse(batch):
+    # Like ijson, non-integers are parsed as Decimals.
+    return json.loads((b'[' + batch + b']').decode('utf8'), parse_float=Decimal)
+
+
+def parse_array(chunks, processes=None, batch_size=2 ** 20, window=None):
+    """
+    Iterates over the elements of a top-level JSON array, parsing batches
+    of elements in a pool of processes while the array is still being
+    read. Elements are yielded in order.
+
+    Arrays no bigger than a single batch are parsed without a pool.
+
+    :param chunks: The bytes of the array, in chunks.
+    :param processes: The number of processes to parse with (by default,
+                      one for each CPU), or a `multiprocessing.pool.Pool` to
+                      parse with.
+    :param batch_size: Roughly how many bytes of elements each process
+                       parses at a time.
+    :param window: How many batches may be parsed (or waiting to be
+                   yielded) at once. Defaults to twice the number of
+                   processes.
+    :return: An iterator over the elements.
+    """
+    owned = not isinstance(processes, multiprocessing.pool.Pool)
+    if window is None:
+        window = 2 * (processes if owned and processes else multiprocessing.cpu_count())
+    batches = _batches(chunks, batch_size)
+    first = next(batches, None)
+    if first is None:
+        return
+    second = next(batches, None)
+    if second is None:
+        for element in _parse(first[1]):
+            yield element
+        return
+
+    pool = multiprocessing.Pool(processes) if owned else processes
+    # The results of the batches being parsed, in order, along with the
+    # separator before each batch and its text.
+    pending = collections.deque()
+
+    def submit(separator, batch, first=False):
+        item = (pool.apply_async(_parse, (batch,)), separator, batch)
+        if first:
+            pending.appendleft(item)
+        else:
+            pending.append(item)
+
+    try:
+        submit(*first)
+        submit(*second)
+        while pending:
+            while batches is not None and len(pending) < max(window, 2):
+                following = next(batches, None)
+                if following is None:
+                    batches = None
+                else:
+                    submit(*following)
+            result, separator, batch = pending.popleft()
+            try:
+                elements = result.get()
+            except ValueError:
+                if not pending:
+                    raise
+                # The batch was split within an element, so join it back to
+                # the next batch and try again.
+                _, following_separator, following = pending.popleft()
+                submit(separator, batch + following_separator + following, first=True)
+                continue
+            for element in elements:
+                yield element
+    finally:
+        if owned:
+            pool.terminate()
@@ -2,22 +2,33 @@ from __future__ import absolute_import
 
 import collections
 from contextlib import closing
-from datetime import datetime, date
+import copy
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from functools import partial
 import json
+import re
 import warnings
 
 from itertools import chain, islice
 
-import ijson
-import jsbeautifier
-import requests
-from requests.auth import HTTPBasicAuth
 import six
 
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable
+
 from .exceptions import JQLSyntaxError, InvalidJavaScriptText
+from .javascript import beautify, minify
+from . import stream
+from .sketches import BloomFilter, HyperLogLog, TDigest, stable_hash_javascript
 
 warnings.simplefilter('default')
 
+_IDENTIFIER = re.compile(r"^[A-Za-z_$][\w$]*$")
+_PARAM_REFERENCE = re.compile(r"(?<![\w$.])params\.([A-Za-z_$][\w$]*)")
+
 
 def _decode(entity):
     """
@@ -57,6 +68,73 @@ class RawJavaScript(object):
         return "RawJavaScript('%s')" % self.java_script
 
 
+class Param(object):
+    """
+    A value left out of the script and instead bound when the query is
+    sent, through the `params` of the request (see `JQL.bind`).
+    """
+
+    def __init__(self, name):
+        if not isinstance(name, six.string_types) or not _IDENTIFIER.match(name):
+            raise JQLSyntaxError("'%s' is not a valid parameter name" % name)
+        self.name = name
+
+    def __str__(self):
+        return "params.%s" % self.name
+
+    def __repr__(self):
+        return "Param('%s')" % self.name
+
+
+def _dumps(value):
+    """
+    JSON encodes a value as a JavaScript expression, referencing any
+    `Param` within it from the request `params` rather than inlining it.
+    """
+    placeholders = {}
+
+    def _replace(v):
+        if isinstance(v, Param):
+            placeholder = "\x00%s" % v.name
+            placeholders[json.dumps(placeholder)] = str(v)
+            return placeholder
+        elif isinstance(v, dict):
+            return dict((k, _replace(e)) for k, e in v.items())
+        elif isinstance(v, (tuple, list)):
+            return [_replace(e) for e in v]
+        return v
+
+    text = json.dumps(_replace(value))
+    for placeholder, js in placeholders.items():
+        text = text.replace(placeholder, js)
+    return text
+
+
+def _param_names(value):
+    """
+    The names of every `Param` within a value, in order.
+    """
+    if isinstance(value, Param):
+        return (value.name,)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        return tuple(n for v in value for n in _param_names(v))
+    return ()
+
+
+def _referenced_params(text):
+    """
+    The names of the parameters referenced as `params.x` in JavaScript,
+    outside of string literals.
+    """
+    return tuple(_PARAM_REFERENCE.findall(_STRING_LITERAL.sub('""', text)))
+
+
+def _unique(names):
+    return tuple(collections.OrderedDict.fromkeys(names))
+
+
 class Converter(object):
 
     def __init__(self, func):
@@ -68,15 +146,63 @@ class Converter(object):
     def __repr__(self):
         return "Converter('%s')" % str(self)
 
+    # Mixpanel's built-in buckets for bucketing timestamps.
+    TIME_BUCKETS = {
+        'hour': 'mixpanel.hourly_time_buckets',
+        'day': 'mixpanel.daily_time_buckets',
+        'week': 'mixpanel.weekly_time_buckets',
+        'month': 'mixpanel.monthly_time_buckets',
+    }
+
     @staticmethod
     def to_number(accessor):
         return Converter('to_number(%s)' % _f(accessor))
 
+    @staticmethod
+    def numeric_bucket(accessor, buckets):
+        """
+        Groups by the bucket the accessor's value falls in, given either as
+        a list of bucket boundaries or as a dict with a `bucket_size` (and
+        optional `offset`).
+        """
+        if isinstance(buckets, dict):
+            if set(buckets) - {'bucket_size', 'offset'} or 'bucket_size' not in buckets:
+                raise JQLSyntaxError(
+                    'buckets in numeric_bucket as a dict must have a bucket_size '
+                    'and optionally an offset')
+        elif not isinstance(buckets, (tuple, list)):
+            raise JQLSyntaxError('buckets in numeric_bucket must be an array or dict')
+        return Converter('numeric_bucket(%s, %s)' % (_f(accessor), json.dumps(buckets)))
+
+    @staticmethod
+    def time_bucket(unit='day'):
+        """
+        Groups events by the hour, day, week or month they occurred in, using
+        Mixpanel's native bucketing. Keys are the timestamps (in milliseconds)
+        of the start of each bucket.
+
+        :param unit: One of 'hour', 'day', 'week' or 'month'.
+        """
+        if unit not in Converter.TIME_BUCKETS:
+            raise JQLSyntaxError(
+                '"%s" is not a valid time bucket unit (valid units: %s)'
+                % (unit, ', '.join(sorted(Converter.TIME_BUCKETS))))
+        return Converter('numeric_bucket("time", %s)' % Converter.TIME_BUCKETS[unit])
+
+    @staticmethod
+    def multiple_keys(accessor):
+        """
+        Groups each record under every element of the array returned by the
+        accessor, rather than under the array itself.
+        """
+        return Converter('multiple_keys(%s)' % _f(accessor))
+
 
 class Reducer(object):
 
     def __init__(self, func):
         self._func = func
+        self.name = func.split('(')[0]
 
     def __str__(self):
         return "mixpanel.reducer.%s" % self._func
@@ -158,6 +284,32 @@ class Reducer(object):
     def object_merge():
         return Reducer._r("object_merge()")
 
+    @staticmethod
+    def hll(accessor='e.distinct_id', precision=12):
+        """
+        Sketches the distinct values returned by the accessor (by default,
+        the distinct users) as a `HyperLogLog`, which can be merged with
+        others and estimates its number of distinct values client-side.
+        """
+        try:
+            return _CustomReducer('hll', HyperLogLog.javascript(_f(accessor), precision))
+        except ValueError as e:
+            raise JQLSyntaxError(str(e))
+
+    @staticmethod
+    def tdigest(accessor, compression=100):
+        """
+        Sketches the distribution of the numbers returned by the accessor
+        as a `TDigest`, which can be merged with others and estimates any
+        of its quantiles client-side.
+        """
+        if not isinstance(compression, six.integer_types + (float,)):
+            raise JQLSyntaxError('compression in tdigest must be a number')
+        try:
+            return _CustomReducer('tdigest', TDigest.javascript(_f(accessor), compression))
+        except ValueError as e:
+            raise JQLSyntaxError(str(e))
+
     @staticmethod
     def apply_group_limits(limits, global_limit):
         if not isinstance(limits, (tuple, list)):
@@ -167,13 +319,29 @@ class Reducer(object):
         return Reducer._r("applyGroupLimits(%s, %s)" % (_decode(limits), global_limit))
 
 
+class _CustomReducer(Reducer):
+    """
+    A reducer implemented in JavaScript by this library rather than
+    provided by Mixpanel.
+    """
+
+    def __init__(self, name, func):
+        super(_CustomReducer, self).__init__(func)
+        self.name = name
+
+    def __str__(self):
+        return self._func
+
+
 def _f(e):
-    if not isinstance(e, (RawJavaScript, str, six.text_type)):
+    if not isinstance(e, (RawJavaScript, Converter, str, six.text_type)):
         raise InvalidJavaScriptText(
             "Must be a text type (str, unicode) or wrapped "
             "as raw(str||unicode)")
     if isinstance(e, RawJavaScript):
         return e.java_script
+    if isinstance(e, Converter):
+        return str(e)
     return "function(e){return %s}" % e
 
 
@@ -181,6 +349,292 @@ def raw(e):
     return RawJavaScript(e)
 
 
+def param(name):
+    return Param(name)
+
+
+def _render(arg):
+    if isinstance(arg, (tuple, list)):
+        return "[%s]" % ", ".join(_render(a) for a in arg)
+    return str(arg)
+
+
+class _Operation(object):
+    """
+    A single stage of a JQL pipeline (e.g. `filter(...)`). The arguments
+    are kept unrendered alongside any metadata about the stage so the
+    pipeline can still be reasoned about after it has been built.
+    """
+
+    # Stages after which the pipeline no longer operates on the
+    # original events/people.
+    RESHAPING = ('map', 'flatten', 'reduce', 'groupBy', 'groupByUser')
+
+    def __init__(self, name, *args, **meta):
+        self.name = name
+        self.args = args
+        self.meta = meta
+
+    def __str__(self):
+        return "%s(%s)" % (self.name, ", ".join(_render(a) for a in self.args))
+
+    def __repr__(self):
+        return "_Operation('%s')" % self
+
+
+# Top level fields shared by events and people, kept by any projection.
+_RECORD_FIELDS = ('name', 'distinct_id', 'time', 'sampling_factor', 'last_seen')
+
+_PROPERTY_REFERENCE = re.compile(
+    r"""\be\.properties(?:\.([A-Za-z_$][\w$]*)|"""
+    r"""\[\s*("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')\s*\])""")
+_FIELD_REFERENCE = re.compile(r"\be\.(?:%s)\b" % "|".join(_RECORD_FIELDS))
+_FUNCTION_HEADER = re.compile(r"\bfunction\s*[\w$]*\s*\(([^)]*)\)")
+_STRING_LITERAL = re.compile(r""""(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'""")
+
+
+def _projection(properties):
+    """
+    Builds a `map` function keeping only the given properties of each
+    event (or person) along with its top level fields.
+    """
+    fields = ["%s: e.%s" % (json.dumps(f), f) for f in _RECORD_FIELDS]
+    kept = ["%s: e.properties[%s]" % (json.dumps(p), json.dumps(p)) for p in properties]
+    return "function(e){return {%s, \"properties\": {%s}}}" % (", ".join(fields), ", ".join(kept))
+
+
+def _accumulators(accumulator):
+    """
+    Prepares the accumulator(s) of a `reduce` or `group_by`. Several can
+    be given as a list or as a dict keyed by name, in which case all are
+    computed in the same pass.
+
+    :return: The accumulator(s), and the names of each (or None).
+    """
+    names = None
+    if isinstance(accumulator, dict):
+        names = list(accumulator)
+        accumulator = [accumulator[n] for n in names]
+    if isinstance(accumulator, (tuple, list)):
+        if not accumulator:
+            raise JQLSyntaxError("At least one accumulator is required")
+        return [a if isinstance(a, Reducer) else _f(a) for a in accumulator], names
+    if not isinstance(accumulator, Reducer):
+        accumulator = _f(accumulator)
+    return accumulator, names
+
+
+def _name_values(names, values):
+    return dict(zip(names, values))
+
+
+def _name_group_values(names, row):
+    if isinstance(row, tuple):
+        return row[0], _name_values(names, row[1])
+    return dict(row, value=_name_values(names, row['value']))
+
+
+def _rescale(kind, fraction, value):
+    if value is None:
+        return value
+    # Non-integers are parsed as Decimals.
+    fraction = Decimal(repr(fraction)) if isinstance(value, Decimal) else float(fraction)
+    if kind == 'count':
+        return int(round(value / fraction))
+    if kind == 'sum':
+        return value / fraction
+    return value
+
+
+def _rescale_value(kinds, names, fraction, value):
+    if not isinstance(kinds, list):
+        return _rescale(kinds, fraction, value)
+    if names:
+        return dict((n, _rescale(k, fraction, value[n])) for n, k in zip(names, kinds))
+    return [_rescale(k, fraction, v) for k, v in zip(kinds, value)]
+
+
+def _rescale_row(grouped, kinds, names, fraction, row):
+    if not grouped:
+        return _rescale_value(kinds, names, fraction, row)
+    if isinstance(row, tuple):
+        return row[0], _rescale_value(kinds, names, fraction, row[1])
+    return dict(row, value=_rescale_value(kinds, names, fraction, row['value']))
+
+
+GroupRow = collections.namedtuple('GroupRow', ['key', 'value'])
+GroupRow.__doc__ = """
+A row of grouped results, far smaller in memory than the usual dict.
+The key is a tuple, so rows can be used as (or keyed by) dict keys.
+"""
+
+
+def _group_row(row):
+    if isinstance(row, tuple):
+        return GroupRow(tuple(row[0]), row[1])
+    return GroupRow(tuple(row['key']), row['value'])
+
+
+def _rehydrate_group(size, as_tuples, row):
+    if as_tuples:
+        return tuple(row[:size]), row[size]
+    return {'key': row[:size], 'value': row[size]}
+
+
+def _rehydrate_record(properties, as_tuples, row):
+    if as_tuples:
+        return tuple(row)
+    fields = len(_RECORD_FIELDS)
+    record = dict((f, v) for f, v in zip(_RECORD_FIELDS, row) if v is not None)
+    record['properties'] = dict(
+        (p, v) for p, v in zip(properties, row[fields:]) if v is not None)
+    return record
+
+
+# Keeps the groups with the largest (numeric) values, folding the rest
+# into a sum and a count of the groups folded.
+_TOP_GROUPS = (
+    "function(accs, items){var rows = items, value = 0, truncated = 0, i; "
+    "for (i = 0; i < accs.length; i++) {rows = rows.concat(accs[i].rows); "
+    "value += accs[i].value; truncated += accs[i].truncated;} "
+    "var rank = function(r){return typeof r.value == \"number\" ? r.value : -Infinity;}; "
+    "rows.sort(function(a, b){var x = rank(a), y = rank(b); return x < y ? 1 : x > y ? -1 : 0;}); "
+    "for (i = %(limit)d; i < rows.length; i++) {"
+    "if (typeof rows[i].value == \"number\") value += rows[i].value; truncated++;} "
+    "return {rows: rows.slice(0, %(limit)d), value: value, truncated: truncated};}")
+
+_WITH_OTHER_GROUP = (
+    "function(r){return r.truncated ? r.rows.concat("
+    "[{key: [\"$other\"], value: r.value, truncated: r.truncated}]) : r.rows}")
+
+
+# Tracks, for each step of an ordered funnel, the latest time a user
+# started an attempt which reached that step within the window.
+_FUNNEL = (
+    "function(state, events){var s = state || {t: [], reached: 0}, i, j, e; "
+    "for (i = 0; i < events.length; i++) {e = events[i]; "
+    "for (j = %(size)d - 1; j >= 0; j--) {if (!%(steps)s[j](e)) continue; "
+    "if (j == 0) s.t[0] = e.time; "
+    "else if (s.t[j - 1] != null && e.time - s.t[j - 1] <= %(window)d "
+    "&& (s.t[j] == null || s.t[j] < s.t[j - 1])) s.t[j] = s.t[j - 1]; "
+    "if (s.t[j] != null && j + 1 > s.reached) s.reached = j + 1;}} "
+    "return s;}")
+
+# Tracks the last time a user did each step of an unordered funnel, and
+# the most leading steps done within the window of one another.
+_UNORDERED_FUNNEL = (
+    "function(state, events){var s = state || {t: [], reached: 0}, i, j, e, matched; "
+    "for (i = 0; i < events.length; i++) {e = events[i]; matched = false; "
+    "for (j = 0; j < %(size)d; j++) {if (%(steps)s[j](e)) {s.t[j] = e.time; matched = true;}} "
+    "if (!matched) continue; "
+    "for (j = 0; j < %(size)d && s.t[j] != null && e.time - s.t[j] <= %(window)d; j++) {} "
+    "if (j > s.reached) s.reached = j;} "
+    "return s;}")
+
+# Tracks when a user was first born, and the periods since in which they
+# returned.
+_RETENTION = (
+    "function(state, events){var s = state || {born: null, periods: []}, i, e, p; "
+    "for (i = 0; i < events.length; i++) {e = events[i]; "
+    "if (s.born == null) {if (%(steps)s[0](e)) s.born = e.time; continue;} "
+    "if (!%(steps)s[1](e)) continue; "
+    "p = Math.floor((e.time - s.born) / %(unit)d); "
+    "if (p >= 1 && p <= %(periods)d && s.periods.indexOf(p) < 0) s.periods.push(p);} "
+    "return s;}")
+
+# The length of each retention period, and the offset of the first cohort
+# from the epoch (weeks start on Mondays rather than Thursdays).
+_RETENTION_UNITS = {
+    'hour': (3600000, 0),
+    'day': (86400000, 0),
+    'week': (604800000, 345600000),
+}
+
+
+def _event_predicate(event):
+    if isinstance(event, RawJavaScript):
+        return event.java_script
+    if not isinstance(event, six.string_types):
+        raise JQLSyntaxError(
+            "Events must be given as event names or raw(...) JavaScript predicates")
+    return "function(e){return e.name == %s}" % json.dumps(event)
+
+
+def _milliseconds(window):
+    if isinstance(window, timedelta):
+        return int(window.total_seconds() * 1000)
+    if isinstance(window, (int, float)) and not isinstance(window, bool) and window > 0:
+        return int(window * 1000)
+    raise JQLSyntaxError("window must be a timedelta or a positive number of seconds")
+
+
+def _js_string(literal):
+    body = literal[1:-1]
+    if literal[0] == "'":
+        body = body.replace("\\'", "'").replace('"', '\\"')
+    return json.loads('"%s"' % body)
+
+
+def _referenced_properties(operations):
+    """
+    Finds every property of the source records referenced by the given
+    operations.
+
+    :param operations: The operations run against the source records.
+    :return: The referenced property names, in order of first reference.
+    :raises JQLSyntaxError: if a record is used in a way that prevents
+                            knowing which of its properties are needed.
+    """
+    properties = []
+
+    def _add(p):
+        if p not in properties:
+            properties.append(p)
+
+    for op in operations:
+        text = str(op)
+        for params in _FUNCTION_HEADER.findall(text):
+            if params.strip() not in ('', 'e'):
+                raise JQLSyntaxError(
+                    "Cannot infer a projection from '%s' (records must be named 'e')" % op)
+        if '=>' in text:
+            raise JQLSyntaxError(
+                "Cannot infer a projection from '%s' (arrow functions are opaque)" % op)
+        for name, quoted in _PROPERTY_REFERENCE.findall(text):
+            _add(name or _js_string(quoted))
+        for literal in _STRING_LITERAL.findall(text):
+            # String accessors (e.g. "properties.x") can select properties too.
+            value = _js_string(literal)
+            if value.startswith('properties.'):
+                _add(value[len('properties.'):])
+        remainder = _PROPERTY_REFERENCE.sub('', text)
+        remainder = _FIELD_REFERENCE.sub('', remainder)
+        remainder = _FUNCTION_HEADER.sub('', remainder)
+        remainder = _STRING_LITERAL.sub('', remainder)
+        if re.search(r"(?<![\w$.])e\b", remainder):
+            raise JQLSyntaxError(
+                "Cannot infer a projection from '%s' (the whole record is used)" % op)
+    return properties
+
+
+_SORTS = ('sortAsc', 'sortDesc')
+_SHAPE_PRESERVING = ('filter',) + _SORTS
+
+
+def _scaled_kinds(operation):
+    """
+    The names of the reducers of a stage aggregating over users, if any of
+    them are counts or sums, which are scaled up for sampled queries.
+    """
+    accumulators = operation.meta.get('accumulators')
+    if accumulators is None or operation.meta.get('per_user'):
+        # Aggregates for each user are unaffected by sampling users.
+        return None
+    several = isinstance(accumulators, list)
+    kinds = [getattr(a, 'name', None) for a in (accumulators if several else [accumulators])]
+    return kinds if set(kinds) & {'count', 'sum'} else None
+
+
 class RequestsStreamWrapper(object):
     """
     A wrapper around a requests response payload for converting
@@ -197,25 +651,78 @@ class RequestsStreamWrapper(object):
             return "".join(islice(self.data, None, n))
 
 
+def _post(url, api_secret, data):
+    # Imported here to keep the cost of importing this library low for
+    # code that only builds scripts.
+    import requests
+    from requests.auth import HTTPBasicAuth
+
+    return closing(requests.post(url,
+                                 auth=HTTPBasicAuth(api_secret, ''),
+                                 data=data,
+                                 stream=True))
+
+
+def _download(url, api_secret, data):
+    """
+    Posts a query and iterates over the raw bytes of the response, in
+    chunks.
+    """
+    with _post(url, api_secret, data) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=2 ** 16):
+            yield chunk
+
+
+def _fetch(url, api_secret, data, decoders, processes=None, interner=None):
+    """
+    Posts a query and iterates over the decoded rows of the response. Only
+    takes picklable arguments, so it can be run in other processes.
+    """
+    if processes is not None:
+        from .parsing import parse_array
+        rows = parse_array(_download(url, api_secret, data), processes)
+        for row in rows:
+            for decode in decoders:
+                row = decode(row)
+            yield row
+        return
+
+    import ijson
+    with _post(url, api_secret, data) as resp:
+        resp.raise_for_status()
+        if interner is None:
+            rows = ijson.items(RequestsStreamWrapper(resp), 'item')
+        else:
+            from .parsing import build_items
+            rows = build_items(ijson.basic_parse(RequestsStreamWrapper(resp)), interner)
+        for row in rows:
+            for decode in decoders:
+                row = decode(row)
+            yield row
+
+
 class Events(object):
 
     def __init__(self, params=None):
+        self.params = {}
         self.src = self._validate_event_params(params)
+        self.parameters = _unique(_param_names(self.params))
 
     def _validate_event_params(self, params):
         if not params:
             return "{}"
         if not isinstance(params, dict):
             raise JQLSyntaxError("event_params must be a dict")
-        params = dict(params)
+        params = self.params = dict(params)
         for k, v in params.items():
             if k in ('to_date', 'from_date'):
                 if isinstance(v, (datetime, date,)):
                     params[k] = v.strftime('%Y-%m-%d')
-                elif not isinstance(v, six.string_types):
+                elif not isinstance(v, (six.string_types, Param)):
                     raise JQLSyntaxError('to_date must be datetime, datetime.date, or str')
             elif k == 'event_selectors':
-                if not isinstance(v, collections.Iterable):
+                if not isinstance(v, Iterable):
                     raise JQLSyntaxError("event_params['event_selectors'] must be iterable")
                 for i, e in enumerate(v):
                     if not isinstance(e, dict):
@@ -225,13 +732,13 @@ class Events(object):
                             raise JQLSyntaxError(
                                 "'%s' is not a valid key in "
                                 "event_params['event_selectors'][%s]" % (ek, i))
-                        elif not isinstance(ev, six.string_types):
+                        elif not isinstance(ev, (six.string_types, Param)):
                             raise JQLSyntaxError(
                                 "event_params['event_selectors'][%s].%s "
                                 "must be a string" % (i, ek))
             else:
                 raise JQLSyntaxError('"%s" is not a valid key in event_params' % k)
-        return json.dumps(params)
+        return _dumps(params)
 
     def __str__(self):
         return "Events(%s)" % self.src
@@ -241,6 +748,7 @@ class People(object):
 
     def __init__(self, params=None):
         self.src = self._validate_people_params(params)
+        self.parameters = _unique(_param_names(params or {}))
 
     def _validate_people_params(self, params):
         if not params:
@@ -250,7 +758,7 @@ class People(object):
         for k, v in params.items():
             if k != 'user_selectors':
                 raise JQLSyntaxError('"%s" is not a valid key in people_params' % k)
-            if not isinstance(v, collections.Iterable):
+            if not isinstance(v, Iterable):
                 raise JQLSyntaxError("people_params['user_selectors'] must be iterable")
             for i, e in enumerate(v):
                 for ek, ev in e.items():
@@ -258,11 +766,11 @@ class People(object):
                         raise JQLSyntaxError(
                             "'%s' is not a valid key in "
                             "people_params['user_selectors'][%s]" % (ek, i))
-                    elif not isinstance(ev, six.string_types):
+                    elif not isinstance(ev, (six.string_types, Param)):
                         raise JQLSyntaxError(
                                 "people_params['user_selectors'][%s].%s "
                                 "must be a string" % (i, ek))
-        return json.dumps(params)
+        return _dumps(params)
 
     def __str__(self):
         return "People(%s)" % self.src
@@ -313,7 +821,16 @@ class JQL(object):
                     people = People()
 
         self.api_secret = api_secret
+        self.events = events or None
+        self.people = people or None
         self.operations = ()
+        self.preamble = ()
+        self.bindings = {}
+        self.sampling = None
+        # Shared with bound copies of the query, whose scripts are the same.
+        self._compiled = [None]
+        self._parameters = _unique(
+            getattr(self.events, 'parameters', ()) + getattr(self.people, 'parameters', ()))
         if events and people:
             self.source = (
                 "join(%s, %s, %s)" % (events, people, self._validate_join_params(join_params)))
@@ -337,7 +854,7 @@ class JQL(object):
                         % (v, ', '.join(self.VALID_JOIN_TYPES))
                     )
             elif k == 'selectors':
-                if not isinstance(v, collections.Iterable):
+                if not isinstance(v, Iterable):
                     raise JQLSyntaxError("join_params['selectors'] must be iterable")
                 for i, e in enumerate(v):
                     if not isinstance(e, dict):
@@ -356,59 +873,401 @@ class JQL(object):
         return json.dumps(params)
 
     def _clone(self):
-        jql = JQL(self.api_secret, events=Events())
-        jql.source = self.source
-        jql.operations = self.operations
+        jql = copy.copy(self)
+        jql._compiled = [None]
         return jql
 
-    def filter(self, f):
-        jql = self._clone()
-        jql.operations += ("filter(%s)" % _f(f),)
+    def bind(self, **values):
+        """
+        Binds values to the parameters (see `param`) referenced by the
+        query. Bound values are sent through the `params` of the request
+        rather than written into the script, so a query's script stays
+        the same (and is only compiled once, for all its bound copies)
+        however it is bound.
+
+        :param values: The values to bind, keyed by parameter name. Dates
+                       are formatted as `YYYY-MM-DD`.
+        """
+        bindings = dict(self.bindings)
+        for k, v in values.items():
+            if isinstance(v, (datetime, date)):
+                v = v.strftime('%Y-%m-%d')
+            try:
+                json.dumps(v)
+            except (TypeError, ValueError):
+                raise JQLSyntaxError("The value bound to '%s' is not JSON serializable" % k)
+            bindings[k] = v
+        jql = copy.copy(self)
+        jql.bindings = bindings
         return jql
 
-    def map(self, f):
+    @property
+    def parameters(self):
+        """
+        The names of all parameters referenced by the query.
+        """
+        return self._parameters
+
+    def _compile(self):
+        if self._compiled[0] is None:
+            self._compiled[0] = minify(str(self))
+        return self._compiled[0]
+
+    def _append(self, operation):
         jql = self._clone()
-        jql.operations += ("map(%s)" % _f(f),)
+        jql.operations += (operation,)
+        jql._parameters = _unique(self._parameters + _referenced_params(str(operation)))
         return jql
 
-    def flatten(self):
+    def filter(self, f):
+        return self._append(_Operation('filter', _f(f)))
+
+    def sample(self, fraction, seed=0):
+        """
+        Only considers a fraction of users, picked by a stable hash of their
+        distinct_id, for fast approximate answers. The sampling is applied
+        directly after the data source.
+
+        Counts and sums computed over users (i.e. by a final `group_by` or
+        `reduce`, optionally followed by sorts) are scaled up by `send()` to
+        estimate the full results. Queries filtering or transforming them
+        any further can't be scaled up, so can't be sent.
+
+        :param fraction: The fraction of users to keep, above 0 and up to 1.
+        :param seed: Picks a different sample of users for each value.
+        """
+        if not isinstance(fraction, (int, float)) or not 0 < fraction <= 1:
+            raise JQLSyntaxError("fraction in sample must be above 0 and at most 1")
+        if self.sampling is not None:
+            raise JQLSyntaxError("The query is already sampled")
         jql = self._clone()
-        jql.operations += ("flatten()",)
+        jql.sampling = fraction
+        jql.preamble += ("var _sample = %s;" % stable_hash_javascript(seed),)
+        jql.operations = (_Operation('filter', "function(e){return _sample(e.distinct_id) < %d}"
+                                     % int(fraction * 2 ** 32)),) + self.operations
         return jql
 
-    def sort_asc(self, accessor):
+    def shard(self, count, index, seed=0):
+        """
+        Keeps only the rows in one of `count` disjoint shards of the results,
+        picked by a stable hash of each row (or of its key, for grouped
+        results). The shard is taken just before a final sort, so each shard
+        is sorted server-side, and the shards can be merged client-side into
+        the sorted results of the whole query (see `send_sharded`).
+
+        :param count: The number of shards.
+        :param index: The shard to keep, from 0 up to `count`.
+        :param seed: Picks a different sharding of rows for each value.
+        """
+        for name, value, minimum in (('count', count, 1), ('index', index, 0)):
+            if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                raise JQLSyntaxError("%s in shard must be an integer of at least %d"
+                                     % (name, minimum))
+        if index >= count:
+            raise JQLSyntaxError("index in shard must be less than count")
+        operations = list(self.operations)
+        sort = operations.pop() if operations and operations[-1].name in _SORTS else None
+        last = operations[-1] if operations else None
+        meta = dict(last.meta) if last is not None else {}
+        name = "_shard%d" % len(self.preamble)
+        # Keys, unlike e.g. floating point sums, are the same on every run.
+        accessor = "r.key" if meta.get('grouped') else "r"
+        operations.append(_Operation(
+            'filter', "function(r){return %s(JSON.stringify(%s)) %% %d == %d}"
+            % (name, accessor, count, index), **meta))
         jql = self._clone()
-        jql.operations += ("sortAsc(%s)" % _f(accessor),)
+        jql.operations = tuple(operations) + ((sort,) if sort is not None else ())
+        jql.preamble += ("var %s = %s;" % (name, stable_hash_javascript(seed)),)
         return jql
 
-    def sort_desc(self, accessor):
-        jql = self._clone()
-        jql.operations += ("sortDesc(%s)" % _f(accessor),)
+    def filter_in(self, accessor, values, false_positive_rate=None):
+        """
+        Keeps only records for which the accessor returns one of the given
+        values. The values are sent through the request `params` and loaded
+        into a `Set` once, rather than inlined into the script.
+
+        :param accessor: The value of each record to look up.
+        :param values: The values to keep records for.
+        :param false_positive_rate: if set, sends a Bloom filter of the
+                                    (string or integer) values instead,
+                                    which is far smaller for large sets at
+                                    the cost of letting through this rate
+                                    of records with other values.
+        """
+        f = _f(accessor)
+        name = "_in%d" % len(self.preamble)
+        values = list(collections.OrderedDict.fromkeys(values))
+        if false_positive_rate is None:
+            lookup = "new Set(params.%s)" % name
+            bound = values
+        else:
+            lookup = "%s(params.%s)" % (BloomFilter.JAVASCRIPT, name)
+            bound = BloomFilter.from_values(values, false_positive_rate).to_params()
+        if isinstance(accessor, RawJavaScript):
+            value = "(%s)(e)" % f
+        else:
+            value = accessor
+        jql = self.bind(**{name: bound})._append(
+            _Operation('filter', "function(e){return %s.has(%s)}" % (name, value)))
+        jql.preamble += ("var %s = %s;" % (name, lookup),)
+        jql._parameters += (name,)
         return jql
 
+    def map(self, f):
+        return self._append(_Operation('map', _f(f)))
+
+    def flatten(self):
+        return self._append(_Operation('flatten'))
+
+    def sort_asc(self, accessor):
+        return self._append(_Operation('sortAsc', _f(accessor)))
+
+    def sort_desc(self, accessor):
+        return self._append(_Operation('sortDesc', _f(accessor)))
+
     def reduce(self, accumulator):
-        if not isinstance(accumulator, Reducer):
-            accumulator = _f(accumulator)
-        jql = self._clone()
-        jql.operations += ("reduce(%s)" % accumulator,)
-        return jql
+        accumulator, names = _accumulators(accumulator)
+        decoders = (partial(_name_values, names),) if names else ()
+        return self._append(_Operation(
+            'reduce', accumulator, accumulators=accumulator, names=names, decoders=decoders))
 
-    def group_by(self, keys, accumulator):
-        return self._group_by(False, keys, accumulator)
+    def group_by(self, keys, accumulator, max_groups=None):
+        """
+        Groups records by the given keys, aggregating each group with the
+        accumulator(s).
+
+        :param max_groups: If given, only the groups with the N largest
+                           values are returned. The rest are folded into a
+                           final row with the key `["$other"]`, whose value
+                           is the sum of their values and whose `truncated`
+                           is how many groups were folded. Requires a
+                           single accumulator.
+        """
+        return self._group_by(False, keys, accumulator, max_groups)
 
-    def group_by_user(self, keys, accumulator):
-        return self._group_by(True, keys, accumulator)
+    def group_by_user(self, keys, accumulator, max_groups=None):
+        return self._group_by(True, keys, accumulator, max_groups)
 
-    def _group_by(self, user, keys, accumulator):
+    def _group_by(self, user, keys, accumulator, max_groups=None):
         if not isinstance(keys, (tuple, set, list)):
             keys = [keys]
-        if not isinstance(accumulator, Reducer):
-            accumulator = _f(accumulator)
-        jql = self._clone()
+        accumulator, names = _accumulators(accumulator)
+        decoders = (partial(_name_group_values, names),) if names else ()
         op = "groupByUser" if user else "groupBy"
-        jql.operations += ("%s([%s], %s)" % (op, ", ".join(_f(k) for k in keys), accumulator),)
+        # Grouping by user prepends the distinct_id to each key.
+        jql = self._append(_Operation(
+            op, [_f(k) for k in keys], accumulator, key_size=len(keys) + user,
+            accumulators=accumulator, names=names, decoders=decoders,
+            grouped=True, per_user=bool(user)))
+        if max_groups is None:
+            return jql
+        if not isinstance(max_groups, int) or isinstance(max_groups, bool) or max_groups < 1:
+            raise JQLSyntaxError("max_groups must be a positive integer")
+        if isinstance(accumulator, list):
+            raise JQLSyntaxError("max_groups requires a single accumulator")
+        # The groups are disjoint, so the top groups of each batch can be
+        # merged without losing any of the overall top groups.
+        jql = jql._append(_Operation('reduce', _TOP_GROUPS % {'limit': max_groups}))
+        return jql._append(_Operation('map', _WITH_OTHER_GROUP))._append(_Operation(
+            'flatten', accumulators=accumulator, grouped=True, per_user=bool(user),
+            max_groups=max_groups))
+
+    def _by_user(self, events, reducer, **values):
+        """
+        Keeps only the given events and folds each user's events, in order,
+        with a reducer, which refers to the events' predicates as `steps`.
+        """
+        name = "_steps%d" % len(self.preamble)
+        predicates = [_event_predicate(e) for e in events]
+        jql = self._append(_Operation('filter', "function(e){return %s}" % " || ".join(
+            "%s[%d](e)" % (name, i) for i in range(len(predicates)))))
+        jql.preamble += ("var %s = [%s];" % (name, ", ".join(predicates)),)
+        values['steps'] = name
+        return jql._append(_Operation('groupByUser', reducer % values))
+
+    def funnel(self, steps, window, ordered=True):
+        """
+        Counts the users reaching each step of a funnel, in a single pass
+        over each user's events.
+
+        Each row's key is the index of a step (starting at 0), and its value
+        the number of users who reached that step.
+
+        :param steps: The events making up the funnel, as event names or
+                      raw(...) JavaScript predicates.
+        :param window: The time allowed (as a timedelta or seconds) from the
+                       first step to the last.
+        :param ordered: Whether the steps must be done in order. Otherwise,
+                        users reach a step by doing it and every step before
+                        it, in any order, within the window.
+        """
+        if not isinstance(steps, (tuple, list)) or not steps:
+            raise JQLSyntaxError("steps in funnel must be a non-empty list")
+        jql = self._by_user(
+            steps, _FUNNEL if ordered else _UNORDERED_FUNNEL,
+            size=len(steps), window=_milliseconds(window))
+        return jql.group_by(
+            [Converter.multiple_keys(raw(
+                "function(r){var k = [], j; for (j = 0; j < r.value.reached; j++) k.push(j); "
+                "return k;}"))],
+            Reducer.count())
+
+    def retention(self, born_event, return_event, unit='week', periods=8):
+        """
+        Counts the users of each cohort (the users first doing `born_event`
+        in the same period) returning in each of the periods after, in a
+        single pass over each user's events.
+
+        Each row's key is the timestamp (in milliseconds) of the start of a
+        cohort's period and the number of periods since, and its value the
+        number of users of the cohort who returned then. Period 0 counts
+        every user of the cohort.
+
+        :param born_event: The event users are born with, as an event name
+                           or raw(...) JavaScript predicate.
+        :param return_event: The event users return with.
+        :param unit: One of 'hour', 'day' or 'week'.
+        :param periods: The number of periods after being born to count.
+        """
+        if unit not in _RETENTION_UNITS:
+            raise JQLSyntaxError(
+                '"%s" is not a valid retention unit (valid units: %s)'
+                % (unit, ', '.join(sorted(_RETENTION_UNITS))))
+        if not isinstance(periods, int) or isinstance(periods, bool) or periods < 1:
+            raise JQLSyntaxError("periods in retention must be a positive integer")
+        length, offset = _RETENTION_UNITS[unit]
+        jql = self._by_user(
+            [born_event, return_event], _RETENTION, unit=length, periods=periods)
+        return jql.filter(raw("function(r){return r.value.born != null}")).group_by(
+            [raw("function(r){return Math.floor((r.value.born - %d) / %d) * %d + %d}"
+                 % (offset, length, length, offset)),
+             Converter.multiple_keys(raw("function(r){return [0].concat(r.value.periods)}"))],
+            Reducer.count())
+
+    def select(self, *properties):
+        """
+        Keeps only the given properties of each record (plus its top level
+        fields such as `name`, `distinct_id` and `time`), shrinking what
+        later stages and the response have to carry.
+
+        :param properties: The names of the properties to keep.
+        """
+        if not properties:
+            raise JQLSyntaxError("select requires at least one property")
+        for p in properties:
+            if not isinstance(p, six.string_types):
+                raise JQLSyntaxError("properties in select must be strings")
+        properties = list(collections.OrderedDict.fromkeys(properties))
+        return self._append(
+            _Operation('map', _projection(properties), properties=properties))
+
+    def project(self):
+        """
+        Inserts a projection directly after the data source keeping only
+        the properties referenced by the pipeline before it first reshapes
+        its records (i.e. up to the first `map`, `reduce`, `group_by`, etc.).
+
+        :raises JQLSyntaxError: if the pipeline never reshapes its records,
+                                joins events with people, or uses records in
+                                a way that hides which properties it reads.
+        """
+        if self.source.startswith("join("):
+            raise JQLSyntaxError("Projections over joins are not supported")
+        for i, op in enumerate(self.operations):
+            if op.name in _Operation.RESHAPING:
+                break
+        else:
+            raise JQLSyntaxError(
+                "Cannot infer a projection without a reshaping stage "
+                "(use select(...) to project raw records)")
+        properties = _referenced_properties(self.operations[:i + 1])
+        jql = self._clone()
+        jql.operations = (_Operation('map', _projection(properties)),) + self.operations
         return jql
 
+    def compact(self, as_tuples=False):
+        """
+        Has Mixpanel return each row as a flat array rather than an object,
+        sparing the response from repeating the same keys on every row. The
+        rows are rebuilt client-side by `send()`.
+
+        Only pipelines ending in a `group_by`, `group_by_user` or `select`
+        have a shape known ahead of time and can be compacted. Properties
+        that are null or missing are omitted from rebuilt records.
+
+        :param as_tuples: rebuild rows as tuples (`(key, value)` for groups,
+                          the flat array of fields for records) instead of
+                          the usual dicts.
+        """
+        last = self.operations[-1] if self.operations else None
+        if last is not None and 'max_groups' in last.meta:
+            raise JQLSyntaxError("compact() cannot be used with max_groups")
+        if last is not None and 'key_size' in last.meta:
+            size = last.meta['key_size']
+            encode = "function(r){return r.key.concat([r.value])}"
+            rehydrate = partial(_rehydrate_group, size, as_tuples)
+        elif last is not None and 'properties' in last.meta:
+            properties = last.meta['properties']
+            encode = "function(e){return [%s]}" % ", ".join(
+                ["e.%s" % f for f in _RECORD_FIELDS]
+                + ["e.properties[%s]" % json.dumps(p) for p in properties])
+            rehydrate = partial(_rehydrate_record, properties, as_tuples)
+        else:
+            raise JQLSyntaxError(
+                "compact() requires the query to end in group_by, group_by_user or select")
+        carried = dict((k, v) for k, v in last.meta.items()
+                       if k in ('accumulators', 'names', 'grouped', 'per_user'))
+        return self._append(_Operation(
+            'map', encode, decoders=(rehydrate,) + last.meta.get('decoders', ()), **carried))
+
+    def _row_decoders(self):
+        """
+        The functions applied, in order, to each row returned by `send()`.
+        """
+        operations = self.operations
+        i = len(operations) - 1
+        # Filters and sorts leave the rows of the stage before them as they are.
+        while i >= 0 and operations[i].name in _SHAPE_PRESERVING and not operations[i].meta:
+            i -= 1
+        if i < 0:
+            return ()
+        last = operations[i]
+        decoders = last.meta.get('decoders', ())
+        if self.sampling is None or last.meta.get('unscaled'):
+            return decoders
+        kinds = _scaled_kinds(last)
+        if kinds is None:
+            transformed = any(_scaled_kinds(op) is not None for op in operations[:i])
+        else:
+            # Filters run server-side against the unscaled values, whereas
+            # scaling keeps the order of sorts.
+            transformed = any(op.name == 'filter' for op in operations[i + 1:])
+        if transformed:
+            raise JQLSyntaxError(
+                "Counts and sums of a sampled query can only be scaled up when they're "
+                "the final results (followed by sorts at most)")
+        if kinds is None:
+            return decoders
+        accumulators = last.meta['accumulators']
+        return decoders + (partial(
+            _rescale_row, last.meta.get('grouped', False),
+            kinds if isinstance(accumulators, list) else kinds[0],
+            last.meta.get('names'), self.sampling),)
+
+    def explain(self, probe=True, fraction=0.01, seed=0):
+        """
+        Estimates, stage by stage, the number of records the query produces
+        and their size in bytes, and flags anything known to be slow. See
+        `mixpanel_jql.explain.explain`.
+
+        :param probe: Whether to run (cheap, sampled) probe queries for the
+                      estimates. Without them, only red flags are reported.
+        :param fraction: The fraction of users each probe query considers.
+        :param seed: Picks a different sample of users for each value.
+        """
+        from .explain import explain
+        return explain(self, probe=probe, fraction=fraction, seed=seed)
+
     def query_plan(self):
         warnings.warn(
             "JQL(...).query_plan is being deprecated in favor or str(JQL(...))",
@@ -417,18 +1276,159 @@ class JQL(object):
 
     @property
     def pretty(self):
-        return jsbeautifier.beautify(str(self))
+        return beautify(str(self))
 
     def __str__(self):
-        script = "function main() { return %s%s; }" %\
-           (self.source, "".join(".%s" % i for i in self.operations))
+        script = "function main() { %sreturn %s%s; }" %\
+           ("".join("%s " % p for p in self.preamble),
+            self.source, "".join(".%s" % i for i in self.operations))
         return script
 
-    def send(self):
-        with closing(requests.post(self.ENDPOINT % self.VERSION,
-                                   auth=HTTPBasicAuth(self.api_secret, ''),
-                                   data={'script': str(self)},
-                                   stream=True)) as resp:
-            resp.raise_for_status()
-            for row in ijson.items(RequestsStreamWrapper(resp), 'item'):
-                yield row
+    def send(self, prefetch=None, processes=None, spool=None, group_rows=False,
+             intern_strings=False, schema=None):
+        """
+        Sends the query to Mixpanel.
+
+        :param prefetch: If given, rows are read and parsed on a background
+                         thread, up to this many ahead of the caller, so a
+                         slow network and slow processing of the rows don't
+                         hold each other up.
+        :param processes: If given, rows are parsed in batches across a pool
+                          of this many processes (or in the given
+                          `multiprocessing.pool.Pool`), for results too large
+                          to parse quickly on one core. Rows keep their order.
+        :param spool: If given, the results are written to disk as they're
+                      read and returned as a `SpooledResult`, which can be
+                      iterated over again, and read in parts, without sending
+                      the query again. Either the path of the file to write,
+                      a directory to write a temporary file in, or True for a
+                      temporary file. Temporary files are deleted when the
+                      result is closed.
+        :param group_rows: Return the rows of a query ending in `group_by` or
+                           `group_by_user` as `GroupRow(key, value)` tuples,
+                           with keys as tuples, rather than as dicts.
+        :param intern_strings: Share a single copy of each object key between
+                               all the rows, as they're parsed, to save
+                               memory when many rows are kept. If a number,
+                               string values are also shared, up to that many
+                               distinct values. Can't be combined with
+                               `processes` or `spool`.
+        :param schema: If given, the rows are read into typed columns, and a
+                       `mixpanel_jql.columns.Columns` returned. The shape of
+                       each row, with the type (`int`, `float`, `bool` or
+                       `str`) of each value in place of the value, e.g.
+                       `{'key': [str, str], 'value': int}`. Rows that don't
+                       match raise a `SchemaMismatchError`. Values are read
+                       straight from the parser's events, without building
+                       the rows, except for queries whose rows must be
+                       decoded first (sampled counts and sums scaled up, or
+                       `compact()` rows rebuilt) or that are parsed across
+                       `processes`.
+        :return: An iterator over the rows of the results (or the `Columns`).
+        """
+        interner = None
+        if intern_strings is not False:
+            if processes is not None or spool is not None:
+                raise JQLSyntaxError(
+                    "intern_strings cannot be combined with processes or spool")
+            if intern_strings is not True and (
+                    not isinstance(intern_strings, int) or intern_strings < 1):
+                raise JQLSyntaxError("intern_strings in send must be True or a positive integer")
+            from .parsing import _Interner
+            interner = _Interner(0 if intern_strings is True else intern_strings)
+        if schema is not None:
+            if spool is not None or group_rows:
+                raise JQLSyntaxError("schema cannot be combined with spool or group_rows")
+            return self._send_columns(schema, prefetch, processes, intern_strings, interner)
+        request = self._request(group_rows)
+        if spool is not None:
+            if prefetch is not None or processes is not None:
+                raise JQLSyntaxError("spool cannot be combined with prefetch or processes")
+            from .spool import SpooledResult
+            url, api_secret, data, decoders = request
+            return SpooledResult(_download(url, api_secret, data), decoders, spool)
+        if prefetch is None:
+            return self._send(request, processes, interner)
+        try:
+            return stream.prefetch(self._send(request, processes, interner), prefetch)
+        except ValueError:
+            raise JQLSyntaxError("prefetch in send must be a positive integer")
+
+    def _send_columns(self, schema, prefetch, processes, intern_strings, interner):
+        """
+        Sends the query, reading the results into columns straight from the
+        parser's events where possible.
+        """
+        from .columns import _raw_schema, read_columns, to_columns
+        raw_schema = None if processes is not None else _raw_schema(schema, self._row_decoders())
+        if raw_schema is None:
+            # Rows that must be decoded first (or are parsed elsewhere) are
+            # read whole.
+            rows = self.send(prefetch, processes, intern_strings=intern_strings)
+            try:
+                return to_columns(rows, schema)
+            finally:
+                rows.close()
+        url, api_secret, data, _ = self._request()
+        chunks = _download(url, api_secret, data)
+        if prefetch is not None:
+            try:
+                chunks = stream.prefetch(chunks, prefetch)
+            except ValueError:
+                raise JQLSyntaxError("prefetch in send must be a positive integer")
+        try:
+            return read_columns(chunks, schema, raw_schema, interner)
+        finally:
+            chunks.close()
+
+    def send_sharded(self, shards, key, **kwargs):
+        """
+        Sends a query ending in `sort_asc` or `sort_desc` as several sharded
+        queries (see `shard`), each sorted server-side, and merges their
+        rows as they arrive. For results too large to sort in one query.
+
+        :param shards: The number of queries to split the query into.
+        :param key: A function computing, from each row, the value the
+                    query sorts by (e.g. `lambda row: row['value']` for
+                    `sort_desc('e.value')`), so the shards can be merged in
+                    order. Required, as the sort's accessor is JavaScript.
+        :param kwargs: Passed to `send()` for each shard. `prefetch` reads
+                       each shard on its own thread, so they download in
+                       parallel.
+        :return: An iterator over the rows of the results, in order.
+        """
+        from .merge import merge_sorted
+
+        if not self.operations or self.operations[-1].name not in _SORTS:
+            raise JQLSyntaxError("send_sharded requires the query to end in a sort")
+        if not callable(key):
+            raise JQLSyntaxError("key in send_sharded must be a function")
+        reverse = self.operations[-1].name == 'sortDesc'
+        rows = [self.shard(shards, i).send(**kwargs) for i in range(shards)]
+        return merge_sorted(rows, key=key, reverse=reverse)
+
+    def _request(self, group_rows=False):
+        """
+        The URL, API secret and form data of the request for the query, and
+        the decoders to apply to each row of the response.
+        """
+        decoders = self._row_decoders()
+        if group_rows:
+            last = self.operations[-1] if self.operations else None
+            if last is None or not last.meta.get('grouped'):
+                raise JQLSyntaxError(
+                    "group_rows requires the query to end in group_by or group_by_user")
+            if 'max_groups' in last.meta:
+                raise JQLSyntaxError("group_rows cannot be used with max_groups")
+            decoders += (_group_row,)
+        missing = [p for p in self.parameters if p not in self.bindings]
+        if missing:
+            raise JQLSyntaxError("No values bound to params: %s" % ", ".join(missing))
+        data = {'script': self._compile()}
+        if self.bindings:
+            data['params'] = json.dumps(self.bindings)
+        return self.ENDPOINT % self.VERSION, self.api_secret, data, decoders
+
+    def _send(self, request, processes=None, interner=None):
+        for row in _fetch(*request, processes=processes, interner=interner):
+            yield row
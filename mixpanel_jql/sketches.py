@@ -0,0 +1,384 @@
+"""
+Compact probabilistic data structures shared between Python and the
+JavaScript run by Mixpanel. Each hashes values exactly as its JavaScript
+counterpart does so the two sides agree.
+"""
+
+from __future__ import absolute_import, division
+
+import math
+import string
+
+import six
+
+from .exceptions import JQLSyntaxError
+
+_FNV_PRIME = 16777619
+_FNV_OFFSETS = (2166136261, 3735928559)
+
+
+def _fnv1a(value, offset):
+    """
+    32-bit FNV-1a over the UTF-16 code units of a string, matching what
+    `charCodeAt` yields in JavaScript.
+    """
+    h = offset
+    data = value.encode('utf-16-le')
+    for i in range(0, len(data), 2):
+        h = ((h ^ (six.indexbytes(data, i) | six.indexbytes(data, i + 1) << 8))
+             * _FNV_PRIME) & 0xFFFFFFFF
+    return h
+
+
+def _text(value):
+    # Mirrors `String(value)` for the types whose representations agree.
+    if isinstance(value, bool) or not isinstance(value, six.string_types + six.integer_types):
+        raise JQLSyntaxError("Only strings and integers can be hashed, not %r" % (value,))
+    return six.text_type(value)
+
+
+class BloomFilter(object):
+    """
+    A set membership test which may report false positives but never
+    false negatives, taking up a fraction of the space of its values.
+    """
+
+    # Bits are packed 6 to a character of this alphabet.
+    ALPHABET = string.ascii_uppercase + string.ascii_lowercase + string.digits + '+/'
+
+    # Builds an object with a `has(value)` method from the parameters
+    # produced by `BloomFilter.to_params()`.
+    JAVASCRIPT = (
+        "(function(f){"
+        "var d=%s,a=[],i;"
+        "for(i=0;i<f.bits.length;i++)a.push(d.indexOf(f.bits.charAt(i)));"
+        "return {has:function(v){"
+        "v=String(v);var h1=%d,h2=%d,c,i,j;"
+        "for(i=0;i<v.length;i++){c=v.charCodeAt(i);"
+        "h1=Math.imul(h1^c,%d)>>>0;h2=Math.imul(h2^c,%d)>>>0;}"
+        "h2=(h2|1)>>>0;"
+        "for(i=0;i<f.k;i++){j=(h1+i*h2)%%f.m;"
+        "if(!((a[Math.floor(j/6)]>>(j%%6))&1))return false;}"
+        "return true;}};})"
+    ) % ('"%s"' % ALPHABET, _FNV_OFFSETS[0], _FNV_OFFSETS[1], _FNV_PRIME, _FNV_PRIME)
+
+    def __init__(self, size, hashes, bits=None):
+        """
+        :param size: The number of bits in the filter.
+        :param hashes: The number of bits set for each value.
+        :param bits: The encoded bits of an existing filter.
+        """
+        self.size = size
+        self.hashes = hashes
+        self._digits = bytearray((size + 5) // 6)
+        if bits is not None:
+            for i, c in enumerate(bits):
+                self._digits[i] = self.ALPHABET.index(c)
+
+    @classmethod
+    def from_values(cls, values, false_positive_rate):
+        """
+        Builds a filter sized to hold the given values with (at most)
+        the given rate of false positives.
+        """
+        if not 0 < false_positive_rate < 1:
+            raise JQLSyntaxError("false_positive_rate must be between 0 and 1")
+        values = list(values)
+        n = max(len(values), 1)
+        size = max(int(math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)), 6)
+        bloom = cls(size, max(int(round(size / n * math.log(2))), 1))
+        for v in values:
+            bloom.add(v)
+        return bloom
+
+    def _positions(self, value):
+        text = _text(value)
+        h1 = _fnv1a(text, _FNV_OFFSETS[0])
+        h2 = _fnv1a(text, _FNV_OFFSETS[1]) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for j in self._positions(value):
+            self._digits[j // 6] |= 1 << (j % 6)
+
+    def __contains__(self, value):
+        return all(self._digits[j // 6] >> (j % 6) & 1 for j in self._positions(value))
+
+    def to_params(self):
+        """
+        The filter as a JSON serializable dict, for use with `JAVASCRIPT`.
+        """
+        return {
+            'm': self.size,
+            'k': self.hashes,
+            'bits': ''.join(self.ALPHABET[d] for d in self._digits),
+        }
+
+
+def _mix(h):
+    # MurmurHash3's finalizer, spreading FNV-1a's bits across the whole hash.
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xFFFFFFFF
+    return h ^ h >> 16
+
+
+def stable_hash(value, seed=''):
+    """
+    A well mixed 32-bit hash of `seed` followed by a string or integer,
+    identical to the one computed by `stable_hash_javascript(seed)`.
+    """
+    return _mix(_fnv1a(six.text_type(seed) + _text(value), _FNV_OFFSETS[0]))
+
+
+def stable_hash_javascript(seed=''):
+    """
+    A JavaScript function computing `stable_hash(value, seed)`.
+    """
+    return (
+        "function(v){v=String(v);var h=%d,i;"
+        "for(i=0;i<v.length;i++)h=Math.imul(h^v.charCodeAt(i),%d);"
+        "h^=h>>>16;h=Math.imul(h,0x85ebca6b);h^=h>>>13;h=Math.imul(h,0xc2b2ae35);"
+        "h^=h>>>16;return h>>>0;}"
+    ) % (_fnv1a(six.text_type(seed), _FNV_OFFSETS[0]), _FNV_PRIME)
+
+
+class HyperLogLog(object):
+    """
+    An estimate of the number of distinct values seen, which can be merged
+    with others to estimate the distinct values seen by any of them.
+
+    Sketches are serialized as one character per register, the register's
+    value offset from `OFFSET`.
+    """
+
+    OFFSET = 35
+
+    # A JQL reducer building (or merging) sketches of the values returned
+    # by an accessor.
+    JAVASCRIPT = (
+        "function(accumulators, items){"
+        "var f=%(accessor)s,p=%(precision)d,m=1<<p,r=[],i,j,h,w,c,v,a,s='';"
+        "for(i=0;i<m;i++)r.push(0);"
+        "for(i=0;i<accumulators.length;i++){a=accumulators[i];"
+        "if(a)for(j=0;j<m;j++){c=a.charCodeAt(j)-%(offset)d;if(c>r[j])r[j]=c;}}"
+        "for(i=0;i<items.length;i++){v=f(items[i]);"
+        "if(v===undefined||v===null)continue;v=String(v);h=%(basis)d;"
+        "for(j=0;j<v.length;j++)h=Math.imul(h^v.charCodeAt(j),%(prime)d);"
+        "h^=h>>>16;h=Math.imul(h,0x85ebca6b);h^=h>>>13;h=Math.imul(h,0xc2b2ae35);"
+        "h^=h>>>16;h>>>=0;"
+        "j=h>>>(32-p);w=(h<<p)>>>0;c=w?Math.clz32(w)+1:33-p;if(c>r[j])r[j]=c;}"
+        "for(i=0;i<m;i++)s+=String.fromCharCode(%(offset)d+r[i]);"
+        "return s;}"
+    )
+
+    def __init__(self, precision=12, registers=None):
+        """
+        :param precision: The number of bits of each hash used to pick a
+                          register. More registers (`2 ** precision`) give
+                          more accurate estimates.
+        :param registers: The registers of an existing sketch.
+        """
+        if not isinstance(precision, int) or not 4 <= precision <= 16:
+            raise ValueError("precision must be an integer from 4 to 16")
+        self.precision = precision
+        self.registers = bytearray(registers or (1 << precision))
+
+    @classmethod
+    def javascript(cls, accessor, precision=12):
+        HyperLogLog(precision)  # Validates the precision.
+        return cls.JAVASCRIPT % {
+            'accessor': accessor, 'precision': precision, 'offset': cls.OFFSET,
+            'basis': _FNV_OFFSETS[0], 'prime': _FNV_PRIME}
+
+    @classmethod
+    def from_sketch(cls, sketch):
+        """
+        Loads a sketch serialized by the JavaScript reducer or `to_sketch`.
+        """
+        precision = len(sketch).bit_length() - 1
+        if len(sketch) != 1 << precision:
+            raise ValueError("Sketches must have a power of 2 registers")
+        return cls(precision, [ord(c) - cls.OFFSET for c in sketch])
+
+    def to_sketch(self):
+        return ''.join(six.unichr(self.OFFSET + r) for r in self.registers)
+
+    def add(self, value):
+        if value is None:
+            return
+        if not isinstance(value, six.string_types):
+            value = _text(value)
+        h = _mix(_fnv1a(value, _FNV_OFFSETS[0]))
+        p = self.precision
+        w = (h << p) & 0xFFFFFFFF
+        rank = 32 - w.bit_length() + 1 if w else 33 - p
+        j = h >> (32 - p)
+        self.registers[j] = max(self.registers[j], rank)
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Only sketches of the same precision can be merged")
+        for j, r in enumerate(other.registers):
+            if r > self.registers[j]:
+                self.registers[j] = r
+        return self
+
+    def cardinality(self):
+        """
+        The estimated number of distinct values added to the sketch.
+        """
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        elif estimate > 2 ** 32 / 30:
+            estimate = -2 ** 32 * math.log(1 - estimate / 2 ** 32)
+        return int(round(estimate))
+
+
+class TDigest(object):
+    """
+    An approximation of the distribution of the numbers seen, accurate at
+    the extremes, which can be merged with others to approximate the
+    distribution of the numbers seen by any of them.
+
+    Sketches are serialized as a flat list of the compression followed by
+    the mean and count of each centroid.
+    """
+
+    # A JQL reducer building (or merging) sketches of the numbers returned
+    # by an accessor.
+    JAVASCRIPT = (
+        "function(accumulators, items){"
+        "var f=%(accessor)s,d=%(compression)r,c=[],o=[d],n=0,i,j,a,v,q,l,u;"
+        "function k(q){return d/(2*Math.PI)*Math.asin(2*q-1);}"
+        "function ki(k){return k>=d/4?1:(Math.sin(2*Math.PI*k/d)+1)/2;}"
+        "for(i=0;i<accumulators.length;i++){a=accumulators[i];"
+        "if(a)for(j=1;j<a.length;j+=2)c.push([a[j],a[j+1]]);}"
+        "for(i=0;i<items.length;i++){v=f(items[i]);"
+        "if(typeof v==='number'&&isFinite(v))c.push([v,1]);}"
+        "if(!c.length)return o;"
+        "c.sort(function(x,y){return x[0]-y[0];});"
+        "for(i=0;i<c.length;i++)n+=c[i][1];"
+        "u=[c[0][0],c[0][1]];q=0;l=ki(k(0)+1);"
+        "for(i=1;i<c.length;i++){"
+        "if(q+(u[1]+c[i][1])/n<=l){u[0]+=(c[i][0]-u[0])*c[i][1]/(u[1]+c[i][1]);u[1]+=c[i][1];}"
+        "else{o.push(u[0],u[1]);q+=u[1]/n;l=ki(k(q)+1);u=[c[i][0],c[i][1]];}}"
+        "o.push(u[0],u[1]);return o;}"
+    )
+
+    def __init__(self, compression=100, centroids=None):
+        """
+        :param compression: Bounds the number of centroids kept (roughly
+                            `compression / 2`). Higher values are more
+                            accurate.
+        :param centroids: The `(mean, count)` centroids of an existing
+                          sketch, sorted by mean.
+        """
+        if compression <= 0:
+            raise ValueError("compression must be positive")
+        self.compression = compression
+        self.centroids = list(centroids or ())
+        self._unmerged = []
+
+    @classmethod
+    def javascript(cls, accessor, compression=100):
+        TDigest(compression)  # Validates the compression.
+        return cls.JAVASCRIPT % {'accessor': accessor, 'compression': float(compression)}
+
+    @classmethod
+    def from_sketch(cls, sketch):
+        """
+        Loads a sketch serialized by the JavaScript reducer or `to_sketch`.
+        """
+        # Sketches returned by `send()` hold Decimals, as parsed by ijson.
+        return cls(float(sketch[0]), [(float(m), float(c))
+                                      for m, c in zip(sketch[1::2], sketch[2::2])])
+
+    def to_sketch(self):
+        self._compress()
+        sketch = [self.compression]
+        for mean, count in self.centroids:
+            sketch.extend((mean, count))
+        return sketch
+
+    def add(self, value, count=1):
+        self._unmerged.append((value, count))
+        if len(self._unmerged) > 10 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one.
+        """
+        other._compress()
+        self._unmerged.extend(other.centroids)
+        self._compress()
+        return self
+
+    def _compress(self):
+        if not self._unmerged:
+            return
+        centroids = sorted(self.centroids + self._unmerged, key=lambda c: c[0])
+        self._unmerged = []
+        d = float(self.compression)
+        total = float(sum(c for _, c in centroids))
+
+        def k(q):
+            return d / (2 * math.pi) * math.asin(2 * q - 1)
+
+        def k_inverse(k):
+            return 1 if k >= d / 4 else (math.sin(2 * math.pi * k / d) + 1) / 2
+
+        merged = []
+        mean, count = centroids[0]
+        q = 0
+        limit = k_inverse(k(0) + 1)
+        for m, c in centroids[1:]:
+            if q + (count + c) / total <= limit:
+                mean += (m - mean) * c / (count + c)
+                count += c
+            else:
+                merged.append((mean, count))
+                q += count / total
+                limit = k_inverse(k(q) + 1)
+                mean, count = m, c
+        merged.append((mean, count))
+        self.centroids = merged
+
+    def count(self):
+        self._compress()
+        return sum(c for _, c in self.centroids)
+
+    def quantile(self, q):
+        """
+        The estimated value below which the given fraction of numbers fall.
+
+        :param q: The quantile, from 0 to 1.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1")
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.count()
+        seen = 0
+        previous = None
+        for mean, count in self.centroids:
+            center = seen + count / 2.0
+            if target < center:
+                if previous is None:
+                    return mean
+                prev_mean, prev_center = previous
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (
+                    center - prev_center)
+            previous = (mean, center)
+            seen += count
+        return self.centroids[-1][0]
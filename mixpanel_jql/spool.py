@@ -0,0 +1,194 @@
+"""
+Results written to disk as they arrive, so they can be read again.
+"""
+
+from __future__ import absolute_import
+
+import mmap
+import os
+import tempfile
+
+from .parsing import _parse, element_offsets
+
+
+class _SpoolReader(object):
+    """
+    Reads a spool from the start, downloading more of it whenever it gets
+    to the end of what's been written so far.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.position = 0
+
+    def read(self, n):
+        result = self.result
+        while self.position >= result._size and result._pull():
+            pass
+        data = result._read(self.position, n)
+        self.position += len(data)
+        return data
+
+
+class _MappedReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, n):
+        data = self.data[self.position:self.position + n]
+        self.position += len(data)
+        return data
+
+
+class SpooledResult(object):
+    """
+    The results of a query, written to disk as they are downloaded. The
+    results can be iterated over any number of times (only the first pass
+    downloads them), and read in parts through an index of their rows.
+
+    The file is deleted when the result is closed, unless it was given by
+    path. Results aren't safe to use from several threads at once.
+    """
+
+    def __init__(self, chunks, decoders, spool):
+        """
+        :param chunks: An iterator over the bytes of the response.
+        :param decoders: The functions applied, in order, to each row.
+        :param spool: The path of a file to write the results to, a
+                      directory to write them to a temporary file in, or True
+                      to write them to a temporary file in the default place.
+        """
+        self._chunks = chunks
+        self._decoders = decoders
+        if spool is True or os.path.isdir(spool):
+            fd, self.path = tempfile.mkstemp(
+                prefix='mixpanel-jql-', suffix='.json', dir=None if spool is True else spool)
+            self._file = os.fdopen(fd, 'w+b')
+            self._delete = True
+        else:
+            self._file = open(spool, 'w+b')
+            self.path = spool
+            self._delete = False
+        self._size = 0
+        self._complete = False
+        self._error = None
+        self._map = None
+        self._index = None
+
+    def _pull(self):
+        """
+        Writes the next chunk of the response to the spool.
+
+        :return: False if the whole response has already been written.
+        """
+        if self._complete:
+            return False
+        if self._error is not None:
+            raise self._error
+        try:
+            chunk = next(self._chunks, None)
+        except Exception as e:
+            self._error = e
+            raise
+        if chunk is None:
+            self._complete = True
+            self._chunks = None
+            self._file.flush()
+            return False
+        self._file.seek(self._size)
+        self._file.write(chunk)
+        self._size += len(chunk)
+        return True
+
+    def _read(self, position, n):
+        self._file.seek(position)
+        return self._file.read(min(n, self._size - position))
+
+    def _mapped(self):
+        """
+        The whole of the results, downloading the rest of them first.
+        """
+        if self._map is None:
+            while self._pull():
+                pass
+            # Empty files can't be mapped.
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self._size else b''
+        return self._map
+
+    def _decode(self, row):
+        for decode in self._decoders:
+            row = decode(row)
+        return row
+
+    def __iter__(self):
+        # Imported here to keep the cost of importing this library low.
+        import ijson
+
+        if self._file is None:
+            raise ValueError("The result is closed")
+        source = _MappedReader(self._mapped()) if self._complete else _SpoolReader(self)
+        for row in ijson.items(source, 'item'):
+            yield self._decode(row)
+
+    @property
+    def index(self):
+        """
+        The offsets of the rows in the spool (see `element_offsets`),
+        downloading the rest of the results first.
+        """
+        if self._index is None:
+            self._index = element_offsets(self._mapped())
+        return self._index
+
+    def batch(self, start, stop=None):
+        """
+        Parses the rows between two positions in the index, without parsing
+        any of the rest of the results.
+
+        :param start: The position in the index of the first row.
+        :param stop: The position in the index after the last row (by
+                     default, the one after the first row).
+        :return: A list of the rows.
+        """
+        index = self.index
+        if stop is None:
+            stop = start + 1 if start != -1 else None
+        start, stop, _ = slice(start, stop).indices(len(index))
+        if start >= stop:
+            return []
+        data = self._mapped()
+        end = index[stop] if stop < len(index) else data.rfind(b']')
+        rows = _parse(data[index[start]:end].rstrip().rstrip(b','))
+        return [self._decode(row) for row in rows]
+
+    def close(self):
+        """
+        Closes (and, unless it was given by path, deletes) the spool.
+        """
+        if self._file is None:
+            return
+        if self._chunks is not None:
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+            self._chunks = None
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._file = None
+        if self._delete:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_file', None) is not None:
+            self.close()
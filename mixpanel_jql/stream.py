@@ -0,0 +1,286 @@
+"""
+Tools for consuming the rows of a query while they're still arriving.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import os
+import pickle
+import tempfile
+import threading
+
+from six.moves import queue
+
+_END = object()
+
+# How often (in seconds) a reader blocked on a full queue checks whether
+# it should stop.
+_POLL_INTERVAL = 0.1
+
+
+class _Failure(object):
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(rows, size):
+    """
+    Iterates over rows read ahead on a background thread, so reading (and
+    parsing) the rows overlaps with whatever is done with them. At most
+    `size` rows are read ahead of the consumer.
+
+    Errors raised while reading are raised to the consumer, after any rows
+    read before them. Closing the returned iterator, or abandoning it,
+    stops the reader and closes `rows`.
+
+    :param rows: An iterator (typically a generator) over the rows.
+    :param size: The number of rows to read ahead.
+    :return: An iterator over the rows.
+    """
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        raise ValueError("size must be a positive integer")
+    return _prefetch(rows, size)
+
+
+def _prefetch(rows, size):
+    buffer = queue.Queue(size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for row in rows:
+                if not put(row):
+                    break
+            else:
+                put(_END)
+        except Exception as e:
+            put(_Failure(e))
+        finally:
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+
+    reader = threading.Thread(target=read, name='mixpanel-jql-prefetch')
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+def tee(rows, n=2, size=1000, spill=None):
+    """
+    Splits one iterator over rows into `n` independent iterators, which may
+    be consumed from different threads. Unlike `itertools.tee`, at most
+    `size` rows are kept in memory: a consumer more than `size` rows ahead
+    of the slowest one waits for it to catch up, unless `spill` is given,
+    in which case older rows are written to disk for the slower consumers
+    to read back instead.
+
+    Rows are read from `rows` by whichever consumer first needs them, and
+    errors raised while reading are raised to each consumer when it gets
+    to them. Closing (or abandoning) a consumer stops it holding back the
+    others, and closing all of them closes `rows`.
+
+    :param rows: An iterator over the rows.
+    :param n: The number of iterators to return.
+    :param size: The number of rows to keep in memory.
+    :param spill: True to spill rows to a temporary file, or a directory to
+                  write the temporary file in. Rows are pickled, so must be
+                  picklable.
+    :return: A tuple of `n` iterators over the rows.
+    """
+    for name, value in (('n', n), ('size', size)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError("%s must be a positive integer" % name)
+    if spill not in (None, False, True) and not os.path.isdir(spill):
+        raise ValueError("spill must be True or a directory")
+    shared = _Tee(rows, n, size, spill or None)
+    return tuple(_TeeIterator(shared, i) for i in range(n))
+
+
+class _Tee(object):
+    """
+    The rows shared by the iterators returned by `tee`.
+
+    Rows are numbered from 0 in the order they're read. Those from
+    `memory_start` on are kept in `memory`, and those before it which some
+    consumer still needs are in the spill file, at the offsets in
+    `spilled` (starting from row `spilled_start`).
+    """
+
+    def __init__(self, rows, n, size, spill):
+        self.rows = rows
+        self.size = size
+        self.spill = spill
+        # The position of each consumer, and the thread it was last used from.
+        self.positions = dict.fromkeys(range(n), 0)
+        self.threads = {}
+        self.abandoned = []
+        self.condition = threading.Condition(threading.Lock())
+        self.memory = collections.deque()
+        self.memory_start = 0
+        self.read = 0
+        self.reading = False
+        self.end = False
+        self.error = None
+        self.file = None
+        self.spilled = []
+        self.spilled_start = 0
+
+    def _next(self, i):
+        if i not in self.positions:
+            return _END
+        position = self.positions[i]
+        self.threads[i] = threading.current_thread()
+        while position == self.read:
+            self._leave_abandoned()
+            if self.end:
+                if self.error is not None:
+                    raise self.error
+                return _END
+            if self.reading:
+                self.condition.wait(_POLL_INTERVAL)
+            elif self.spill is None and self.read - min(self.positions.values()) >= self.size:
+                self._wait_for_others(i)
+            else:
+                self._read()
+        self.positions[i] = position + 1
+        if position >= self.memory_start:
+            row = self.memory[position - self.memory_start]
+        else:
+            self.file.seek(self.spilled[position - self.spilled_start])
+            row = pickle.load(self.file)
+        self._trim()
+        return row
+
+    def _wait_for_others(self, i):
+        low = min(self.positions.values())
+        lagging = [j for j, position in self.positions.items() if position == low]
+        if all(self.threads.get(j) is self.threads[i] for j in lagging):
+            raise RuntimeError(
+                "A tee'd iterator got %d rows ahead of another used from the same thread; "
+                "use spill to buffer more rows on disk" % self.size)
+        self.condition.wait(_POLL_INTERVAL)
+
+    def _read(self):
+        # Other consumers carry on with the rows already read meanwhile.
+        self.reading = True
+        self.condition.release()
+        try:
+            row = next(self.rows, _END)
+        except Exception as e:
+            row = _Failure(e)
+        finally:
+            self.condition.acquire()
+            self.reading = False
+            self.condition.notify_all()
+        if row is _END or isinstance(row, _Failure):
+            self.end = True
+            self.error = getattr(row, 'error', None)
+            return
+        if len(self.memory) >= self.size:
+            self._spill()
+        self.memory.append(row)
+        self.read += 1
+
+    def _spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(
+                prefix='mixpanel-jql-', dir=None if self.spill is True else self.spill)
+        self.file.seek(0, os.SEEK_END)
+        self.spilled.append(self.file.tell())
+        pickle.dump(self.memory.popleft(), self.file, pickle.HIGHEST_PROTOCOL)
+        self.memory_start += 1
+
+    def _trim(self):
+        """
+        Drops the rows every consumer has already read.
+        """
+        low = min(self.positions.values()) if self.positions else self.read
+        if low >= self.memory_start and self.spilled:
+            self.file.seek(0)
+            self.file.truncate()
+            self.spilled = []
+        while self.memory_start < low:
+            self.memory.popleft()
+            self.memory_start += 1
+        if not self.spilled:
+            self.spilled_start = self.memory_start
+        self.condition.notify_all()
+
+    def _leave_abandoned(self):
+        while self.abandoned:
+            self._leave(self.abandoned.pop())
+
+    def _leave(self, i):
+        if i not in self.positions:
+            return
+        del self.positions[i]
+        self.threads.pop(i, None)
+        self._trim()
+        if not self.positions:
+            self._close()
+
+    def _close(self):
+        close = getattr(self.rows, 'close', None)
+        if close is not None:
+            close()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class _TeeIterator(object):
+
+    def __init__(self, shared, i):
+        self.shared = shared
+        self.i = i
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.shared.condition:
+            row = self.shared._next(self.i)
+        if row is _END:
+            self.close()
+            raise StopIteration
+        return row
+
+    next = __next__
+
+    def close(self):
+        with self.shared.condition:
+            self.shared._leave(self.i)
+
+    def __del__(self):
+        # Garbage collection may happen while this thread holds the lock, so
+        # if it can't be had, whoever has it leaves for this iterator.
+        shared = self.shared
+        shared.abandoned.append(self.i)
+        if shared.condition.acquire(False):
+            try:
+                shared._leave_abandoned()
+            finally:
+                shared.condition.release()
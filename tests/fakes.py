@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+
+class FakeResponse(object):
+    """
+    Stands in for a streamed `requests` response carrying JSON rows.
+    """
+
+    def __init__(self, rows, chunk_size=7, error=None):
+        self.content = json.dumps(rows).encode('utf8')
+        self.chunk_size = chunk_size
+        self.error = error
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), self.chunk_size):
+            if self.error is not None and i >= len(self.content) // 2:
+                raise self.error
+            yield self.content[i:i + self.chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def respond(rows, **kwargs):
+    """
+    Patches `requests.post` to answer every request with the given rows.
+    """
+    return mock.patch(
+        'requests.post', side_effect=lambda *a, **kw: FakeResponse(rows, **kwargs))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import json
+import threading
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.coalesce import SingleFlight, coalesce
+from mixpanel_jql.exceptions import JQLSyntaxError
+
+from .fakes import respond
+from .test_sketches import NODE, run_node
+
+ROWS = [{'key': [i], 'value': i * 2} for i in range(50)]
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.query = JQL('secret', events=Events()).group_by('e.x', Reducer.count())
+
+    def test_shared_request(self):
+        with respond(ROWS) as post:
+            a = self.flights.send(self.query)
+            b = self.flights.send(self.query)
+            self.assertEqual(next(a), ROWS[0])
+            self.assertEqual(list(b), ROWS)
+            self.assertEqual(list(a), ROWS[1:])
+            self.assertEqual(post.call_count, 1)
+
+            # The request has landed, so the next send is a new one.
+            self.assertEqual(list(self.flights.send(self.query)), ROWS)
+            self.assertEqual(post.call_count, 2)
+
+    def test_distinct_queries(self):
+        with respond(ROWS) as post:
+            a = self.flights.send(self.query)
+            b = self.flights.send(self.query.bind(x=1))
+            c = self.flights.send(JQL('other', events=Events()).group_by('e.x', Reducer.count()))
+            for rows in (a, b, c):
+                self.assertEqual(list(rows), ROWS)
+            self.assertEqual(post.call_count, 3)
+
+    def test_decoded_per_subscriber(self):
+        # The same script, with rows decoded differently.
+        named = JQL('secret', events=Events()).group_by('e.x', {'n': Reducer.count()})
+        listed = JQL('secret', events=Events()).group_by('e.x', [Reducer.count()])
+        with respond([{'key': ['x'], 'value': [3]}]) as post:
+            a = self.flights.send(named)
+            b = self.flights.send(listed)
+            self.assertEqual(list(b), [{'key': ['x'], 'value': [3]}])
+            self.assertEqual(list(a), [{'key': ['x'], 'value': {'n': 3}}])
+            self.assertEqual(post.call_count, 1)
+
+    def test_concurrent_subscribers(self):
+        results = [None] * 8
+        start = threading.Event()
+
+        def consume(i, rows):
+            start.wait()
+            results[i] = list(rows)
+
+        with respond(ROWS, chunk_size=1) as post:
+            threads = [
+                threading.Thread(target=consume, args=(i, self.flights.send(self.query)))
+                for i in range(len(results))]
+            for t in threads:
+                t.start()
+            start.set()
+            for t in threads:
+                t.join()
+            self.assertEqual(post.call_count, 1)
+        self.assertEqual(results, [ROWS] * len(results))
+
+    def test_errors_reach_every_subscriber(self):
+        with respond(ROWS, error=IOError('connection reset')):
+            a = self.flights.send(self.query)
+            b = self.flights.send(self.query)
+            for rows in (a, b):
+                with self.assertRaises(IOError):
+                    list(rows)
+
+    def test_abandoned_request(self):
+        with respond(ROWS) as post:
+            a = self.flights.send(self.query)
+            next(a)
+            a.close()
+            self.assertEqual(list(self.flights.send(self.query)), ROWS)
+            self.assertEqual(post.call_count, 2)
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def _query(self, event, from_date, to_date, user=False):
+        query = JQL('secret', events=Events({
+            'event_selectors': [{'event': event}],
+            'from_date': from_date,
+            'to_date': to_date
+        })).filter('e.properties.x > 1')
+        group = query.group_by_user if user else query.group_by
+        return group('e.properties.c', Reducer.count())
+
+    def test_script(self):
+        coalesced = coalesce([
+            self._query('A', '2017-01-01', '2017-01-31'),
+            self._query('B', '2017-01-15', '2017-02-15'),
+            self._query('A', '2017-02-01', '2017-02-28'),
+        ], utc_offset=timedelta(hours=-8))
+        # Each day starts at 08:00 UTC.
+        self.assertEqual(
+            str(coalesced.query),
+            'function main() { return Events({"event_selectors": [{"event": "A"}, '
+            '{"event": "B"}], "from_date": "2017-01-01", "to_date": "2017-02-28"})'
+            '.filter(function(e){return e.properties.x > 1})'
+            '.groupBy([mixpanel.multiple_keys(function(e){var t = []; '
+            'if (["A"].indexOf(e.name) >= 0 && e.time >= 1483257600000 '
+            '&& e.time < 1485936000000) t.push(0); '
+            'if (["B"].indexOf(e.name) >= 0 && e.time >= 1484467200000 '
+            '&& e.time < 1487232000000) t.push(1); '
+            'if (["A"].indexOf(e.name) >= 0 && e.time >= 1485936000000 '
+            '&& e.time < 1488355200000) t.push(2); '
+            'return t;}), function(e){return e.properties.c}], mixpanel.reducer.count()); }')
+
+    def test_same_dates(self):
+        # Queries over the same dates need no offset, as Mixpanel picks their events.
+        coalesced = coalesce([self._query('A', '2017-01-01', '2017-01-31'),
+                              self._query('B', '2017-01-01', '2017-01-31')])
+        self.assertIn('if (["A"].indexOf(e.name) >= 0) t.push(0);', str(coalesced.query))
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_midnight(self):
+        coalesced = coalesce([self._query('A', '2017-01-01', '2017-01-31'),
+                              self._query('A', '2017-02-01', '2017-02-28')],
+                             utc_offset=timedelta(hours=-8))
+        tag = coalesced.query.operations[-1].args[0][0]
+        # Late on January 31st in the project's timezone, but February in UTC.
+        times = [datetime(2017, 2, 1, 7, 59), datetime(2017, 2, 1, 8, 0)]
+        events = [{'name': 'A', 'time': int((t - datetime(1970, 1, 1)).total_seconds() * 1000)}
+                  for t in times]
+        self.assertEqual(run_node(
+            'var mixpanel = {multiple_keys: function(f){return f}}; '
+            'console.log(JSON.stringify(%s.map(%s)));' % (json.dumps(events), tag)), [[0], [1]])
+
+    def test_split(self):
+        coalesced = coalesce([
+            self._query('A', '2017-01-01', '2017-01-31', user=True),
+            self._query('B', '2017-01-01', '2017-01-31', user=True),
+        ])
+        rows = [
+            {'key': ['u1', 0, 'x'], 'value': 1},
+            {'key': ['u1', 1, 'x'], 'value': 2},
+            {'key': ['u2', 1, 'y'], 'value': 3},
+        ]
+        with respond(rows) as post:
+            a, b = coalesced.send()
+            self.assertEqual(list(b), [
+                {'key': ['u1', 'x'], 'value': 2},
+                {'key': ['u2', 'y'], 'value': 3},
+            ])
+            self.assertEqual(list(a), [{'key': ['u1', 'x'], 'value': 1}])
+            self.assertEqual(post.call_count, 1)
+
+    def test_error(self):
+        coalesced = coalesce([
+            self._query('A', '2017-01-01', '2017-01-31'),
+            self._query('B', '2017-01-01', '2017-01-31'),
+        ])
+        rows = [{'key': [i % 2, 'x%d' % i], 'value': i} for i in range(40)]
+        with respond(rows, error=IOError('connection reset')):
+            a, b = coalesced.send()
+            # The error reaches every query, not just the one reading.
+            for rows in (a, b):
+                with self.assertRaises(IOError):
+                    list(rows)
+
+    def test_invalid(self):
+        query = self._query('A', '2017-01-01', '2017-01-31')
+        for queries in (
+                [],
+                [query, query.filter('e.y')],
+                [query, JQL('other', events=Events()).filter(
+                    'e.properties.x > 1').group_by('e.properties.c', Reducer.count())],
+                [query.sort_asc('e.value')],
+                [JQL('secret', events=Events({'event_selectors': [{'selector': 'x'}]})
+                     ).group_by('e.c', Reducer.count())],
+                # Without the project's timezone, events can't be told apart by date.
+                [query, self._query('A', '2017-02-01', '2017-02-28')]):
+            with self.assertRaises(JQLSyntaxError):
+                coalesce(queries)
+        with self.assertRaises(JQLSyntaxError):
+            coalesce([query], utc_offset=-8)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import array
+import json
+import pickle
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.columns import Columns, read_columns, to_columns
+from mixpanel_jql.exceptions import JQLSyntaxError, SchemaMismatchError
+
+from .fakes import mock, respond
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestToColumns(unittest.TestCase):
+
+    def test_columns(self):
+        rows = [{'key': ['a', 1], 'value': {'n': 2, 's': 1.5, 'ok': True}},
+                {'key': ['b', 2], 'value': {'n': 3, 's': 4, 'ok': False}}]
+        schema = {'key': [str, int], 'value': {'n': int, 's': float, 'ok': bool}}
+        columns = to_columns(rows, schema)
+        self.assertIsInstance(columns, Columns)
+        self.assertEqual(list(columns), ['key.0', 'key.1', 'value.n', 'value.s', 'value.ok'])
+        self.assertEqual(columns['key.0'], ['a', 'b'])
+        self.assertEqual(list(columns['key.1']), [1, 2])
+        self.assertEqual(columns['value.s'], array.array('d', [1.5, 4.0]))
+        self.assertEqual(list(columns['value.ok']), [1, 0])
+        self.assertEqual(columns.rows, 2)
+
+    def test_scalars(self):
+        columns = to_columns(iter([1, 2, 3]), int)
+        self.assertEqual(list(columns), ['value'])
+        self.assertEqual(list(columns['value']), [1, 2, 3])
+        self.assertEqual(to_columns([], int).rows, 0)
+
+    def test_mismatch(self):
+        schema = {'key': [str], 'value': int}
+        for row in ({'key': ['a'], 'value': 1.5},
+                    {'key': ['a'], 'value': True},
+                    {'key': ['a'], 'value': 2 ** 63},
+                    {'key': ['a', 'b'], 'value': 1},
+                    {'key': [1], 'value': 1},
+                    {'key': 'a', 'value': 1},
+                    {'value': 1},
+                    [['a'], 1]):
+            with self.assertRaises(SchemaMismatchError):
+                to_columns([row], schema)
+
+    def test_invalid_schema(self):
+        for schema in ({'key': [dict]}, {}, [], 'int'):
+            with self.assertRaises(JQLSyntaxError):
+                to_columns([], schema)
+
+    def test_pickle(self):
+        columns = to_columns([{'key': ['a'], 'value': 1}], {'key': [str], 'value': int})
+        self.assertEqual(pickle.loads(pickle.dumps(columns)), columns)
+
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_to_numpy(self):
+        columns = to_columns([[1, 0.5, True, 'a'], [2, 1.5, False, 'b']],
+                             [int, float, bool, str])
+        arrays = columns.to_numpy()
+        self.assertEqual(arrays['0'].dtype, numpy.int64)
+        self.assertEqual(arrays['1'].tolist(), [0.5, 1.5])
+        self.assertEqual(arrays['2'].tolist(), [True, False])
+        self.assertEqual(arrays['3'].tolist(), ['a', 'b'])
+
+
+class TestReadColumns(unittest.TestCase):
+
+    def test_columns(self):
+        rows = [{'key': ['a', 1], 'extra': [{'x': [1]}], 'value': {'s': 1.5, 'ok': True}},
+                {'value': {'ok': False, 's': 4}, 'key': ['b', 2]}]
+        schema = {'key': [str, int], 'value': {'s': float, 'ok': bool}}
+        data = json.dumps(rows).encode('utf8')
+        columns = read_columns([data[:9], data[9:]], schema)
+        self.assertEqual(columns, to_columns(rows, schema))
+        self.assertEqual(list(columns), ['key.0', 'key.1', 'value.s', 'value.ok'])
+        self.assertEqual(read_columns([b'[]'], int).rows, 0)
+
+    def test_mismatch(self):
+        schema = {'key': [str], 'value': int}
+        for row in ({'key': ['a'], 'value': 1.5},
+                    {'key': ['a'], 'value': True},
+                    {'key': ['a'], 'value': 2 ** 63},
+                    {'key': ['a'], 'value': None},
+                    {'key': ['a', 'b'], 'value': 1},
+                    {'key': [], 'value': 1},
+                    {'key': [1], 'value': 1},
+                    {'key': 'a', 'value': 1},
+                    {'value': 1},
+                    [['a'], 1]):
+            data = json.dumps([{'key': ['a'], 'value': 1}, row]).encode('utf8')
+            with self.assertRaises(SchemaMismatchError) as raised:
+                read_columns([data], schema)
+            self.assertIn('Row 1 ', str(raised.exception))
+
+
+class TestSendSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events()).group_by(
+            ['e.name'], {'n': Reducer.count(), 's': Reducer.sum('e.x')})
+
+    def test_send(self):
+        rows = [{'key': ['x%d' % i], 'value': [i, i + 0.5]} for i in range(100)]
+        with respond(rows):
+            with mock.patch('mixpanel_jql.columns.to_columns') as materialized:
+                # Named accumulators are read in the order they're returned.
+                columns = self.query.send(
+                    schema={'value': {'s': float, 'n': int}, 'key': [str]}, prefetch=2)
+        self.assertFalse(materialized.called)
+        self.assertEqual(list(columns), ['value.s', 'value.n', 'key.0'])
+        self.assertEqual(list(columns['value.n']), list(range(100)))
+        self.assertEqual(columns['value.s'][10], 10.5)
+        self.assertEqual(columns['key.0'][10], 'x10')
+
+    def test_compact(self):
+        # The rows are scaled up and rebuilt before they're read.
+        with respond([['x', 1], ['y', 2]]):
+            columns = self.query.sample(0.5).group_by('e.a', Reducer.count()).compact(
+                as_tuples=True).send(prefetch=10, schema=[[str], int])
+        self.assertEqual(columns['0.0'], ['x', 'y'])
+        self.assertEqual(list(columns['1']), [2, 4])
+
+    def test_mismatch(self):
+        with respond([{'key': ['x'], 'value': [1, None]}]):
+            with self.assertRaises(SchemaMismatchError):
+                self.query.send(schema={'key': [str], 'value': {'n': int, 's': float}})
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.send(schema=int, spool=True)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.send(schema={'key': object})
+        with self.assertRaises(JQLSyntaxError):
+            self.query.send(schema={'key': [str], 'value': {'n': int, 's': float}}, prefetch=0)
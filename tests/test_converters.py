@@ -4,7 +4,8 @@ from __future__ import unicode_literals
 
 import unittest
 
-from mixpanel_jql import Converter
+from mixpanel_jql import JQL, Converter, Events, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
 
 
 class TestConverters(unittest.TestCase):
@@ -13,3 +14,40 @@ class TestConverters(unittest.TestCase):
         self.assertEqual(
             str(Converter.to_number('e.properties.y')),
             'mixpanel.to_number(function(e){return e.properties.y})')
+
+    def test_numeric_bucket(self):
+        self.assertEqual(
+            str(Converter.numeric_bucket('e.properties.y', [0, 10, 100])),
+            'mixpanel.numeric_bucket(function(e){return e.properties.y}, [0, 10, 100])')
+        self.assertEqual(
+            str(Converter.numeric_bucket('e.properties.y', {'bucket_size': 10})),
+            'mixpanel.numeric_bucket(function(e){return e.properties.y}, {"bucket_size": 10})')
+        with self.assertRaises(JQLSyntaxError):
+            Converter.numeric_bucket('e.properties.y', {'offset': 10})
+        with self.assertRaises(JQLSyntaxError):
+            Converter.numeric_bucket('e.properties.y', 10)
+
+    def test_time_bucket(self):
+        self.assertEqual(
+            str(Converter.time_bucket()),
+            'mixpanel.numeric_bucket("time", mixpanel.daily_time_buckets)')
+        self.assertEqual(
+            str(Converter.time_bucket('hour')),
+            'mixpanel.numeric_bucket("time", mixpanel.hourly_time_buckets)')
+        with self.assertRaises(JQLSyntaxError):
+            Converter.time_bucket('fortnight')
+
+    def test_multiple_keys(self):
+        self.assertEqual(
+            str(Converter.multiple_keys('e.properties.tags')),
+            'mixpanel.multiple_keys(function(e){return e.properties.tags})')
+
+    def test_as_group_key(self):
+        query = JQL('key', events=Events()).group_by(
+            keys=[Converter.time_bucket('week'), 'e.name'],
+            accumulator=Reducer.count())
+        self.assertEqual(
+            str(query),
+            'function main() { return Events({}).groupBy('
+            '[mixpanel.numeric_bucket("time", mixpanel.weekly_time_buckets), '
+            'function(e){return e.name}], mixpanel.reducer.count()); }')
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import array
+import multiprocessing
+import os
+import time
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer, param
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.executor import _SharedArray, _load, _share, send_many, shared_memory
+
+from .fakes import respond
+
+
+def values(rows):
+    return array.array('d', (row['value'] for row in rows))
+
+
+def summarize(rows):
+    return {'count': sum(1 for _ in rows), 'pid': multiprocessing.current_process().pid}
+
+
+class TestSendMany(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events()).group_by(
+            ['e.name'], {'n': Reducer.count()})
+
+    def test_rows(self):
+        rows = [{'key': ['a'], 'value': [1]}, {'key': ['b'], 'value': [2]}]
+        with respond(rows):
+            results = list(send_many([self.query, self.query], processes=2))
+        # Rows are decoded in the workers.
+        self.assertEqual(results, [[
+            {'key': ['a'], 'value': {'n': 1}}, {'key': ['b'], 'value': {'n': 2}},
+        ]] * 2)
+
+    def test_transform(self):
+        query = JQL('secret', events=Events()).group_by(['e.name'], Reducer.count())
+        with respond([{'key': [i], 'value': i} for i in range(10)]):
+            results = list(send_many([query] * 3, summarize, processes=2))
+        self.assertEqual([r['count'] for r in results], [10] * 3)
+        self.assertNotIn(multiprocessing.current_process().pid, [r['pid'] for r in results])
+
+    def test_shared_arrays(self):
+        query = JQL('secret', events=Events()).group_by(['e.name'], Reducer.count())
+        rows = [{'key': [i], 'value': i * 0.5} for i in range(20000)]
+        with respond(rows, chunk_size=2 ** 16):
+            results = list(send_many([query, query], values, processes=2))
+        self.assertEqual(results, [array.array('d', (i * 0.5 for i in range(20000)))] * 2)
+        with respond(rows, chunk_size=2 ** 16):
+            pool = multiprocessing.Pool(2)
+            try:
+                self.assertEqual(list(send_many([query, query], values, processes=pool)), results)
+            finally:
+                pool.terminate()
+
+    @unittest.skipUnless(shared_memory and os.path.isdir('/dev/shm'), "no shared memory to list")
+    def test_abandoned(self):
+        query = JQL('secret', events=Events()).group_by(['e.name'], Reducer.count())
+        rows = [{'key': [i], 'value': i * 0.5} for i in range(20000)]
+        before = set(os.listdir('/dev/shm'))
+        with respond(rows, chunk_size=2 ** 16):
+            results = send_many([query] * 3, values, processes=3)
+            next(results)
+            # The other results are shared while no one is reading them.
+            time.sleep(1)
+            results.close()
+        self.assertEqual(set(os.listdir('/dev/shm')) - before, set())
+
+    def test_errors(self):
+        with self.assertRaises(JQLSyntaxError):
+            send_many([self.query.filter('e.x == %s' % param('x'))])
+        with respond([{'key': [i], 'value': [i]} for i in range(10)], error=IOError('reset')):
+            with self.assertRaises(IOError):
+                list(send_many([self.query], processes=1))
+
+    def test_no_queries(self):
+        self.assertEqual(list(send_many([])), [])
+
+
+@unittest.skipIf(shared_memory is None, "shared memory requires Python 3.8+")
+class TestSharing(unittest.TestCase):
+
+    def test_round_trip(self):
+        large = array.array('q', range(10000))
+        result = _share({'a': large, 'b': [large, array.array('b', [1])], 'c': 'x'})
+        self.assertIsInstance(result['a'], _SharedArray)
+        self.assertIsInstance(result['b'][1], array.array)
+        self.assertEqual(_load(result), {'a': large, 'b': [large, array.array('b', [1])], 'c': 'x'})
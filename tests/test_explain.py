@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.explain import _PROBE
+
+from .fakes import FakeResponse, mock
+from .test_sketches import NODE, run_reducer
+
+
+class TestExplain(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events({
+            'event_selectors': [{'event': 'X'}],
+            'from_date': '2016-05-01',
+            'to_date': '2016-05-31',
+        })).filter('e.properties.a == 1').group_by(['e.properties.b'], Reducer.count())
+
+    def test_probes(self):
+        scripts = []
+
+        def post(*args, **kwargs):
+            scripts.append(kwargs['data']['script'])
+            return FakeResponse([[100 - len(scripts), 1000]])
+
+        with mock.patch('requests.post', side_effect=post):
+            explanation = self.query.explain(fraction=0.1)
+        self.assertEqual(len(scripts), 3)
+        for i, script in enumerate(scripts):
+            self.assertIn('_sample(e.distinct_id)<%d' % int(0.1 * 2 ** 32), script)
+            self.assertIn('.reduce(function(accs,items){', script)
+            self.assertEqual(script.count('.filter('), 2 if i else 1)
+        self.assertNotIn('groupBy', scripts[1])
+        self.assertIn('groupBy', scripts[2])
+        self.assertEqual([s.operation for s in explanation.stages], [
+            self.query.source,
+            '.filter(function(e){return e.properties.a == 1})',
+            '.groupBy([function(e){return e.properties.b}], mixpanel.reducer.count())',
+        ])
+        self.assertEqual([s.rows for s in explanation.stages], [990, 980, 970])
+        self.assertEqual(explanation.rows, 970)
+        self.assertEqual(explanation.bytes, 10000)
+        self.assertEqual(explanation.warnings, [])
+        self.assertIn('9.8 KB', str(explanation))
+
+    def test_sampled_query(self):
+        query = self.query.sample(0.5)
+        with mock.patch('requests.post', side_effect=lambda *a, **kw: FakeResponse([[10, 100]])):
+            explanation = query.explain()
+        # The query's own sample isn't scaled up, or probed apart from its source.
+        self.assertEqual(len(explanation.stages), 3)
+        self.assertEqual(explanation.rows, 10)
+
+    def test_static(self):
+        with mock.patch('requests.post') as post:
+            explanation = self.query.explain(probe=False)
+        self.assertFalse(post.called)
+        self.assertEqual(explanation.rows, None)
+        self.assertIn('?', str(explanation))
+
+    def test_large_results(self):
+        with mock.patch('requests.post', side_effect=lambda *a, **kw: FakeResponse([[1, 2 ** 21]])):
+            explanation = self.query.explain()
+        self.assertEqual(explanation.warnings, [
+            'The results are estimated at 200.0 MB, and may time out or fail'])
+
+    def test_red_flags(self):
+        query = JQL('secret', events=Events()).group_by_user(
+            ["new Date(e.time).toISOString().split('T')[0]"], Reducer.count()
+        ).sort_desc('e.value')
+        self.assertEqual(query.explain(probe=False).warnings, [
+            "Stage 2 sorts the output of group_by_user (stage 1), which has a row for "
+            "every user; aggregate it further or sort client side",
+            'Stage 1 builds keys with new Date(...) for every record; '
+            'Converter.time_bucket(...) is much faster',
+        ])
+        query = JQL('secret', events=Events()).group_by_user(['e.name'], Reducer.count()) \
+            .group_by(['e.key[1]'], Reducer.count()).sort_desc('e.value')
+        self.assertEqual(query.explain(probe=False).warnings, [])
+
+        query = JQL('secret', events=Events()).sort_asc('e.time').reduce(Reducer.count())
+        self.assertEqual(query.explain(probe=False).warnings, [
+            'Stage 1 sorts records which are then aggregated, so the order is lost'])
+
+        query = JQL('secret', events=Events()).filter('e.name == "a"')
+        self.assertEqual(query.explain(probe=False).warnings, [
+            'The query is never aggregated, so every matching record is returned'])
+
+    def test_invalid_fraction(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.explain(fraction=0)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_probe_reducer(self):
+        values = [1, 'ab', {'c': None}]
+        size = sum(len(json.dumps({'v': v}, separators=(',', ':'))) + 1 for v in values)
+        self.assertEqual(run_reducer(_PROBE, values[:2], values[2:]), [3, size])
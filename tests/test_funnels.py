@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import json
+import unittest
+
+from mixpanel_jql import JQL, Events, raw
+from mixpanel_jql.exceptions import JQLSyntaxError
+
+from .test_sketches import NODE, run_node
+
+HOUR = 3600000
+
+
+def run_by_user(query, *batches):
+    """
+    Runs the per-user reducer of a funnel or retention query over batches
+    of one user's events, returning the keys the user is counted under.
+    """
+    by_user = [op for op in query.operations if op.name == 'groupByUser'][0]
+    group = query.operations[-1]
+    reducer = str(by_user)[len('groupByUser('):-1]
+    keys = group.args[0]
+    return run_node(
+        '%s var r = %s, s; %s.forEach(function(b){ s = r(s, b); });'
+        'var row = JSON.parse(JSON.stringify({key: ["user"], value: s}));'
+        'console.log(JSON.stringify([%s]));'
+        % (" ".join(query.preamble), reducer, json.dumps(batches),
+           ", ".join("(%s)(row)" % k.replace('mixpanel.multiple_keys', '') for k in keys)))
+
+
+def events(*names_and_hours):
+    return [{'name': name, 'time': hour * HOUR} for name, hour in names_and_hours]
+
+
+class TestFunnel(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events())
+
+    def test_script(self):
+        query = self.query.funnel(['a', raw('function(e){return e.properties.x > 1}')],
+                                  timedelta(hours=1))
+        self.assertEqual([op.name for op in query.operations],
+                         ['filter', 'groupByUser', 'groupBy'])
+        self.assertEqual(query.preamble, (
+            'var _steps0 = [function(e){return e.name == "a"}, '
+            'function(e){return e.properties.x > 1}];',))
+        self.assertEqual(str(query.operations[0]),
+                         'filter(function(e){return _steps0[0](e) || _steps0[1](e)})')
+        self.assertIn('<= 3600000', str(query))
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.funnel([], 60)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.funnel(['a'], -1)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.funnel([1], 60)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_ordered(self):
+        query = self.query.funnel(['a', 'b', 'c'], timedelta(hours=2))
+        # The first attempt times out, but the second (from a later a) completes.
+        self.assertEqual(run_by_user(
+            query, events(('a', 0), ('b', 1)), events(('a', 2), ('c', 3), ('b', 3), ('c', 4))),
+            [[0, 1, 2]])
+        self.assertEqual(run_by_user(query, events(('a', 0), ('b', 1), ('c', 3))), [[0, 1]])
+        self.assertEqual(run_by_user(query, events(('b', 0), ('a', 1), ('c', 2))), [[0]])
+        self.assertEqual(run_by_user(query, events(('b', 0), ('c', 1))), [[]])
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_unordered(self):
+        query = self.query.funnel(['a', 'b', 'c'], timedelta(hours=2), ordered=False)
+        self.assertEqual(run_by_user(query, events(('c', 0), ('b', 1), ('a', 2))), [[0, 1, 2]])
+        self.assertEqual(run_by_user(query, events(('c', 0)), events(('a', 3), ('b', 4))),
+                         [[0, 1]])
+        self.assertEqual(run_by_user(query, events(('b', 0), ('c', 1))), [[]])
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events())
+
+    def test_script(self):
+        query = self.query.retention('signup', 'login', unit='day', periods=7)
+        self.assertEqual([op.name for op in query.operations],
+                         ['filter', 'groupByUser', 'filter', 'groupBy'])
+        self.assertIn('p <= 7', str(query))
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.retention('signup', 'login', unit='month')
+        with self.assertRaises(JQLSyntaxError):
+            self.query.retention('signup', 'login', periods=0)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_periods(self):
+        query = self.query.retention('signup', 'login', unit='hour', periods=3)
+        self.assertEqual(run_by_user(
+            query,
+            events(('login', 0), ('signup', 10.5), ('login', 11)),
+            events(('login', 12), ('login', 12.5), ('signup', 13), ('login', 14), ('login', 20))),
+            [10 * HOUR, [0, 1, 2, 3]])
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_weekly_cohorts_start_on_mondays(self):
+        query = self.query.retention('signup', 'login', unit='week')
+        # 1970-01-13 is a Tuesday.
+        born = 12 * 24
+        self.assertEqual(run_by_user(query, events(('signup', born)))[0], 11 * 24 * HOUR)
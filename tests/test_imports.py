@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import subprocess
+import sys
+import unittest
+
+
+def imported_modules(statement):
+    """
+    Runs `statement` in a fresh interpreter with `-X importtime`, returning
+    the cumulative import time (in microseconds) of every module imported.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stderr=subprocess.STDOUT).decode('utf8')
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7+")
+class TestImportTime(unittest.TestCase):
+
+    # Modules only needed when sending queries or resolving the version.
+    DEFERRED = ('requests', 'ijson', 'mixpanel_jql._version', 'subprocess')
+
+    def test_deferred_imports(self):
+        modules = imported_modules('import mixpanel_jql')
+        self.assertIn('mixpanel_jql', modules)
+        for module in self.DEFERRED:
+            self.assertNotIn(module, modules)
+
+    def test_version(self):
+        import mixpanel_jql
+        self.assertTrue(mixpanel_jql.__version__)
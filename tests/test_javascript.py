@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.javascript import beautify, minify
+
+
+class TestMinify(unittest.TestCase):
+
+    def test_whitespace_and_comments(self):
+        self.assertEqual(
+            minify('function f(a, b) {\n  // add\n  return a + /* b */ b;\n}'),
+            'function f(a,b){return a+b;}')
+
+    def test_literals_untouched(self):
+        self.assertEqual(
+            minify('var s = "a  // b", t = \'/* c */\'; var r = /x  y\\/[/]/g;'),
+            'var s="a  // b",t=\'/* c */\';var r=/x  y\\/[/]/g;')
+
+    def test_ambiguous_operators(self):
+        self.assertEqual(minify('a + +b - -c + ++d'), 'a+ +b- -c+ ++d')
+        self.assertEqual(minify('x = a / b / c'), 'x=a/b/c')
+
+    def test_automatic_semicolon_insertion(self):
+        self.assertEqual(minify('return\nx'), 'return\nx')
+        self.assertEqual(minify('var a = 1\nvar b = 2'), 'var a=1\nvar b=2')
+        self.assertEqual(minify('a = b\n++c'), 'a=b\n++c')
+        self.assertEqual(minify('a = b\n(c)'), 'a=b(c)')
+        self.assertEqual(minify('a = {\n  b: 1\n}'), 'a={b:1}')
+
+
+class TestBeautify(unittest.TestCase):
+
+    def test_query(self):
+        query = JQL(
+            api_secret=None, events=Events({'from_date': '2016-04-01'})
+        ).filter(
+            'e.properties.B == 2'
+        ).group_by(
+            ['e.a', 'e.b'], Reducer.count()
+        )
+        self.assertEqual(query.pretty, '\n'.join([
+            'function main() {',
+            '    return Events({',
+            '        "from_date": "2016-04-01"',
+            '    }).filter(function(e) {',
+            '        return e.properties.B == 2',
+            '    }).groupBy([function(e) {',
+            '        return e.a',
+            '    }, function(e) {',
+            '        return e.b',
+            '    }], mixpanel.reducer.count());',
+            '}',
+        ]))
+
+    def test_statements(self):
+        self.assertEqual(
+            beautify('if(x>-1){for(var i=0;i<3;i++){x+=i}}else{x=x?1:{}}\n++y'),
+            '\n'.join([
+                'if (x > -1) {',
+                '    for (var i = 0; i < 3; i++) {',
+                '        x += i',
+                '    }',
+                '} else {',
+                '    x = x ? 1 : {}',
+                '}',
+                '++y',
+            ]))
+
+    def test_object_in_ternary(self):
+        # The colon of a key inside a ternary isn't the ternary's colon.
+        self.assertEqual(beautify('x=a?{b:c?1:2}:3').split('\n')[1], '    b: c ? 1 : 2')
+
+    def test_round_trip(self):
+        script = str(JQL(api_secret=None, events=Events()).filter(
+            'e.properties.F == "a  b" && e.x != -1'))
+        self.assertEqual(minify(beautify(script)), minify(script))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from decimal import Decimal
+import json
+import random
+import re
+import unittest
+
+from mixpanel_jql import JQL, Events, GroupRow, HyperLogLog, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.merge import KeyedAggregator, external_sort, merge_function, merge_sorted
+
+from .fakes import FakeResponse, mock
+from .test_sketches import NODE, run_node
+
+
+class TestMergeSorted(unittest.TestCase):
+
+    def test_merge(self):
+        self.assertEqual(list(merge_sorted([[1, 4, 7], [], [2, 5], [3, 6, 8, 9]])),
+                         list(range(1, 10)))
+
+    def test_key_and_reverse(self):
+        rows = [[{'v': 9, 'i': 0}, {'v': 5, 'i': 0}], [{'v': 9, 'i': 1}, {'v': 1, 'i': 1}]]
+        merged = list(merge_sorted(rows, key=lambda r: r['v'], reverse=True))
+        # Ties are taken in the order of the iterables, and rows never compared.
+        self.assertEqual([(r['v'], r['i']) for r in merged], [(9, 0), (9, 1), (5, 0), (1, 1)])
+
+    def test_close(self):
+        closed = []
+
+        def rows(name):
+            try:
+                for i in range(10):
+                    yield i
+            finally:
+                closed.append(name)
+
+        merged = merge_sorted([rows('a'), rows('b')])
+        self.assertEqual([next(merged) for _ in range(3)], [0, 0, 1])
+        merged.close()
+        self.assertEqual(sorted(closed), ['a', 'b'])
+
+
+class TestExternalSort(unittest.TestCase):
+
+    def test_sort(self):
+        generator = random.Random(0)
+        rows = [{'v': generator.randint(0, 100), 'i': i} for i in range(5000)]
+        for reverse in (False, True):
+            for run_size in (7, 1000, 5000, 10000):
+                key = lambda r: r['v']  # noqa: E731
+                self.assertEqual(
+                    list(external_sort(iter(rows), key, reverse, run_size)),
+                    sorted(rows, key=key, reverse=reverse))
+
+    def test_empty(self):
+        self.assertEqual(list(external_sort([], run_size=10)), [])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            external_sort([], run_size=0)
+
+
+def respond_by_shard(rows, count):
+    """
+    Patches `requests.post` to answer each shard of a query with the given
+    rows in that shard, sorted by descending value.
+    """
+    def post(url, auth=None, data=None, stream=None):
+        index = int(re.search(r'%%\s*%d\s*==\s*(\d+)' % count, data['script']).group(1))
+        shard = [r for i, r in enumerate(rows) if i % count == index]
+        return FakeResponse(sorted(shard, key=lambda r: -r['value']))
+    return mock.patch('requests.post', side_effect=post)
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events()).group_by('e.name', Reducer.count())
+
+    def test_before_sort(self):
+        query = self.query.sort_desc('e.value').shard(4, 1)
+        self.assertEqual(
+            [op.name for op in query.operations], ['groupBy', 'filter', 'sortDesc'])
+        self.assertIn(
+            'return _shard0(JSON.stringify(r.key)) % 4 == 1}).sortDesc(', str(query))
+        self.assertTrue(str(query).startswith('function main() { var _shard0 = function(v)'))
+
+    def test_keeps_decoders(self):
+        query = self.query.group_by('e.a', {'n': Reducer.count()}).shard(2, 0)
+        self.assertIn('JSON.stringify(r.key)', str(query))
+        self.assertEqual(len(query._row_decoders()), 1)
+        self.assertIn('JSON.stringify(r)', str(JQL('secret', events=Events()).shard(2, 0)))
+
+    def test_invalid(self):
+        for count, index in ((0, 0), (2, 2), (2, -1), (1.5, 0), (True, 0)):
+            with self.assertRaises(JQLSyntaxError):
+                self.query.shard(count, index)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_disjoint(self):
+        rows = [{'key': ['x%d' % i], 'value': i} for i in range(200)]
+        shards = []
+        for index in range(3):
+            query = self.query.shard(3, index)
+            shards.append(run_node("%s console.log(JSON.stringify(%s.filter(%s)));" % (
+                " ".join(query.preamble), json.dumps(rows), query.operations[-1].args[0])))
+        self.assertEqual(sorted(r['value'] for shard in shards for r in shard), list(range(200)))
+        self.assertTrue(all(shards))
+
+
+class TestSendSharded(unittest.TestCase):
+
+    def test_merged(self):
+        query = JQL('secret', events=Events()).group_by('e.name', Reducer.count()).sort_desc(
+            'e.value')
+        rows = [{'key': ['x%d' % i], 'value': (i * 37) % 101} for i in range(101)]
+        with respond_by_shard(rows, 3):
+            merged = list(query.send_sharded(3, key=lambda r: r['value'], prefetch=10))
+        self.assertEqual([r['value'] for r in merged], list(range(100, -1, -1)))
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            JQL('secret', events=Events()).send_sharded(2, key=lambda r: r['value'])
+        query = JQL('secret', events=Events()).group_by('e.name', Reducer.count()).sort_desc(
+            'e.value')
+        with self.assertRaises(JQLSyntaxError):
+            query.send_sharded(2, key=None)
+        with self.assertRaises(TypeError):
+            query.send_sharded(2)
+
+
+class TestKeyedAggregator(unittest.TestCase):
+
+    def test_spills(self):
+        generator = random.Random(0)
+        rows = [{'key': ['k%d' % generator.randint(0, 300), generator.randint(0, 1)], 'value': i}
+                for i in range(3000)]
+        expected = {}
+        for row in rows:
+            key = tuple(row['key'])
+            expected[key] = expected.get(key, 0) + row['value']
+        for max_keys in (10, 1000):
+            with KeyedAggregator(Reducer.sum('e.x'), max_keys=max_keys) as aggregator:
+                aggregator.update(rows[:1000])
+                aggregator.update(GroupRow(tuple(r['key']), r['value']) for r in rows[1000:])
+                results = list(aggregator)
+                self.assertEqual(dict(results), expected)
+                self.assertEqual(len(results), len(expected))
+                self.assertIsInstance(results[0], GroupRow)
+                self.assertEqual(dict(aggregator), expected)
+
+    def test_accumulators(self):
+        aggregator = KeyedAggregator({'n': Reducer.count(), 'low': Reducer.min('e.x'),
+                                      'seen': Reducer.object_merge()}, max_keys=1)
+        aggregator.add(['a'], {'n': 2, 'low': 5, 'seen': {'x': 1, 'y': {'z': 2}}})
+        aggregator.add(['b'], {'n': 1, 'low': None, 'seen': {}})
+        aggregator.add(['a'], {'n': 3, 'low': 4, 'seen': {'x': 2, 'y': {'z': 1}, 'w': 'v'}})
+        self.assertEqual(dict(aggregator), {
+            ('a',): {'n': 5, 'low': 4, 'seen': {'x': 3, 'y': {'z': 3}, 'w': 'v'}},
+            ('b',): {'n': 1, 'low': None, 'seen': {}}})
+
+    def test_decimals_and_floats(self):
+        # Results parsed from responses hold Decimals, and those loaded back
+        # from JSON files floats.
+        self.assertEqual(merge_function(Reducer.sum('e.x'))(Decimal('1.5'), 2.5), 4)
+        self.assertEqual(merge_function(Reducer.sum('e.x'))(0.5, Decimal('1.5')), 2)
+        merged = merge_function(Reducer.object_merge())({'x': Decimal('0.1'), 'y': {'z': 1.5}},
+                                                        {'x': 0.2, 'y': {'z': Decimal(1)}})
+        self.assertEqual(merged, {'x': Decimal('0.3'), 'y': {'z': Decimal('2.5')}})
+
+    def test_numeric_keys(self):
+        keys = [('1',), (Decimal('1'),), (1,), (1.0,), (True,), (Decimal('1.5'),), (1.5,)]
+        for max_keys in (1, 100):
+            with KeyedAggregator(Reducer.count(), max_keys=max_keys) as aggregator:
+                for key in keys:
+                    aggregator.add(key, 1)
+                counts = sorted(row.value for row in aggregator)
+                self.assertEqual(counts, [1, 1, 2, 3])
+
+    def test_sketches(self):
+        merge = merge_function([Reducer.hll(), Reducer.count()])
+        a, b = HyperLogLog(4), HyperLogLog(4)
+        for i in range(50):
+            (a if i % 2 else b).add(i)
+        merged = merge([a.to_sketch(), 1], [b.to_sketch(), 2])
+        self.assertEqual(merged[1], 3)
+        self.assertEqual(HyperLogLog.from_sketch(merged[0]).registers,
+                         HyperLogLog(4).merge(a).merge(b).registers)
+
+    def test_unmergeable(self):
+        for accumulator in (Reducer.avg('e.x'), [Reducer.count(), Reducer.top(3)], 'count'):
+            with self.assertRaises(ValueError):
+                KeyedAggregator(accumulator)
+        with self.assertRaises(ValueError):
+            KeyedAggregator(max, max_keys=0)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from decimal import Decimal
+import io
+import json
+import multiprocessing
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.parsing import _batches, _Interner, _parse, build_items, parse_array
+
+from .fakes import respond
+
+ROWS = [
+    {'key': ['a "quoted" [string]', 1], 'value': 1.5},
+    {'key': ['back\\slash\\', None], 'value': {'nested': [[], {}, [1, [2]]]}},
+    'a string, with {brackets}',
+    12,
+    [],
+    {'key': ['é中😀', True], 'value': -3e10},
+]
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def rejoin(batches):
+    return b'[' + b''.join(separator + batch for separator, batch in batches) + b']'
+
+
+class TestBatches(unittest.TestCase):
+
+    def test_every_split(self):
+        data = json.dumps(ROWS).encode('utf8')
+        for size in range(1, 40):
+            batches = list(_batches(chunked(data, size), batch_size=30))
+            self.assertGreater(len(batches), 1)
+            self.assertEqual(rejoin(batches), data)
+            rows = [row for _, batch in batches for row in _parse(batch)]
+            self.assertEqual(rows, ROWS)
+
+    def test_first_key(self):
+        data = b' \n[ {"key": 1} ,\n {"other": 2}, {"key": 3} ]\n'
+        batches = list(_batches(chunked(data, 3), 1))
+        self.assertEqual(batches, [
+            (b'', b' {"key": 1} ,\n {"other": 2}'), (b', ', b'{"key": 3} ')])
+
+    def test_scalars(self):
+        # Only objects and arrays are split apart.
+        data = json.dumps(list(range(100))).encode('utf8')
+        self.assertEqual(list(_batches(chunked(data, 7), 10)), [(b'', data[1:-1])])
+
+    def test_empty(self):
+        self.assertEqual(list(_batches([b'[', b' ]'], 10)), [])
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(_batches([b'{"a": 1}'], 10))
+        with self.assertRaises(ValueError):
+            list(_batches([b'[1, 2'], 10))
+        with self.assertRaises(ValueError):
+            list(_batches([b'[1, 2] 3'], 10))
+
+
+class TestParseArray(unittest.TestCase):
+
+    def test_in_order(self):
+        rows = [{'key': [i], 'value': i / 4.0} for i in range(1000)]
+        data = json.dumps(rows).encode('utf8')
+        parsed = list(parse_array(chunked(data, 1000), processes=2, batch_size=500, window=3))
+        self.assertEqual([r['key'] for r in parsed], [r['key'] for r in rows])
+        # Like ijson, non-integers are parsed as Decimals.
+        self.assertEqual(parsed[5]['value'], Decimal('1.25'))
+
+    def test_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            data = json.dumps([[i] for i in range(100)]).encode('utf8')
+            self.assertEqual(list(parse_array(chunked(data, 7), pool, batch_size=20)),
+                             [[i] for i in range(100)])
+        finally:
+            pool.terminate()
+
+    def test_split_within_elements(self):
+        rows = [{'key': [i], 'value': [{'key': '}, {"key": '}, {'key': ['], [']}]}
+                for i in range(200)]
+        data = json.dumps(rows).encode('utf8')
+        batches = list(_batches(chunked(data, 64), batch_size=100))
+        with self.assertRaises(ValueError):
+            for _, batch in batches:
+                _parse(batch)
+        self.assertEqual(list(parse_array(chunked(data, 64), 2, batch_size=100)), rows)
+
+    def test_malformed(self):
+        data = json.dumps([{'key': [i]} for i in range(100)]).encode('utf8')
+        data = data.replace(b'{"key": [50]}', b'{"key": [50}')
+        with self.assertRaises(ValueError):
+            list(parse_array(chunked(data, 64), 2, batch_size=100))
+
+    def test_single_batch(self):
+        self.assertEqual(list(parse_array([b'[1, 2, 3]'], processes=2)), [1, 2, 3])
+
+
+class TestBuildItems(unittest.TestCase):
+
+    def test_items(self):
+        import ijson
+        data = json.dumps(ROWS + ROWS).encode('utf8')
+        rows = list(build_items(ijson.basic_parse(io.BytesIO(data)), _Interner(10)))
+        self.assertEqual(rows, ROWS + ROWS)
+        self.assertIs(rows[0]['key'][0], rows[len(ROWS)]['key'][0])
+        with self.assertRaises(ValueError):
+            list(build_items(ijson.basic_parse(io.BytesIO(b'{}')), _Interner()))
+
+
+class TestSendProcesses(unittest.TestCase):
+
+    def test_send(self):
+        query = JQL('secret', events=Events()).group_by(
+            ['e.name'], {'n': Reducer.count(), 's': Reducer.sum('e.x')})
+        rows = [{'key': ['x%d' % i], 'value': [i, i + 0.5]} for i in range(5000)]
+        with respond(rows, chunk_size=4096):
+            sent = list(query.send(processes=2))
+        self.assertEqual(len(sent), 5000)
+        self.assertEqual(sent[10], {'key': ['x10'], 'value': {'n': 10, 's': Decimal('10.5')}})
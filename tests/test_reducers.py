@@ -112,3 +112,19 @@ class TestComplexReducers(unittest.TestCase):
 
         with self.assertRaises(JQLSyntaxError):
             Reducer.apply_group_limits(77, 77)
+
+
+class TestSketchReducers(unittest.TestCase):
+
+    def test_hll(self):
+        self.assertIn('var f=function(e){return e.distinct_id},p=12,', str(Reducer.hll()))
+        self.assertIn('var f=function(e){return e.x},p=8,', str(Reducer.hll('e.x', 8)))
+        with self.assertRaises(JQLSyntaxError):
+            Reducer.hll(precision=20)
+
+    def test_tdigest(self):
+        self.assertIn('var f=x,d=50.0,', str(Reducer.tdigest(raw('x'), 50)))
+        with self.assertRaises(JQLSyntaxError):
+            Reducer.tdigest('e.x', 'a lot')
+        with self.assertRaises(JQLSyntaxError):
+            Reducer.tdigest('e.x', -1)
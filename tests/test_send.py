@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import date
+import json
+import unittest
+
+from mixpanel_jql import JQL, Events, GroupRow, Reducer, param
+from mixpanel_jql.exceptions import JQLSyntaxError
+
+from .fakes import mock, respond
+
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret='secret', events=Events())
+
+    def test_compact_groups(self):
+        query = self.query.group_by(['e.a', 'e.b'], Reducer.count()).compact()
+        self.assertTrue(str(query).endswith(
+            '.map(function(r){return r.key.concat([r.value])}); }'))
+        with respond([['x', 1, 5], ['y', 2, 6]]):
+            self.assertEqual(list(query.send()), [
+                {'key': ['x', 1], 'value': 5},
+                {'key': ['y', 2], 'value': 6},
+            ])
+
+    def test_compact_user_groups_as_tuples(self):
+        query = self.query.group_by_user('e.a', Reducer.count()).compact(as_tuples=True)
+        with respond([['user', 'x', 5]]):
+            self.assertEqual(list(query.send()), [(('user', 'x'), 5)])
+
+    def test_compact_records(self):
+        query = self.query.select('a', 'b').compact()
+        self.assertTrue(str(query).endswith(
+            '.map(function(e){return [e.name, e.distinct_id, e.time, e.sampling_factor, '
+            'e.last_seen, e.properties["a"], e.properties["b"]]}); }'))
+        with respond([['ev', 'u', 10, None, None, 1, None]]):
+            self.assertEqual(list(query.send()), [{
+                'name': 'ev', 'distinct_id': 'u', 'time': 10, 'properties': {'a': 1}}])
+
+    def test_compact_unknown_shape(self):
+        for query in (self.query, self.query.map('e.properties'),
+                      self.query.group_by('e.a', Reducer.count()).filter('e.value > 1')):
+            with self.assertRaises(JQLSyntaxError):
+                query.compact()
+
+
+class TestGroupRows(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret='secret', events=Events())
+
+    def test_group_by(self):
+        query = self.query.group_by(['e.a', 'e.b'], {'n': Reducer.count()})
+        with respond([{'key': ['x', 1], 'value': [5]}]):
+            rows = list(query.send(group_rows=True))
+        self.assertEqual(rows, [(('x', 1), {'n': 5})])
+        self.assertIsInstance(rows[0], GroupRow)
+        self.assertEqual(rows[0].key, ('x', 1))
+        self.assertEqual({rows[0].key: rows[0].value}, {('x', 1): {'n': 5}})
+
+    def test_compact(self):
+        for as_tuples in (False, True):
+            query = self.query.group_by_user('e.a', Reducer.count()).compact(as_tuples)
+            with respond([['user', 'x', 5]]):
+                self.assertEqual(list(query.send(group_rows=True)),
+                                 [GroupRow(('user', 'x'), 5)])
+
+    def test_sampled(self):
+        query = self.query.sample(0.5).group_by('e.a', Reducer.count())
+        with respond([{'key': ['x'], 'value': 5}]):
+            self.assertEqual(list(query.send(group_rows=True)), [GroupRow(('x',), 10)])
+
+    def test_not_grouped(self):
+        for query in (self.query, self.query.reduce(Reducer.count()),
+                      self.query.group_by('e.a', Reducer.count(), max_groups=5)):
+            with self.assertRaises(JQLSyntaxError):
+                query.send(group_rows=True)
+
+
+class TestIntern(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret='secret', events=Events())
+        self.rows = [{'properties': {'$browser': 'Chrome', '$os': os, 'n': 1.5, 'ok': True},
+                      'tags': [os, None, [{}]]}
+                     for os in ('Linux', 'Mac', 'Linux', 'Mac')]
+
+    def test_keys(self):
+        with respond(self.rows):
+            with mock.patch('ijson.items') as items:
+                rows = list(self.query.send(intern_strings=True))
+        # Rows are built from the parser's events, rather than rebuilt.
+        self.assertFalse(items.called)
+        self.assertEqual(rows, self.rows)
+        first, second = (list(r['properties']) for r in rows[:2])
+        for a, b in zip(sorted(first), sorted(second)):
+            self.assertIs(a, b)
+        self.assertIsNot(rows[0]['properties']['$browser'], rows[1]['properties']['$browser'])
+
+    def test_values(self):
+        with respond(self.rows):
+            rows = list(self.query.send(intern_strings=1))
+        self.assertEqual(rows, self.rows)
+        # Only the first distinct value fits in the table.
+        self.assertIs(rows[0]['properties']['$browser'], rows[3]['properties']['$browser'])
+        self.assertIsNot(rows[0]['tags'][0], rows[2]['tags'][0])
+
+    def test_invalid(self):
+        for intern_strings in (0, -1, 'yes'):
+            with self.assertRaises(JQLSyntaxError):
+                self.query.send(intern_strings=intern_strings)
+        for kwargs in ({'processes': 2}, {'spool': True}):
+            with self.assertRaises(JQLSyntaxError):
+                self.query.send(intern_strings=True, **kwargs)
+
+
+class TestNamedAccumulators(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret='secret', events=Events())
+        self.accumulators = {'n': Reducer.count(), 'total': Reducer.sum('e.x')}
+
+    def test_group_by(self):
+        query = self.query.group_by('e.a', self.accumulators)
+        with respond([{'key': ['x'], 'value': [3, 10]}]):
+            self.assertEqual(
+                list(query.send()), [{'key': ['x'], 'value': {'n': 3, 'total': 10}}])
+        with respond([['x', [3, 10]]]):
+            self.assertEqual(
+                list(query.compact(as_tuples=True).send()), [(('x',), {'n': 3, 'total': 10})])
+
+    def test_reduce(self):
+        query = self.query.reduce(self.accumulators)
+        with respond([[3, 10]]):
+            self.assertEqual(list(query.send()), [{'n': 3, 'total': 10}])
+
+    def test_later_stages(self):
+        query = self.query.group_by('e.a', self.accumulators)
+        # Filters and sorts keep the shape of the rows.
+        for later in (query.filter('e.value[0] > 1'), query.sort_desc('e.value[0]'),
+                      query.filter('e.value[0] > 1').sort_asc('e.value[1]')):
+            with respond([{'key': ['x'], 'value': [3, 10]}]):
+                self.assertEqual(
+                    list(later.send()), [{'key': ['x'], 'value': {'n': 3, 'total': 10}}])
+        with respond([[3, 10]]):
+            self.assertEqual(list(query.map('e.value').send()), [[3, 10]])
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret='secret', events=Events()).sample(0.1)
+
+    def test_rescaled(self):
+        query = self.query.group_by('e.a', {
+            'n': Reducer.count(), 's': Reducer.sum('e.x'), 'm': Reducer.max('e.x')})
+        with respond([{'key': ['x'], 'value': [3, 2.5, 7]}]):
+            self.assertEqual(
+                list(query.send()), [{'key': ['x'], 'value': {'n': 30, 's': 25.0, 'm': 7}}])
+        with respond([[3, 2.5]]):
+            self.assertEqual(
+                list(self.query.reduce([Reducer.count(), Reducer.sum('e.x')]).send()),
+                [[30, 25.0]])
+        with respond([['x', 3]]):
+            self.assertEqual(
+                list(self.query.group_by('e.a', Reducer.count()).compact(as_tuples=True).send()),
+                [(('x',), 30)])
+
+    def test_later_stages(self):
+        query = self.query.group_by('e.a', Reducer.count())
+        for later in (query.sort_desc('e.value'), query.sort_asc('e.key').sort_desc('e.value')):
+            with respond([{'key': ['x'], 'value': 3}]):
+                self.assertEqual(list(later.send()), [{'key': ['x'], 'value': 30}])
+
+    def test_not_rescaled(self):
+        for query in (self.query.group_by_user('e.a', Reducer.count()),
+                      self.query.group_by('e.a', Reducer.avg('e.x')),
+                      self.query.group_by_user('e.a', Reducer.count()).sort_desc('e.value')):
+            with respond([{'key': ['x'], 'value': 3}]):
+                self.assertEqual(list(query.send()), [{'key': ['x'], 'value': 3}])
+
+    def test_not_rescalable(self):
+        # Counts filtered or transformed by later stages can't be scaled up.
+        for query in (self.query.group_by('e.a', Reducer.count()).map('e.value'),
+                      self.query.reduce(Reducer.sum('e.x')).map('e * 2'),
+                      # Filters would compare the unscaled values.
+                      self.query.group_by('e.a', Reducer.count()).filter('e.value > 100'),
+                      self.query.group_by('e.a', Reducer.count()).sort_desc(
+                          'e.value').filter('e.value > 100')):
+            with self.assertRaises(JQLSyntaxError):
+                query.send()
+
+
+class TestParams(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(
+            api_secret='secret',
+            events=Events({'from_date': param('start'), 'to_date': '2017-01-31'})
+        ).filter('e.name == %s' % param('event'))
+
+    def test_script(self):
+        self.assertEqual(
+            str(self.query),
+            'function main() { return Events({"from_date": params.start, '
+            '"to_date": "2017-01-31"}).filter(function(e){return e.name == params.event}); }')
+        self.assertEqual(self.query.parameters, ('start', 'event'))
+
+    def test_send(self):
+        query = self.query.bind(start=date(2017, 1, 1)).bind(event='x')
+        with respond([]) as post:
+            list(query.send())
+        data = post.call_args[1]['data']
+        self.assertEqual(json.loads(data['params']), {'start': '2017-01-01', 'event': 'x'})
+        self.assertEqual(data['script'], query._compile())
+
+    def test_compiled_once(self):
+        with mock.patch('mixpanel_jql.query.minify', side_effect=lambda s: s) as minify:
+            scripts = [self.query.bind(start='2017-01-01', event=e)._compile() for e in 'xyz']
+        self.assertEqual(minify.call_count, 1)
+        self.assertIs(scripts[0], scripts[2])
+
+    def test_string_literals(self):
+        query = self.query.filter('e.name != "params.other"')
+        self.assertEqual(query.parameters, ('start', 'event'))
+        self.assertEqual(query.filter_in('e.name', ['a']).parameters, ('start', 'event', '_in0'))
+
+    def test_unbound(self):
+        with respond([]):
+            with self.assertRaises(JQLSyntaxError):
+                list(self.query.bind(start='2017-01-01').send())
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            param('not valid')
+        with self.assertRaises(JQLSyntaxError):
+            self.query.bind(start=object())
+
+
+class TestGroupLimits(unittest.TestCase):
+
+    def test_sampled_residual(self):
+        query = JQL('secret', events=Events()).sample(0.5).group_by(
+            ['e.name'], Reducer.count(), max_groups=1)
+        with respond([{'key': ['a'], 'value': 10},
+                      {'key': ['$other'], 'value': 6, 'truncated': 2}]):
+            self.assertEqual(list(query.send()), [
+                {'key': ['a'], 'value': 20},
+                {'key': ['$other'], 'value': 12, 'truncated': 2},
+            ])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import random
+import subprocess
+import unittest
+
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.sketches import (
+    BloomFilter, HyperLogLog, TDigest, stable_hash, stable_hash_javascript)
+
+from .fakes import respond
+
+NODE = which('node')
+
+
+def run_node(script):
+    """
+    Runs JavaScript with node, returning whatever it `console.log`s as JSON.
+    """
+    process = subprocess.Popen([NODE], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = process.communicate(script.encode('utf8'))
+    return json.loads(out.decode('utf8'))
+
+
+def run_reducer(reducer, *batches):
+    """
+    Runs a JavaScript reducer over batches of values, feeding each batch
+    the result of the previous one as an accumulator.
+    """
+    return run_node(
+        'var r = %s, a = []; %s.forEach(function(b){'
+        '  a = [r(a, b.map(function(v){return {v: v}}))]; });'
+        'console.log(JSON.stringify(a[0]));' % (reducer, json.dumps(batches)))
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    VALUES = ['user%d' % i for i in range(1000)] + ['é中😀', 12345]
+    OTHERS = ['other%d' % i for i in range(5000)]
+
+    def setUp(self):
+        self.bloom = BloomFilter.from_values(self.VALUES, 0.01)
+
+    def test_membership(self):
+        for v in self.VALUES:
+            self.assertIn(v, self.bloom)
+        false_positives = sum(1 for v in self.OTHERS if v in self.bloom)
+        self.assertLess(false_positives / float(len(self.OTHERS)), 0.02)
+
+    def test_params(self):
+        params = self.bloom.to_params()
+        copy = BloomFilter(params['m'], params['k'], params['bits'])
+        for v in self.VALUES + self.OTHERS:
+            self.assertEqual(v in copy, v in self.bloom)
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            BloomFilter.from_values(self.VALUES, 1.5)
+        with self.assertRaises(JQLSyntaxError):
+            BloomFilter.from_values([1.5], 0.01)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_javascript(self):
+        values = self.VALUES + self.OTHERS
+        self.assertEqual(
+            run_node(
+                'var f = %s(%s); console.log(JSON.stringify(%s.map(function(v){return f.has(v)})));'
+                % (BloomFilter.JAVASCRIPT, json.dumps(self.bloom.to_params()),
+                   json.dumps(values))),
+            [v in self.bloom for v in values])
+
+
+class TestStableHash(unittest.TestCase):
+
+    VALUES = ['user%d' % i for i in range(100)] + ['é中😀', 12]
+
+    def test_seed(self):
+        self.assertEqual(stable_hash('a', 1), stable_hash('a', 1))
+        self.assertNotEqual(stable_hash('a', 1), stable_hash('a', 2))
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_javascript(self):
+        self.assertEqual(
+            run_node('console.log(JSON.stringify(%s.map(%s)));'
+                     % (json.dumps(self.VALUES), stable_hash_javascript('seed'))),
+            [stable_hash(v, 'seed') for v in self.VALUES])
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def _sketch(self, values, precision=12):
+        hll = HyperLogLog(precision)
+        for v in values:
+            hll.add(v)
+        return hll
+
+    def test_cardinality(self):
+        for n in (0, 10, 1000, 50000):
+            estimate = self._sketch('user%d' % i for i in range(n)).cardinality()
+            self.assertLessEqual(abs(estimate - n), n * 0.05)
+
+    def test_merge(self):
+        a = self._sketch('user%d' % i for i in range(0, 6000))
+        b = self._sketch('user%d' % i for i in range(4000, 10000))
+        merged = HyperLogLog.from_sketch(a.to_sketch()).merge(b)
+        self.assertLessEqual(abs(merged.cardinality() - 10000), 500)
+        self.assertEqual(
+            merged.to_sketch(), self._sketch('user%d' % i for i in range(10000)).to_sketch())
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(10))
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_javascript(self):
+        values = ['user%d' % i for i in range(3000)] + [1, 'é中😀']
+        sketch = run_reducer(
+            HyperLogLog.javascript('function(e){return e.v}', 10), values[:1000], values[1000:])
+        self.assertEqual(sketch, self._sketch(values, 10).to_sketch())
+
+
+class TestTDigest(unittest.TestCase):
+
+    def setUp(self):
+        r = random.Random(7)
+        self.values = [r.gauss(0, 1) for _ in range(20000)]
+        self.ordered = sorted(self.values)
+
+    def _assert_quantiles(self, digest):
+        self.assertEqual(digest.count(), len(self.values))
+        for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+            self.assertAlmostEqual(
+                digest.quantile(q), self.ordered[int(q * len(self.values))], delta=0.05)
+
+    def test_quantiles(self):
+        digest = TDigest()
+        for v in self.values:
+            digest.add(v)
+        self._assert_quantiles(digest)
+        self.assertLess(len(digest.centroids), 100)
+
+    def test_merge(self):
+        a, b = TDigest(), TDigest()
+        for v in self.values[:5000]:
+            a.add(v)
+        for v in self.values[5000:]:
+            b.add(v)
+        self._assert_quantiles(TDigest.from_sketch(a.to_sketch()).merge(b))
+
+    def test_sent(self):
+        digest = TDigest()
+        for v in self.values:
+            digest.add(v)
+        query = JQL('secret', events=Events()).group_by(
+            'e.name', {'t': Reducer.tdigest('e.properties.v')})
+        with respond([{'key': ['x'], 'value': [digest.to_sketch()]}]):
+            row, = query.send()
+        sent = TDigest.from_sketch(row['value']['t'])
+        self._assert_quantiles(sent)
+        local = TDigest()
+        local.add(0.5)
+        self.assertEqual(sent.merge(local).count(), len(self.values) + 1)
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_javascript(self):
+        sketch = run_reducer(
+            TDigest.javascript('function(e){return e.v}'), self.values[:8000], self.values[8000:])
+        self._assert_quantiles(TDigest.from_sketch(sketch))
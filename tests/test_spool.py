@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mixpanel_jql import JQL, Events, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.parsing import element_offsets
+
+from .fakes import FakeResponse, mock, respond
+
+ROWS = [{'key': ['x%d' % i, '}, {"key": ['], 'value': [i]} for i in range(100)]
+
+
+class TestElementOffsets(unittest.TestCase):
+
+    def test_offsets(self):
+        data = json.dumps(ROWS).encode('utf8')
+        offsets = element_offsets(data)
+        self.assertEqual(len(offsets), 100)
+        self.assertEqual(json.loads(data[offsets[7]:offsets[8] - 2].decode('utf8')), ROWS[7])
+
+    def test_nested(self):
+        data = b' [ {"a": [{}, {}]}, [[1], [2]], 3, {}, 4 ] '
+        self.assertEqual([data[o:o + 3] for o in element_offsets(data)],
+                         [b'{"a', b'[[1', b'3, ', b'{},', b'4 ]'])
+
+    def test_scalars(self):
+        data = b'[1,"a, b",  "\\\\", null ,[2, 3]]'
+        self.assertEqual([data[o:o + 2] for o in element_offsets(data)],
+                         [b'1,', b'"a', b'"\\', b'nu', b'[2'])
+
+    def test_empty(self):
+        self.assertEqual(len(element_offsets(b'[ ]')), 0)
+        with self.assertRaises(ValueError):
+            element_offsets(b'{}')
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.query = JQL('secret', events=Events()).group_by(
+            ['e.name', 'e.x'], {'n': Reducer.count()})
+        self.decoded = [dict(row, value={'n': row['value'][0]}) for row in ROWS]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        with respond(ROWS) as post:
+            result = self.query.send(spool=self.directory)
+            self.assertEqual(list(result), self.decoded)
+            self.assertEqual(list(result), self.decoded)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(result.path)])
+        result.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_abandoned_pass(self):
+        with respond(ROWS):
+            with self.query.send(spool=True) as result:
+                first = iter(result)
+                self.assertEqual(next(first), self.decoded[0])
+                # A second pass starts while the first is still downloading.
+                self.assertEqual(list(result), self.decoded)
+                self.assertEqual(list(first), self.decoded[1:])
+        self.assertFalse(os.path.exists(result.path))
+
+    def test_path(self):
+        path = os.path.join(self.directory, 'result.json')
+        with respond(ROWS):
+            with self.query.send(spool=path) as result:
+                list(result)
+        with open(path) as f:
+            self.assertEqual(json.load(f), ROWS)
+
+    def test_batch(self):
+        with respond(ROWS):
+            with self.query.send(spool=True) as result:
+                self.assertEqual(len(result.index), 100)
+                self.assertEqual(result.batch(10), [self.decoded[10]])
+                self.assertEqual(result.batch(95, 200), self.decoded[95:])
+                self.assertEqual(result.batch(-1), [self.decoded[-1]])
+                self.assertEqual(result.batch(5, 5), [])
+                self.assertEqual(list(result), self.decoded)
+
+    def test_batch_scalars(self):
+        rows = ['a, "b"', 1, None, 2.5, [3]]
+        with respond(rows):
+            with JQL('secret', events=Events()).map('e.name').send(spool=True) as result:
+                self.assertEqual(len(result.index), 5)
+                self.assertEqual(result.batch(0), ['a, "b"'])
+                self.assertEqual(result.batch(1, 3), [1, None])
+                self.assertEqual(result.batch(3), [2.5])
+                self.assertEqual(result.batch(-1), [[3]])
+
+    def test_error(self):
+        response = FakeResponse(ROWS, error=IOError('reset'))
+        with mock.patch('requests.post', return_value=response):
+            with self.query.send(spool=True) as result:
+                with self.assertRaises(IOError):
+                    list(result)
+                with self.assertRaises(IOError):
+                    list(result)
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.send(spool=True, prefetch=10)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mixpanel_jql import JQL, Events
+from mixpanel_jql.exceptions import JQLSyntaxError
+from mixpanel_jql.stream import prefetch, tee
+
+from .fakes import FakeResponse, mock, respond
+
+
+class Source(object):
+    """
+    A generator of rows recording how far it has been read, and whether
+    it was closed.
+    """
+
+    def __init__(self, count, error=None):
+        self.read = 0
+        self.closed = threading.Event()
+        self.rows = self._rows(count, error)
+
+    def _rows(self, count, error):
+        try:
+            for i in range(count):
+                self.read += 1
+                yield i
+            if error is not None:
+                raise error
+        finally:
+            self.closed.set()
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_rows(self):
+        source = Source(100)
+        self.assertEqual(list(prefetch(source.rows, 5)), list(range(100)))
+        self.assertTrue(source.closed.wait(1))
+
+    def test_backpressure(self):
+        source = Source(100)
+        rows = prefetch(source.rows, 5)
+        self.assertEqual(next(rows), 0)
+        time.sleep(0.2)
+        # The row handed over, those queued, and one waiting to be queued.
+        self.assertLessEqual(source.read, 7)
+        rows.close()
+
+    def test_error(self):
+        source = Source(3, error=KeyError('x'))
+        rows = prefetch(source.rows, 5)
+        self.assertEqual([next(rows) for _ in range(3)], [0, 1, 2])
+        with self.assertRaises(KeyError):
+            next(rows)
+
+    def test_cancel(self):
+        source = Source(100)
+        rows = prefetch(source.rows, 2)
+        next(rows)
+        rows.close()
+        self.assertTrue(source.closed.wait(1))
+        self.assertLess(source.read, 100)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            prefetch(iter([]), 0)
+
+
+class TestTee(unittest.TestCase):
+
+    def test_rows(self):
+        source = Source(100)
+        a, b, c = tee(source.rows, 3)
+        self.assertEqual(list(a), list(range(100)))
+        self.assertEqual(list(zip(b, c)), [(i, i) for i in range(100)])
+        self.assertTrue(source.closed.is_set())
+
+    def test_backpressure(self):
+        source = Source(100)
+        a, b = tee(source.rows, 2, size=5)
+        rows = []
+        reader = threading.Thread(target=lambda: rows.extend(a))
+        reader.start()
+        time.sleep(0.2)
+        self.assertEqual(source.read, 5)
+        self.assertEqual(list(b), list(range(100)))
+        reader.join(1)
+        self.assertEqual(rows, list(range(100)))
+
+    def test_same_thread(self):
+        a, b = tee(Source(100).rows, 2, size=5)
+        next(b)
+        with self.assertRaises(RuntimeError):
+            list(a)
+
+    def test_spill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for spill in (True, directory):
+                source = Source(100)
+                a, b, c = tee(source.rows, 3, size=3, spill=spill)
+                self.assertEqual(next(c), 0)
+                self.assertEqual(list(a), list(range(100)))
+                self.assertEqual([next(b) for _ in range(50)], list(range(50)))
+                self.assertEqual(list(c), list(range(1, 100)))
+                self.assertEqual(list(b), list(range(50, 100)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_error(self):
+        a, b = tee(Source(3, error=KeyError('x')).rows, 2)
+        for rows in (a, b):
+            self.assertEqual([next(rows) for _ in range(3)], [0, 1, 2])
+            with self.assertRaises(KeyError):
+                next(rows)
+
+    def test_close(self):
+        source = Source(100)
+        a, b = tee(source.rows, 2, size=5)
+        next(a)
+        a.close()
+        # A closed iterator doesn't hold back the others.
+        self.assertEqual(list(b), list(range(100)))
+        source = Source(100)
+        a, b = tee(source.rows, 2)
+        next(a)
+        a.close()
+        b.close()
+        self.assertTrue(source.closed.is_set())
+        self.assertEqual(source.read, 1)
+
+    def test_invalid(self):
+        for kwargs in ({'n': 0}, {'size': 0}, {'spill': 'not/a/directory'}):
+            with self.assertRaises(ValueError):
+                tee(iter([]), **kwargs)
+
+
+class TestSendPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL('secret', events=Events())
+
+    def test_send(self):
+        rows = [{'key': [i], 'value': i} for i in range(50)]
+        with respond(rows):
+            self.assertEqual(list(self.query.send(prefetch=4)), rows)
+
+    def test_error(self):
+        response = FakeResponse([{'value': i} for i in range(50)], error=IOError('reset'))
+        with mock.patch('requests.post', return_value=response):
+            rows = self.query.send(prefetch=4)
+            with self.assertRaises(IOError):
+                list(rows)
+        self.assertTrue(response.closed)
+
+    def test_cancel(self):
+        response = FakeResponse([{'value': i} for i in range(50)])
+        with mock.patch('requests.post', return_value=response):
+            rows = self.query.send(prefetch=2)
+            next(rows)
+            rows.close()
+            for _ in range(20):
+                if response.closed:
+                    break
+                time.sleep(0.05)
+        self.assertTrue(response.closed)
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.send(prefetch=0)
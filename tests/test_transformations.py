@@ -2,9 +2,15 @@
 
 from __future__ import unicode_literals
 
+import json
 import unittest
 
+import six
+
 from mixpanel_jql import JQL, raw, Events, Reducer
+from mixpanel_jql.exceptions import JQLSyntaxError
+
+from .test_sketches import NODE, run_node
 
 
 class TestAccessorOnlyTransformations(unittest.TestCase):
@@ -78,5 +84,160 @@ class TestGroupTransformations(unittest.TestCase):
     def test_group_by(self):
         self._test('group_by', 'groupBy')
 
+    def test_multiple_accumulators(self):
+        expected = (
+            'function main() { return Events({}).groupBy([e.a], '
+            '[mixpanel.reducer.count(), mixpanel.reducer.sum(function(e){return e.x})]); }')
+        self.assertEqual(
+            str(self.query.group_by(raw('e.a'), [Reducer.count(), Reducer.sum('e.x')])),
+            expected)
+        self.assertEqual(
+            str(self.query.group_by(raw('e.a'), {'n': Reducer.count(), 's': Reducer.sum('e.x')})),
+            expected)
+        self.assertEqual(
+            str(self.query.reduce([Reducer.count(), raw('f')])),
+            'function main() { return Events({}).reduce([mixpanel.reducer.count(), f]); }')
+        with self.assertRaises(JQLSyntaxError):
+            self.query.group_by(raw('e.a'), [])
+
     def test_group_by_user(self):
         self._test('group_by_user', 'groupByUser')
+
+
+class TestProjections(unittest.TestCase):
+
+    FIELDS = ('"name": e.name, "distinct_id": e.distinct_id, "time": e.time, '
+              '"sampling_factor": e.sampling_factor, "last_seen": e.last_seen')
+
+    def setUp(self):
+        self.query = JQL(api_secret=None, events=Events())
+
+    def _projection(self, properties):
+        return 'map(function(e){return {%s, "properties": {%s}}})' % (
+            self.FIELDS,
+            ', '.join('"%s": e.properties["%s"]' % (p, p) for p in properties))
+
+    def test_select(self):
+        self.assertEqual(
+            str(self.query.select('a', '$b', 'a')),
+            'function main() { return Events({}).%s; }' % self._projection(['a', '$b']))
+        with self.assertRaises(JQLSyntaxError):
+            self.query.select()
+        with self.assertRaises(JQLSyntaxError):
+            self.query.select(3)
+
+    def test_project(self):
+        query = self.query.filter(
+            'e.properties.a == 2 && e.name == "x"'
+        ).group_by(
+            ["e.properties['b']", raw('"properties.c"')], Reducer.sum('e.properties["d"]')
+        ).sort_desc('e.value')
+        self.assertEqual(
+            str(query.project()),
+            'function main() { return Events({}).%s%s; }' % (
+                self._projection(['a', 'b', 'd', 'c']),
+                ''.join('.%s' % op for op in query.operations)))
+
+    def test_project_needs_reshaping_stage(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.filter('e.properties.a == 2').project()
+
+    def test_project_opaque_records(self):
+        for query in (
+                self.query.map('e'),
+                self.query.map(raw('function(x){return x.properties.a}')),
+                self.query.filter('f(e)').map('e.properties.a')):
+            with self.assertRaises(JQLSyntaxError):
+                query.project()
+
+
+class TestMembershipFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret=None, events=Events())
+
+    def test_set(self):
+        query = self.query.filter_in('e.distinct_id', ['a', 'b', 'a']).filter_in(
+            raw('function(e){return e.name}'), [1])
+        self.assertEqual(
+            str(query),
+            'function main() { var _in0 = new Set(params._in0); '
+            'var _in1 = new Set(params._in1); return Events({})'
+            '.filter(function(e){return _in0.has(e.distinct_id)})'
+            '.filter(function(e){return _in1.has((function(e){return e.name})(e))}); }')
+        self.assertEqual(query.bindings, {'_in0': ['a', 'b'], '_in1': [1]})
+
+    def test_bloom_filter(self):
+        query = self.query.filter_in('e.distinct_id', ['a', 'b'], false_positive_rate=0.01)
+        self.assertIn('var _in0 = (function(f){', str(query))
+        self.assertEqual(sorted(query.bindings['_in0']), ['bits', 'k', 'm'])
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret=None, events=Events())
+
+    def test_sample(self):
+        query = self.query.filter('e.x').sample(0.25, seed='a')
+        self.assertEqual(query.sampling, 0.25)
+        six.assertRegex(
+            self, str(query),
+            r'^function main\(\) \{ var _sample = function\(v\)\{.*\}; return Events\(\{\}\)'
+            r'\.filter\(function\(e\)\{return _sample\(e.distinct_id\) < 1073741824\}\)'
+            r'\.filter\(function\(e\)\{return e.x\}\); \}$')
+        self.assertNotEqual(str(query), str(self.query.filter('e.x').sample(0.25, seed='b')))
+
+    def test_invalid(self):
+        for fraction in (0, 1.5, '0.5'):
+            with self.assertRaises(JQLSyntaxError):
+                self.query.sample(fraction)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.sample(0.5).sample(0.5)
+
+
+class TestGroupLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.query = JQL(api_secret=None, events=Events())
+
+    def test_max_groups(self):
+        query = self.query.group_by(['e.name'], Reducer.count(), max_groups=10)
+        self.assertEqual([op.name for op in query.operations],
+                         ['groupBy', 'reduce', 'map', 'flatten'])
+        self.assertIn('rows.slice(0, 10)', str(query))
+        self.assertIn('key: ["$other"]', str(query))
+
+    def test_max_groups_per_user(self):
+        query = self.query.group_by_user(['e.name'], Reducer.count(), max_groups=10)
+        self.assertEqual([op.name for op in query.operations],
+                         ['groupByUser', 'reduce', 'map', 'flatten'])
+
+    def test_invalid(self):
+        with self.assertRaises(JQLSyntaxError):
+            self.query.group_by(['e.name'], Reducer.count(), max_groups=0)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.group_by(['e.name'], Reducer.count(), max_groups='10')
+        with self.assertRaises(JQLSyntaxError):
+            self.query.group_by(['e.name'], [Reducer.count(), Reducer.sum('e.x')], max_groups=10)
+        with self.assertRaises(JQLSyntaxError):
+            self.query.group_by(['e.name'], Reducer.count(), max_groups=10).compact()
+
+    @unittest.skipUnless(NODE, "node is not installed")
+    def test_folding(self):
+        query = self.query.group_by(['e.name'], Reducer.count(), max_groups=2)
+        reduce, fold = [str(op)[len(op.name) + 1:-1] for op in query.operations[1:3]]
+        batches = [
+            [{'key': ['a'], 'value': 1}, {'key': ['b'], 'value': 5}],
+            [{'key': ['c'], 'value': 3}, {'key': ['d'], 'value': 4}, {'key': ['e'], 'value': 2}],
+        ]
+        # Each batch is reduced separately before the results are merged.
+        rows = run_node(
+            'var r = %s, f = %s, b = %s; '
+            'console.log(JSON.stringify(f(r(b.map(function(i){return r([], i)}), []))));'
+            % (reduce, fold, json.dumps(batches)))
+        self.assertEqual(rows, [
+            {'key': ['b'], 'value': 5},
+            {'key': ['d'], 'value': 4},
+            {'key': ['$other'], 'value': 6, 'truncated': 3},
+        ])